@@ -0,0 +1,105 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Compares the number of function evaluations and the time per fit of curve_fit with
+finite-difference derivatives and with the analytic jacobians of the fit functions.
+
+Usage: python benchmarks/jacobians.py [--frames 200]
+"""
+
+from __future__ import division
+import argparse
+import timeit
+import numpy as np
+from scipy.optimize import curve_fit
+import odmanalysis.fitfunctions as ff
+
+
+class CountingFitFunction(object):
+    """
+    Wraps a fit function and counts the evaluations of the function and of its jacobian.
+    """
+    def __init__(self,fitFunction):
+        self.fitFunction = fitFunction
+        self.nfev = 0
+        self.njev = 0
+
+    def __call__(self,x,*parameters):
+        self.nfev += 1
+        return self.fitFunction(x,*parameters)
+
+    def jacobian(self,x,*parameters):
+        self.njev += 1
+        return self.fitFunction.jacobian(x,*parameters)
+
+
+def createBenchmarkCases(xdata):
+    #spline fit functions interpolate a template profile that starts at pixel 0
+    templateX = np.arange(int(xdata[-1]) + 1)
+    splineTemplate = 1000 + 500*np.exp(-((templateX - 70)/6.)**2)
+
+    cases = [(ff.Gaussian(),[70,6,75000,0.5,1000],0),
+             (ff.Harmonic(),[70,3000,0.02,2,1000],0),
+             (ff.Merlijnian(),[30,60,80,100,70,1000],4),
+             (ff.Jaapian(),[20,5,0.8,70,1000,100],3),
+             (ff.DualHarmonic(),[70,0.1,300,200,1000],0),
+             (ff.Sinc(),[0.3,500,1000,70.5],3)]
+
+    spline = ff.ScaledSpline()
+    spline.estimateInitialParameters(splineTemplate)
+    cases.append((spline,[0.,1.,0.],0))
+    return cases
+
+
+def createProfiles(fitFunction,xdata,parameters,displacementIndex,nFrames,noise=2.0,seed=0):
+    """
+    Creates nFrames noisy profiles of which the displacement parameter moves along a sine.
+    """
+    random = np.random.RandomState(seed)
+    profiles = []
+    for i in range(nFrames):
+        p = np.array(parameters,dtype=float)
+        p[displacementIndex] += 0.2*np.sin(2*np.pi*i/nFrames)
+        profiles.append(fitFunction(xdata,*p) + random.normal(0,noise,len(xdata)))
+    return profiles
+
+
+def fitAll(fitFunction,xdata,profiles,p0,useJacobian):
+    counter = CountingFitFunction(fitFunction)
+    jac = counter.jacobian if useJacobian else None
+    start = timeit.default_timer()
+    for ydata in profiles:
+        p0,pcov = curve_fit(counter,xdata,ydata,p0,jac=jac,maxfev=10000)
+    elapsed = timeit.default_timer() - start
+    return counter.nfev / len(profiles), counter.njev / len(profiles), elapsed / len(profiles) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks curve fitting with and without analytic jacobians.")
+    parser.add_argument('--frames',type=int,default=200,help="number of profiles to fit per fit function")
+    args = parser.parse_args()
+
+    xdata = np.arange(40,100,dtype=float)
+    print "%-40s %8s %8s %8s %8s %8s %8s" % ("fit function","nfev(fd)","nfev(J)","njev(J)","ms(fd)","ms(J)","speedup")
+    for fitFunction,parameters,displacementIndex in createBenchmarkCases(xdata):
+        profiles = createProfiles(fitFunction,xdata,parameters,displacementIndex,args.frames)
+        nfevFD,_,msFD = fitAll(fitFunction,xdata,profiles,parameters,False)
+        nfevJ,njevJ,msJ = fitAll(fitFunction,xdata,profiles,parameters,True)
+        print "%-40s %8.1f %8.1f %8.1f %8.3f %8.3f %8.2f" % (fitFunction.getName(),nfevFD,nfevJ,njevJ,msFD,msJ,msFD/msJ)
+
+
+if __name__ == '__main__':
+    main()
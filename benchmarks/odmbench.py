@@ -0,0 +1,445 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmarks of the hot paths of odmanalysis on a synthetic measurement: parsing
+and reading raw data, cycle detection, fitting with every fit function, exporting
+results and creating plots.
+
+Every benchmark runs in a separate process, so that its peak memory use can be
+measured. The results are written as JSON, with the throughput in profiles per
+second and the peak resident memory of every benchmark, together with the git
+commit and the library versions, so that runs of different commits can be compared:
+
+    python benchmarks/odmbench.py --output before.json
+    git checkout other-branch
+    python benchmarks/odmbench.py --output after.json --compare before.json
+
+odmanalysis must be importable, e.g. installed with 'pip install -e .'.
+"""
+
+from __future__ import division
+import os
+import sys
+import re
+import json
+import shutil
+import inspect
+import platform
+import argparse
+import datetime
+import tempfile
+import resource
+import subprocess
+import timeit
+import warnings
+import multiprocessing
+from collections import OrderedDict
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import scipy
+import pandas as pd
+import odmanalysis as odm
+import odmanalysis.fitfunctions as ff
+import odmanalysis.plots as odmp
+import odmanalysis.AnalysisResults as AnalysisResults
+import odmanalysis.ODMAnalysis as ODMAnalysis
+from odmanalysis.ProgressReporting import ProgressReporter, StreamReporter
+
+from syntheticdata import SyntheticMeasurement
+
+
+DEFAULT_FIT_FUNCTIONS = ["Gaussian","Scaled Spline","Scaled Spline (template matching)","FFT cross-correlation"]
+
+BENCHMARKS = OrderedDict()
+
+
+class Benchmark(object):
+    """
+    A prepared benchmark: run() is timed, prepare() is called untimed before every run.
+    metrics() returns a dictionary of other results, which is added to the results
+    after the last run.
+    """
+    def __init__(self,run,nProfiles,prepare=None,metrics=None):
+        self.run = run
+        self.nProfiles = nProfiles
+        self.prepare = prepare
+        self.metrics = metrics
+
+
+def benchmark(name):
+    """
+    Registers a function that takes a BenchmarkContext and returns a Benchmark.
+    """
+    def register(f):
+        BENCHMARKS[name] = f
+        return f
+    return register
+
+
+class BenchmarkContext(object):
+    def __init__(self,measurement,workDir,fitFrames):
+        self.measurement = measurement
+        self.workDir = workDir
+        self.dataFile = os.path.join(workDir,'data.csv')
+        self.fitFrames = fitFrames
+
+    def readData(self):
+        return odm.readODMData(self.dataFile,progressReporter=ProgressReporter())
+
+    def fitSettings(self,fitFunction,center,referenceIntensityProfile):
+        estimatorIds = [e.id for e in fitFunction.getEstimatorDefinitions()] + ['minBound','maxBound']
+        estimatorValues = {key: value for key,value in self.measurement.estimatorValues(center).items() if key in estimatorIds}
+        settings = odm.ODAFitSettings(fitFunction,estimatorValues)
+        settings.referenceIntensityProfile = referenceIntensityProfile
+        return settings
+
+    def initialParameters(self,settings):
+        """
+        The estimated initial parameters, in the order of the arguments of the fit function.
+        """
+        estimates = settings.fitFunction.estimateInitialParameters(settings.referenceIntensityProfile,**settings.estimatorValuesDict)
+        names = inspect.getargspec(settings.fitFunction.__call__).args[2:]
+        return [float(estimates[name]) for name in names]
+
+    def analysisDataFrame(self):
+        """
+        Returns a dataframe with the columns of an odmanalysis.csv file.
+        """
+        df = self.readData()
+        profiles = odm.getIntensityProfileMatrix(df)
+        results = {}
+        for suffix,center in [('_mp',self.measurement.movingPeakCenter),('_ref',self.measurement.referencePeakCenter)]:
+            settings = self.fitSettings(ff.FFTCrossCorrelation(),center,profiles.iloc[0])
+            fitResults = odm.calculatePeakDisplacements(profiles,settings,ProgressReporter())
+            results['displacement' + suffix] = fitResults.displacement
+            results['chiSquare' + suffix] = fitResults.chiSquare
+        analysis = df[['relativeTime','cycleNumber','direction','actuatorVoltage']].join(pd.DataFrame(results))
+        analysis['displacement'] = analysis.displacement_mp - analysis.displacement_ref
+        return analysis
+
+
+@benchmark('parse/bulk')
+def parseBulk(context):
+    def run():
+        for chunk in odm.getODMDataReader(context.dataFile,dropEmptyProfiles=True):
+            pass
+    return Benchmark(run,context.measurement.nFrames)
+
+@benchmark('parse/rowwise')
+def parseRowwise(context):
+    def run():
+        for chunk in odm.getODMDataReader(context.dataFile,bulkParse=False,dropEmptyProfiles=True):
+            pass
+    return Benchmark(run,context.measurement.nFrames)
+
+@benchmark('parse/region')
+def parseRegion(context):
+    measurement = context.measurement
+    settings = [odm.ODAFitSettings(None,measurement.estimatorValues(center)) for center in [measurement.movingPeakCenter,measurement.referencePeakCenter]]
+    region = odm.ProfileRegion.fromFitSettings(settings)
+    def run():
+        for chunk in odm.getODMDataReader(context.dataFile,dropEmptyProfiles=True,region=region):
+            pass
+    return Benchmark(run,measurement.nFrames)
+
+@benchmark('read/uncached')
+def readUncached(context):
+    cachePath = odm.RawDataCache.getCachePath(context.dataFile)
+    def prepare():
+        if os.path.exists(cachePath):
+            shutil.rmtree(cachePath)
+    return Benchmark(context.readData,context.measurement.nFrames,prepare)
+
+@benchmark('read/cached')
+def readCached(context):
+    context.readData()
+    return Benchmark(context.readData,context.measurement.nFrames)
+
+@benchmark('cycles')
+def detectCycles(context):
+    df = context.readData()[['actuatorVoltage']]
+    def run():
+        odm.getActuationDirectionAndCycle(df.copy())
+    return Benchmark(run,len(df))
+
+def fitBenchmark(fitFunctionName,solver='curve_fit'):
+    def setup(context):
+        df = context.readData()
+        profiles = odm.getIntensityProfileMatrix(df)[:context.fitFrames]
+        settings = context.fitSettings(ff.createFitFunction(fitFunctionName),context.measurement.movingPeakCenter,profiles.iloc[0])
+        pInitial = context.initialParameters(settings)
+        def run():
+            odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=pInitial,solver=solver)
+        return Benchmark(run,len(profiles))
+    return setup
+
+#the vectorized Levenberg-Marquardt solver, to compare with fit/Gaussian and fit/Harmonic
+for name in ['Gaussian','Harmonic']:
+    BENCHMARKS['fit/batched/' + name] = fitBenchmark(name,solver='batched')
+
+@benchmark('fit/cached')
+def fitCached(context):
+    #a fit of which the results are in the fit result cache
+    df = context.readData()
+    profiles = odm.getIntensityProfileMatrix(df)[:context.fitFrames]
+    settings = context.fitSettings(ff.Gaussian(),context.measurement.movingPeakCenter,profiles.iloc[0])
+    pInitial = context.initialParameters(settings)
+    cache = odm.FitResultCache(os.path.join(context.workDir,'fitcache'))
+    odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=pInitial,cache=cache)
+    def run():
+        odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=pInitial,cache=cache)
+    return Benchmark(run,len(profiles))
+
+@benchmark('fit/warmstart')
+def fitWarmStart(context):
+    #a fit with the warm start checks, of profiles of which every 100th is a dropped frame
+    df = context.readData()
+    profiles = odm.getIntensityProfileMatrix(df)[:context.fitFrames]
+    settings = context.fitSettings(ff.Gaussian(),context.measurement.movingPeakCenter,profiles.iloc[0])
+    pInitial = context.initialParameters(settings)
+    data = np.array(profiles.data,dtype=float)
+    data[::100] = np.random.RandomState(0).normal(0,1,data[::100].shape)
+    profiles = odm.ProfileMatrix(data,profiles.index,profiles.xOffset,profiles.binning)
+    def run():
+        odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=pInitial,
+                                       warmStartPolicy=odm.WarmStartPolicy(),maxfev=20000)
+    return Benchmark(run,len(profiles))
+
+def countEvaluations():
+    """
+    Counts the evaluations of the fit functions by curve_fit in calculatePeakDisplacements,
+    in this (benchmark) process. Returns a list with the count.
+    """
+    count = [0]
+    curveFit = ODMAnalysis._curve_fit
+    def countingCurveFit(f,*args,**kwargs):
+        def counted(x,*p):
+            count[0] += 1
+            return f(x,*p)
+        return curveFit(counted,*args,**kwargs)
+    ODMAnalysis._curve_fit = countingCurveFit
+    return count
+
+def predictorBenchmark(predictor,predictByVoltage=False):
+    def setup(context):
+        #every 5th frame, so that the peak moves further between the fitted frames
+        df = context.readData()
+        profiles = odm.getIntensityProfileMatrix(df)[:5*context.fitFrames:5]
+        actuatorVoltage = df.actuatorVoltage.values[:5*context.fitFrames:5] if predictByVoltage else None
+        settings = context.fitSettings(ff.Gaussian(),context.measurement.movingPeakCenter,profiles.iloc[0])
+        pInitial = context.initialParameters(settings)
+        count = countEvaluations()
+        nFits = [0]
+        def run():
+            odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=pInitial,actuatorVoltage=actuatorVoltage,
+                                           warmStartPolicy=odm.WarmStartPolicy(predictor=predictor),maxfev=20000)
+            nFits[0] += len(profiles)
+        return Benchmark(run,len(profiles),metrics=lambda: {'meanEvaluations': count[0] / nFits[0]})
+    return setup
+
+for _predictor in sorted(odm.WarmStart.PREDICTORS):
+    benchmark('fit/predictor/%s' % _predictor)(predictorBenchmark(_predictor))
+    if _predictor != 'previous':
+        benchmark('fit/predictor/%s-voltage' % _predictor)(predictorBenchmark(_predictor,predictByVoltage=True))
+
+@benchmark('export/csv')
+def exportCsv(context):
+    df = context.analysisDataFrame()
+    path = os.path.join(context.workDir,'odmanalysis.csv')
+    def run():
+        df.to_csv(path,index_label='timestamp')
+    return Benchmark(run,len(df))
+
+@benchmark('export/pickle')
+def exportPickle(context):
+    df = context.analysisDataFrame()
+    path = os.path.join(context.workDir,'odmanalysis.pcl')
+    def run():
+        df.to_pickle(path)
+    return Benchmark(run,len(df))
+
+@benchmark('export/binary')
+def exportBinary(context):
+    df = context.analysisDataFrame()
+    path = os.path.join(context.workDir,'odmanalysis' + AnalysisResults.RESULTS_EXTENSION)
+    def run():
+        AnalysisResults.writeAnalysisResults(df,path)
+    return Benchmark(run,len(df))
+
+@benchmark('load/csv')
+def loadCsv(context):
+    df = context.analysisDataFrame()
+    #a name without binary results next to it, so that the csv file is read
+    path = os.path.join(context.workDir,'odmanalysis-csvonly.csv')
+    df.to_csv(path,index_label='timestamp')
+    def run():
+        odm.readAnalysisData(path,readSettings=False)
+    return Benchmark(run,len(df))
+
+@benchmark('load/binary')
+def loadBinary(context):
+    df = context.analysisDataFrame()
+    path = os.path.join(context.workDir,'odmanalysis' + AnalysisResults.RESULTS_EXTENSION)
+    AnalysisResults.writeAnalysisResults(df,path)
+    def run():
+        odm.readAnalysisData(path,readSettings=False)
+    return Benchmark(run,len(df))
+
+@benchmark('progress/stream')
+def reportProgress(context):
+    #progress as calculatePeakDisplacements reports it: once for every profile
+    nProfiles = context.measurement.nFrames
+    def run():
+        reporter = StreamReporter(open(os.devnull,'w'))
+        for i in range(nProfiles):
+            reporter.progress((i + 1) / nProfiles * 100)
+    return Benchmark(run,nProfiles)
+
+@benchmark('plots')
+def createPlots(context):
+    df = context.analysisDataFrame()
+    odm.removeIncompleteCycles(df)
+    plotDir = os.path.join(context.workDir,'plots')
+    if not os.path.exists(plotDir):
+        os.makedirs(plotDir)
+    #animations are left out, because they depend on an external video encoder
+    odmPlots = [odmPlot for odmPlot in odmp.ODMPlot.getSuitablePlotDefinitions(df) if odmPlot.filename.endswith('.png')]
+    def run():
+        for odmPlot in odmPlots:
+            odmPlot.runAndSave(df,plotDir)
+            matplotlib.pyplot.close('all')
+    return Benchmark(run,len(df))
+
+
+def _runBenchmark(name,context,repeat,connection):
+    #progress reporters may hold on to sys.stdout, so the file descriptor is redirected
+    os.dup2(os.open(os.devnull,os.O_WRONLY),sys.stdout.fileno())
+    warnings.simplefilter('ignore')
+    try:
+        bench = BENCHMARKS[name](context)
+        times = []
+        for i in range(repeat):
+            if bench.prepare is not None:
+                bench.prepare()
+            start = timeit.default_timer()
+            bench.run()
+            times.append(timeit.default_timer() - start)
+        result = {'seconds': min(times),
+                  'profiles': bench.nProfiles,
+                  'profilesPerSecond': bench.nProfiles / min(times)}
+        if bench.metrics is not None:
+            result.update(bench.metrics())
+    except Exception as e:
+        result = {'error': "%s: %s" % (type(e).__name__,e)}
+    result['peakRSSMB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    connection.send(result)
+    connection.close()
+
+def runBenchmark(name,context,repeat=1):
+    """
+    Runs the target benchmark in a new process and returns a dictionary with its results.
+    """
+    receiver,sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_runBenchmark,args=(name,context,repeat,sender))
+    process.start()
+    result = receiver.recv() if receiver.poll(None) else {'error': 'no result'}
+    process.join()
+    return result
+
+
+def getCommit():
+    try:
+        root = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=root,stderr=open(os.devnull,'w')).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def compareResults(current,baseline,stream=sys.stderr):
+    stream.write("%-45s %14s %14s %8s\n" % ("benchmark","baseline (/s)","current (/s)","ratio"))
+    for name,result in current['results'].items():
+        old = baseline['results'].get(name,{})
+        if 'profilesPerSecond' in result and 'profilesPerSecond' in old:
+            stream.write("%-45s %14.1f %14.1f %8.2f\n" % (name,old['profilesPerSecond'],result['profilesPerSecond'],result['profilesPerSecond'] / old['profilesPerSecond']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks odmanalysis on a synthetic measurement.")
+    parser.add_argument('--frames',type=int,default=2000)
+    parser.add_argument('--pixels',type=int,default=200)
+    parser.add_argument('--width',type=float,default=6.,help="standard deviation of the peaks in pixels")
+    parser.add_argument('--cycles',type=int,default=4)
+    parser.add_argument('--noise',type=float,default=2.)
+    parser.add_argument('--fit-frames',dest='fitFrames',type=int,default=500,help="number of profiles to fit per fit function")
+    parser.add_argument('--fitfunctions',type=str,nargs='+',default=DEFAULT_FIT_FUNCTIONS,help="names of the fit functions to benchmark, or 'all'")
+    parser.add_argument('--repeat',type=int,default=1,help="the best of this many runs is reported")
+    parser.add_argument('--only',type=str,default=None,help="regular expression for the benchmarks to run")
+    parser.add_argument('--output',type=str,default=None,help="JSON file to write the results to (default stdout)")
+    parser.add_argument('--compare',type=str,default=None,help="JSON file of an earlier run to compare with")
+    parser.add_argument('--list',action='store_true',help="list the benchmarks and exit")
+    args = parser.parse_args()
+
+    fitFunctionNames = [f.getName() for f in ff.createFitFunctions()] if args.fitfunctions == ['all'] else args.fitfunctions
+    for name in fitFunctionNames:
+        BENCHMARKS['fit/' + name] = fitBenchmark(name)
+
+    names = [name for name in BENCHMARKS if args.only is None or re.search(args.only,name)]
+    if args.list:
+        print "\n".join(names)
+        return
+
+    measurement = SyntheticMeasurement(args.frames,args.pixels,args.width,args.cycles,args.noise)
+    workDir = tempfile.mkdtemp(prefix='odmbench')
+    try:
+        measurement.write(os.path.join(workDir,'data.csv'))
+        context = BenchmarkContext(measurement,workDir,min(args.fitFrames,args.frames))
+
+        results = OrderedDict()
+        for name in names:
+            results[name] = runBenchmark(name,context,args.repeat)
+            result = results[name]
+            if 'error' in result:
+                sys.stderr.write("%-45s %s\n" % (name,result['error']))
+            else:
+                sys.stderr.write("%-45s %10.4f s %12.1f profiles/s %8.1f MB\n" % (name,result['seconds'],result['profilesPerSecond'],result['peakRSSMB']))
+    finally:
+        shutil.rmtree(workDir)
+
+    parameters = measurement.toDict()
+    parameters.update({'fitFrames': context.fitFrames,'repeat': args.repeat})
+    report = OrderedDict([('commit',getCommit()),
+                          ('date',datetime.datetime.now().isoformat()),
+                          ('python',platform.python_version()),
+                          ('numpy',np.__version__),
+                          ('scipy',scipy.__version__),
+                          ('pandas',pd.__version__),
+                          ('parameters',parameters),
+                          ('results',results)])
+
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=2)
+    else:
+        print json.dumps(report,indent=2)
+
+    if args.compare is not None:
+        with open(args.compare,'r') as f:
+            compareResults(report,json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Generator of synthetic data.csv files in the format written by the LabVIEW ODM
+measurement software.
+
+Every intensity profile has a moving Gaussian peak and a fixed reference peak. The
+actuator voltage is a triangle wave and the displacement of the moving peak is
+proportional to the square of the voltage, like that of an electrostatic actuator.
+
+Usage: python benchmarks/syntheticdata.py data.csv [--frames 2000] [--pixels 200] ...
+"""
+
+from __future__ import division
+import argparse
+import datetime
+import numpy as np
+
+
+class SyntheticMeasurement(object):
+    """
+    Parameters of a synthetic measurement and the true displacements it contains.
+    """
+    def __init__(self,nFrames=2000,nPixels=200,peakWidth=6.,nCycles=4,noise=2.,amplitude=10.,maxVoltage=20.,seed=0):
+        self.nFrames = nFrames
+        self.nPixels = nPixels
+        self.peakWidth = peakWidth
+        self.nCycles = nCycles
+        self.noise = noise
+        self.amplitude = amplitude
+        self.maxVoltage = maxVoltage
+        self.seed = seed
+
+        self.baseline = 1000.
+        self.peakHeight = 2000.
+        self.movingPeakCenter = 0.35 * nPixels
+        self.referencePeakCenter = 0.7 * nPixels
+
+        phase = np.arange(nFrames) * nCycles / nFrames % 1
+        self.actuatorVoltage = maxVoltage * (1 - np.abs(2*phase - 1))
+        self.displacement = amplitude * (self.actuatorVoltage / maxVoltage)**2
+
+    def toDict(self):
+        return {'frames': self.nFrames,
+                'pixels': self.nPixels,
+                'peakWidth': self.peakWidth,
+                'cycles': self.nCycles,
+                'noise': self.noise,
+                'amplitude': self.amplitude,
+                'seed': self.seed}
+
+    def peak(self,x,center):
+        return self.peakHeight * np.exp(-0.5*((x - center)/self.peakWidth)**2)
+
+    def profiles(self):
+        """
+        Returns the (n_frames x n_pixels) integer matrix of intensity profiles.
+        """
+        random = np.random.RandomState(self.seed)
+        x = np.arange(self.nPixels)
+        reference = self.baseline + self.peak(x,self.referencePeakCenter)
+        profiles = reference + self.peak(x[np.newaxis,:],self.movingPeakCenter + self.displacement[:,np.newaxis])
+        profiles += random.normal(0,self.noise,profiles.shape)
+        return np.round(profiles).astype(int)
+
+    def estimatorValues(self,center):
+        """
+        Returns the estimator values of a fit function for the peak at the target center,
+        as they would be selected in the gui.
+        """
+        margin = 4*self.peakWidth
+        top = self.baseline + self.peakHeight
+        return {'peakCoordinates': (center,top),
+                'lowerValleyCoordinates': (center - 2*self.peakWidth,self.baseline),
+                'upperValleyCoordinates': (center + 2*self.peakWidth,self.baseline),
+                'minBound': (center - margin,self.baseline),
+                'maxBound': (center + margin + self.amplitude,self.baseline),
+                'splineMinBound': (center - margin,self.baseline),
+                'splineMaxBound': (center + margin + self.amplitude,self.baseline)}
+
+    def write(self,path):
+        """
+        Writes the measurement to the target path as a data.csv file.
+        """
+        start = datetime.datetime(2014,1,1,12,0,0)
+        interval = datetime.timedelta(milliseconds=10)
+        with open(path,'w') as f:
+            f.write("Timestamp\tRelative time (s)\tActuator Voltage (V)\tIntensity Profile\n")
+            for i,profile in enumerate(self.profiles()):
+                timestamp = (start + i*interval).strftime("%m/%d/%Y %H:%M:%S.%f")[:-3]
+                f.write("%s\t%.3f\t%.4f\t<%s>\n" % (timestamp,i*0.01,self.actuatorVoltage[i],";".join(map(str,profile))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a synthetic data.csv file.")
+    parser.add_argument('datafile',type=str)
+    parser.add_argument('--frames',type=int,default=2000)
+    parser.add_argument('--pixels',type=int,default=200)
+    parser.add_argument('--width',type=float,default=6.,help="standard deviation of the peaks in pixels")
+    parser.add_argument('--cycles',type=int,default=4)
+    parser.add_argument('--noise',type=float,default=2.,help="standard deviation of the noise")
+    parser.add_argument('--amplitude',type=float,default=10.,help="maximum displacement in pixels")
+    args = parser.parse_args()
+
+    SyntheticMeasurement(args.frames,args.pixels,args.width,args.cycles,args.noise,args.amplitude).write(args.datafile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Binary columnar storage of ODM analysis results.
+
+The results that are written to 'odmanalysis.csv' can also be stored in a directory
+'odmanalysis.odmresults', with one .npy file per column:
+
+    - timestamp.npy: the index, as datetime64[ns]
+    - <column>.npy: the values of every other column. Text columns, like
+      'direction', are stored as int8 category codes.
+    - columns.json: the names and order of the columns and the categories of the
+      text columns
+
+Rows can be appended, also while other processes read the results, and single
+columns can be read (or memory-mapped) without touching the others.
+"""
+
+import os as _os
+import json as _json
+import shutil as _shutil
+import numpy as _np
+import pandas as _pd
+from RawDataCache import NpyAppender as _NpyAppender
+
+RESULTS_EXTENSION = '.odmresults'
+
+_INDEX_NAME = 'timestamp'
+
+
+def getBinaryResultsPath(resultsFilePath):
+    """
+    Returns the path of the binary results next to the target csv results file.
+    """
+    return _os.path.splitext(_os.path.abspath(resultsFilePath))[0] + RESULTS_EXTENSION
+
+
+def isBinaryResults(path):
+    return _os.path.isfile(_os.path.join(path,'columns.json'))
+
+
+def findBinaryResults(resultsFilePath):
+    """
+    Returns the path of the binary results for the target results file, or None.
+
+    The target path itself is returned if it is binary results. For a csv file, the
+    binary results next to it are returned if they were written to at least as
+    recently as the csv file (within a second), or if the csv file does not exist.
+    """
+    if isBinaryResults(resultsFilePath):
+        return resultsFilePath
+
+    binaryPath = getBinaryResultsPath(resultsFilePath)
+    if not isBinaryResults(binaryPath):
+        return None
+    if not _os.path.isfile(resultsFilePath):
+        return binaryPath
+    if _os.path.getmtime(_os.path.join(binaryPath,_INDEX_NAME + '.npy')) >= _os.path.getmtime(resultsFilePath) - 1:
+        return binaryPath
+    return None
+
+
+class AnalysisResultsWriter(object):
+    """
+    Writes analysis results to a binary results directory, dataframe by dataframe.
+    """
+
+    def __init__(self,path,append=False):
+        """
+        Parameters
+        ----------
+
+        path : string
+            Path to the results directory, usually ending in '.odmresults'.
+        append : boolean
+            If True and the directory holds results, the rows are appended to them.
+            Otherwise existing results are replaced.
+        """
+        self.path = path
+        self.columns = None
+        self.categories = {}
+        self.appenders = {}
+
+        if append and isBinaryResults(path):
+            with open(_os.path.join(path,'columns.json'),'r') as f:
+                description = _json.load(f)
+            self.columns = description['columns']
+            self.categories = description['categories']
+            self.appenders = {name: _NpyAppender(self._columnPath(name),append=True) for name in [_INDEX_NAME] + self.columns}
+            #discard the rows of an interrupted write, that were not written for every column
+            nRows = min(appender.nRows for appender in self.appenders.values())
+            for appender in self.appenders.values():
+                if appender.nRows > nRows:
+                    appender.truncate(nRows)
+                    appender.flush()
+        else:
+            if _os.path.exists(path):
+                _shutil.rmtree(path)
+            _os.makedirs(path)
+
+    def _columnPath(self,name):
+        return _os.path.join(self.path,name + '.npy')
+
+    def _start(self,df):
+        self.columns = [str(name) for name in df.columns]
+        for name in self.columns:
+            column = df[name]
+            if column.dtype.name == 'category':
+                self.categories[name] = [str(c) for c in column.cat.categories]
+            elif column.dtype == object:
+                if not all(isinstance(value,basestring) for value in column):
+                    raise TypeError("column '%s' holds values other than text, which cannot be stored" % name)
+                self.categories[name] = sorted(set(str(value) for value in column))
+        self.appenders = {name: _NpyAppender(self._columnPath(name)) for name in [_INDEX_NAME] + self.columns}
+
+        with open(_os.path.join(self.path,'columns.json'),'w') as f:
+            _json.dump({'columns': self.columns,'categories': self.categories},f)
+
+    def _codes(self,name,column):
+        categories = self.categories[name]
+        values = _np.asarray(column.astype(str))
+        newCategories = sorted(set(values) - set(categories))
+        if newCategories:
+            categories.extend(newCategories)
+            with open(_os.path.join(self.path,'columns.json'),'w') as f:
+                _json.dump({'columns': self.columns,'categories': self.categories},f)
+        return _pd.Categorical(values,categories=categories).codes.astype(_np.int8)
+
+    def append(self,df):
+        """
+        Appends the rows of the target dataframe, which must have a timestamp index and
+        the same columns as the dataframes that were appended before.
+        """
+        if self.columns is None:
+            self._start(df)
+        elif [str(name) for name in df.columns] != self.columns:
+            raise ValueError("the columns %s differ from the columns %s of the results" % (list(df.columns),self.columns))
+
+        for name in self.columns:
+            column = df[name]
+            values = self._codes(name,column) if name in self.categories else column.values
+            self.appenders[name].append(values)
+        self.appenders[_INDEX_NAME].append(_np.asarray(df.index.values,dtype='datetime64[ns]'))
+
+        for appender in self.appenders.values():
+            appender.flush()
+
+    def close(self):
+        for appender in self.appenders.values():
+            appender.close()
+        self.appenders = {}
+
+
+def writeAnalysisResults(df,path):
+    """
+    Writes the target analysis dataframe to a binary results directory.
+    """
+    writer = AnalysisResultsWriter(path)
+    writer.append(df)
+    writer.close()
+
+
+def readAnalysisResults(path,columns=None,mmap=False):
+    """
+    Reads binary analysis results.
+
+    Parameters
+    ----------
+
+    path : string
+        Path to the results directory.
+    columns : list of strings or None
+        The columns to read. All columns by default.
+    mmap : boolean
+        If True, the numeric columns are memory-mapped instead of read into memory.
+
+    Returns
+    -------
+
+    A dataframe with a 'timestamp' index, like the one that is read from the csv results.
+    """
+    with open(_os.path.join(path,'columns.json'),'r') as f:
+        description = _json.load(f)
+    if columns is None:
+        columns = description['columns']
+    else:
+        missing = [name for name in columns if name not in description['columns']]
+        if missing:
+            raise KeyError("no columns %s in %s" % (missing,path))
+
+    mmapMode = 'r' if mmap else None
+    index = _np.load(_os.path.join(path,_INDEX_NAME + '.npy'),mmap_mode=mmapMode)
+    arrays = [_np.load(_os.path.join(path,name + '.npy'),mmap_mode=mmapMode) for name in columns]
+    nRows = min([len(index)] + [len(values) for values in arrays])
+
+    data = {}
+    for name,values in zip(columns,arrays):
+        if name in description['categories']:
+            data[name] = _pd.Categorical.from_codes(_np.asarray(values[:nRows]),description['categories'][name])
+        else:
+            data[name] = values[:nRows]
+
+    return _pd.DataFrame(data,index=_pd.DatetimeIndex(_np.asarray(index[:nRows]),name=_INDEX_NAME),columns=columns)
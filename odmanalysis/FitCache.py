@@ -0,0 +1,206 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Content-addressed cache of curve fit results.
+
+The fit results of a block of intensity profiles only depend on the profiles, the fit
+settings, the initial parameters and the fitting options. A FitResultCache stores the
+FitResultStore of every fitted block in a directory under a key that is a hash of
+all of these (see getFitCacheKey), so that fitting the same block with the same
+settings again returns the stored results instead.
+
+Every entry is a subdirectory with the .npy files of a FitResultStore. When the
+total size of the entries exceeds the maximum size of the cache, the least recently
+used entries are removed.
+"""
+
+import os as _os
+import json as _json
+import shutil as _shutil
+import hashlib as _hashlib
+import threading as _threading
+import numpy as _np
+from FitResults import FitResultStore
+
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 1024**3
+
+
+def _jsonDefault(value):
+    if isinstance(value,_np.ndarray):
+        return value.tolist()
+    if isinstance(value,_np.generic):
+        return value.item()
+    if callable(value):
+        return getattr(value,'__name__',type(value).__name__)
+    return repr(value)
+
+def _updateWithArray(md,a):
+    a = _np.ascontiguousarray(a)
+    md.update("%s%s" % (a.dtype.str,a.shape))
+    md.update(a.data)
+
+
+def getFitCacheKey(peakFitSettings,xdata,profiles,p0,templateProfile=None,**options):
+    """
+    Returns the cache key of a fit of a block of intensity profiles.
+
+    Parameters
+    ----------
+
+    peakFitSettings : ODAFitSettings instance
+        The fit settings. The fit function name, the bounds and the estimator values
+        of ODAFitSettings.toDict() are part of the key.
+    xdata : 1D numpy.ndarray
+        The pixel coordinates of the fit window.
+    profiles : (n_frames x n_pixels) numpy.ndarray
+        The profiles in the fit window.
+    p0 : sequence of floats
+        The initial parameters of the fit of the first profile.
+    templateProfile : 1D numpy.ndarray or None
+        The profile that the fit function was initialized with, for fit functions
+        that are based on a template profile.
+    options :
+        Any other arguments that change the fit results, like the solver and the
+        curve_fit keyword arguments. Functions are identified by their name, numpy
+        arrays by their contents.
+
+    Returns
+    -------
+
+    A hexadecimal string.
+    """
+    md = _hashlib.sha1()
+    arrays = {name: value for name,value in options.items() if isinstance(value,_np.ndarray)}
+    description = {'version': CACHE_VERSION,
+                   'settings': peakFitSettings.toDict(),
+                   'p0': [float(p) for p in p0],
+                   'options': {name: value for name,value in options.items() if name not in arrays}}
+    if arrays:
+        description['arrays'] = sorted(arrays)
+    md.update(_json.dumps(description,sort_keys=True,default=_jsonDefault))
+    _updateWithArray(md,xdata)
+    _updateWithArray(md,profiles)
+    if templateProfile is not None:
+        _updateWithArray(md,templateProfile)
+    for name in sorted(arrays):
+        _updateWithArray(md,arrays[name])
+    return md.hexdigest()
+
+
+class FitResultCache(object):
+    """
+    A directory of fit results by cache key, with least recently used eviction.
+    """
+
+    def __init__(self,path,maxBytes=DEFAULT_MAX_BYTES):
+        """
+        Parameters
+        ----------
+
+        path : string
+            The cache directory. It is created if it does not exist.
+        maxBytes : integer
+            The maximum total size of the cached fit results.
+        """
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        if not _os.path.isdir(path):
+            _os.makedirs(path)
+
+    def _entryPath(self,key):
+        return _os.path.join(self.path,key)
+
+    def __contains__(self,key):
+        return _os.path.isfile(_os.path.join(self._entryPath(key),'status.npy'))
+
+    def get(self,key):
+        """
+        Returns the FitResultStore under the target key, without index, or None.
+        """
+        entryPath = self._entryPath(key)
+        try:
+            store = FitResultStore.load(entryPath)
+            #the modification time of the entry is its last use
+            _os.utime(entryPath,None)
+        except (IOError,OSError,ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return store
+
+    def put(self,key,store):
+        """
+        Stores the target FitResultStore under the target key and evicts the least
+        recently used entries if the cache has grown too large.
+        """
+        entryPath = self._entryPath(key)
+        if key in self:
+            return
+        #written next to the entry and renamed, so that readers never see a partial entry
+        tempPath = "%s.%i-%i.tmp" % (entryPath,_os.getpid(),_threading.current_thread().ident)
+        FitResultStore(store.popt,store.pcov,store.chiSquare,store.status).save(tempPath)
+        try:
+            _os.rename(tempPath,entryPath)
+        except OSError:
+            #stored by another process in the meantime
+            _shutil.rmtree(tempPath,ignore_errors=True)
+        self.evict()
+
+    def _entries(self):
+        """
+        Returns a list of (last use, size, path) tuples of the entries.
+        """
+        entries = []
+        for name in _os.listdir(self.path):
+            entryPath = _os.path.join(self.path,name)
+            if name.endswith('.tmp') or not _os.path.isdir(entryPath):
+                continue
+            try:
+                size = sum(_os.path.getsize(_os.path.join(entryPath,f)) for f in _os.listdir(entryPath))
+                entries.append((_os.path.getmtime(entryPath),size,entryPath))
+            except OSError:
+                #evicted by another process
+                pass
+        return entries
+
+    @property
+    def size(self):
+        """
+        The total size of the cached fit results in bytes.
+        """
+        return sum(size for lastUse,size,entryPath in self._entries())
+
+    def evict(self,maxBytes=None):
+        """
+        Removes the least recently used entries until the cache is at most maxBytes
+        (by default the maximum size of the cache) large.
+        """
+        if maxBytes is None:
+            maxBytes = self.maxBytes
+        entries = sorted(self._entries())
+        total = sum(size for lastUse,size,entryPath in entries)
+        for lastUse,size,entryPath in entries:
+            if total <= maxBytes:
+                break
+            _shutil.rmtree(entryPath,ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        self.evict(0)
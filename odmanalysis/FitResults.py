@@ -0,0 +1,463 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Dense array storage of curve fit results.
+
+The fit results of all frames of a peak are kept in a few arrays instead of one
+object per frame:
+
+    - popt: (n_frames x n_parameters) optimal parameters
+    - pcov: (n_frames x n_parameters x n_parameters) covariance matrices
+    - chiSquare: (n_frames,) chi-square statistics
+    - status: (n_frames,) int8 status codes (see the STATUS_* constants)
+
+On disk the fit results of a measurement are a directory 'fitResults.odmfits',
+with a subdirectory of .npy files per peak ('mp' for the moving peak and 'ref' for
+the reference peak), which can be memory-mapped when they are read. Frames can be
+appended to them with a FitResultsWriter, e.g. to checkpoint a long fit.
+"""
+
+import os as _os
+import shutil as _shutil
+import numpy as _np
+import pandas as _pd
+from RawDataCache import NpyAppender as _NpyAppender
+
+FIT_RESULTS_EXTENSION = '.odmfits'
+
+#status codes
+STATUS_NOT_FITTED = -1
+STATUS_OK = 0
+STATUS_NO_COVARIANCE = 1
+#set by the warm start checks of calculatePeakDisplacements (see the WarmStart module)
+STATUS_RECOVERED = 2
+STATUS_IMPLAUSIBLE = 3
+STATUS_FAILED = 4
+
+#the frames of which the fit result can be used as initial parameters
+USABLE_STATUSES = (STATUS_OK,STATUS_NO_COVARIANCE,STATUS_RECOVERED)
+
+_INDEX_NAME = 'timestamp'
+_arrayNames = ['popt','pcov','chiSquare','status']
+
+
+def _statusFromCovariance(pcov):
+    """
+    Returns STATUS_NO_COVARIANCE for the frames of which the covariance matrix is not
+    finite, STATUS_OK for the others.
+    """
+    finite = _np.isfinite(pcov).reshape((len(pcov),-1)).all(axis=1)
+    return _np.where(finite,STATUS_OK,STATUS_NO_COVARIANCE).astype(_np.int8)
+
+
+class CurveFitResult(object):
+    """
+    The fit result of a single frame, as a view on a FitResultStore. The values are
+    only read from the store when they are accessed.
+    """
+
+    __slots__ = ('store','frameIndex')
+
+    def __init__(self,store,frameIndex):
+        self.store = store
+        self.frameIndex = frameIndex
+
+    def __getstate__(self):
+        return (self.store,self.frameIndex)
+
+    def __setstate__(self,state):
+        self.store,self.frameIndex = state
+
+    @property
+    def popt(self):
+        return self.store.popt[self.frameIndex]
+
+    @property
+    def pcov(self):
+        return self.store.pcov[self.frameIndex]
+
+    @property
+    def chiSquare(self):
+        return self.store.chiSquare[self.frameIndex]
+
+    @property
+    def status(self):
+        return self.store.status[self.frameIndex]
+
+    def __repr__(self):
+        return "CurveFitResult(popt=%s, chiSquare=%s, status=%i)" % (list(self.popt),self.chiSquare,self.status)
+
+
+class FitResultStore(object):
+    """
+    Curve fit results of a sequence of frames, stored as dense arrays.
+
+    Indexing a store with a frame number returns a CurveFitResult view of that
+    frame. Negative frame numbers count from the end, like for lists.
+    """
+
+    def __init__(self,popt,pcov,chiSquare,status=None,index=None):
+        """
+        Parameters
+        ----------
+
+        popt : (n_frames x n_parameters) array
+        pcov : (n_frames x n_parameters x n_parameters) array
+        chiSquare : (n_frames,) array
+        status : (n_frames,) array of status codes
+            Derived from pcov if None: STATUS_NO_COVARIANCE where it is not finite,
+            STATUS_OK elsewhere.
+        index : pandas.DatetimeIndex or None
+            The timestamps of the frames.
+        """
+        self.popt = popt
+        self.pcov = pcov
+        self.chiSquare = chiSquare
+        if status is None:
+            status = _statusFromCovariance(pcov)
+        self.status = status
+        self.index = index
+
+    @classmethod
+    def empty(cls,nFrames,nParameters,index=None):
+        """
+        Returns a store for nFrames frames, with NaN values and STATUS_NOT_FITTED for
+        every frame, that can be filled with setResult.
+        """
+        return cls(_np.full((nFrames,nParameters),_np.nan),
+                   _np.full((nFrames,nParameters,nParameters),_np.nan),
+                   _np.full(nFrames,_np.nan),
+                   _np.full(nFrames,STATUS_NOT_FITTED,dtype=_np.int8),
+                   index)
+
+    @classmethod
+    def fromResults(cls,results,index=None):
+        """
+        Creates a store from a sequence of (popt,pcov,chiSquare) or
+        (popt,pcov,chiSquare,status) tuples. The status of the frames without a
+        status (or a status of None) is derived from the covariance matrix.
+        """
+        nParameters = len(results[0][0]) if len(results) else 0
+        store = cls.empty(len(results),nParameters,index)
+        popt,pcov,chiSquare = store.popt,store.pcov,store.chiSquare
+        for i,result in enumerate(results):
+            popt[i],pcov[i],chiSquare[i] = result[:3]
+        store.status[:] = _statusFromCovariance(pcov)
+        for i,result in enumerate(results):
+            if len(result) > 3 and result[3] is not None:
+                store.status[i] = result[3]
+        return store
+
+    @classmethod
+    def fromCurveFitResults(cls,curveFitResults):
+        """
+        Creates a store from a pandas.Series of objects with popt, pcov and chiSquare
+        attributes, like the 'curveFitResult_mp' column of a pickled fitResults.pcl
+        dataframe.
+        """
+        index = _pd.DatetimeIndex(curveFitResults.index,name=_INDEX_NAME)
+        views = curveFitResults.values
+        if len(views) and all(isinstance(r,CurveFitResult) for r in views):
+            #views of all frames of a single store, in order, share its arrays
+            store = views[0].store
+            if len(store) == len(views) and all(r.store is store and r.frameIndex == i for i,r in enumerate(views)):
+                return cls(store.popt,store.pcov,store.chiSquare,store.status,index)
+
+        results = [(r.popt,r.pcov,r.chiSquare) for r in views]
+        return cls.fromResults(results,index=index)
+
+    @classmethod
+    def concatenate(cls,stores):
+        """
+        Returns a store with the frames of all target stores, in order.
+        """
+        indexes = [store.index for store in stores]
+        index = indexes[0].append(indexes[1:]) if all(i is not None for i in indexes) else None
+        return cls(*[_np.concatenate([getattr(store,name) for store in stores]) for name in _arrayNames],index=index)
+
+    def slice(self,start,stop):
+        """
+        Returns a store with the frames start to stop, that shares the arrays of this store.
+        """
+        index = self.index[start:stop] if self.index is not None else None
+        return FitResultStore(*[getattr(self,name)[start:stop] for name in _arrayNames],index=index)
+
+    def lastUsableResult(self):
+        """
+        Returns the CurveFitResult of the last frame with one of the USABLE_STATUSES,
+        or None.
+        """
+        usable = _np.flatnonzero(_np.in1d(self.status,USABLE_STATUSES))
+        return self[usable[-1]] if len(usable) else None
+
+    @property
+    def nParameters(self):
+        return self.popt.shape[1]
+
+    def setResult(self,frameIndex,popt,pcov,chiSquare,status=None):
+        """
+        Stores the fit result of a single frame.
+        """
+        self.popt[frameIndex] = popt
+        self.pcov[frameIndex] = pcov
+        self.chiSquare[frameIndex] = chiSquare
+        if status is None:
+            status = STATUS_OK if _np.isfinite(pcov).all() else STATUS_NO_COVARIANCE
+        self.status[frameIndex] = status
+
+    def __len__(self):
+        return len(self.popt)
+
+    def __getitem__(self,frameIndex):
+        n = len(self)
+        if frameIndex < 0:
+            frameIndex += n
+        if not 0 <= frameIndex < n:
+            raise IndexError("frame index out of range")
+        return CurveFitResult(self,frameIndex)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield CurveFitResult(self,i)
+
+    def toSeries(self):
+        """
+        Returns a pandas.Series with a CurveFitResult view for every frame.
+        """
+        return _pd.Series(list(self),index=self.index)
+
+    def save(self,path):
+        """
+        Writes the store to the target directory, replacing its contents.
+        """
+        if _os.path.exists(path):
+            _shutil.rmtree(path)
+        _os.makedirs(path)
+        for name in _arrayNames:
+            _np.save(_os.path.join(path,name + '.npy'),getattr(self,name))
+        if self.index is not None:
+            _np.save(_os.path.join(path,_INDEX_NAME + '.npy'),_np.asarray(self.index.values,dtype='datetime64[ns]'))
+
+    @classmethod
+    def load(cls,path,mmap=False):
+        """
+        Reads a store that was written with save. If mmap is True, the arrays are
+        memory-mapped instead of read into memory.
+        """
+        mmapMode = 'r' if mmap else None
+        arrays = [_np.load(_os.path.join(path,name + '.npy'),mmap_mode=mmapMode) for name in _arrayNames]
+        indexPath = _os.path.join(path,_INDEX_NAME + '.npy')
+        index = _pd.DatetimeIndex(_np.load(indexPath),name=_INDEX_NAME) if _os.path.isfile(indexPath) else None
+        return cls(*arrays,index=index)
+
+
+def getFitResultsPath(commonPath):
+    """
+    Returns the path of the fit results of the measurement in the target directory.
+    """
+    return _os.path.join(commonPath,'fitResults' + FIT_RESULTS_EXTENSION)
+
+
+class FitResultsWriter(object):
+    """
+    Writes the fit results of a measurement to a fit results directory, block of
+    frames by block of frames.
+    """
+
+    def __init__(self,path,append=False):
+        """
+        Parameters
+        ----------
+
+        path : string
+            Path to the fit results directory, usually 'fitResults.odmfits'.
+        append : boolean
+            If True and the directory holds fit results, the frames are appended to
+            them. Otherwise existing fit results are replaced.
+        """
+        self.path = path
+        self.appenders = {}
+
+        if append and _os.path.isdir(path):
+            for peakName in sorted(_os.listdir(path)):
+                if _os.path.isfile(_os.path.join(path,peakName,'popt.npy')):
+                    self._openPeak(peakName)
+            #discard the frames of an interrupted write, that were not written for every array
+            self.truncate(self.nFrames)
+        else:
+            if _os.path.exists(path):
+                _shutil.rmtree(path)
+            _os.makedirs(path)
+
+    def _openPeak(self,peakName):
+        peakPath = _os.path.join(self.path,peakName)
+        names = _arrayNames + ([_INDEX_NAME] if _os.path.isfile(_os.path.join(peakPath,_INDEX_NAME + '.npy')) else [])
+        appenders = {}
+        try:
+            for name in names:
+                appenders[name] = _NpyAppender(_os.path.join(peakPath,name + '.npy'),append=True)
+            self.appenders[peakName] = appenders
+        except ValueError:
+            #written with FitResultStore.save, which leaves no room to grow the header
+            for appender in appenders.values():
+                appender.stream.close()
+            store = FitResultStore.load(peakPath)
+            self.appenders[peakName] = self._createPeak(peakName,store.index is not None)
+            self._appendStore(peakName,store)
+
+    def _createPeak(self,peakName,withIndex):
+        peakPath = _os.path.join(self.path,peakName)
+        if _os.path.exists(peakPath):
+            _shutil.rmtree(peakPath)
+        _os.makedirs(peakPath)
+        names = _arrayNames + ([_INDEX_NAME] if withIndex else [])
+        return {name: _NpyAppender(_os.path.join(peakPath,name + '.npy')) for name in names}
+
+    def _appendStore(self,peakName,store):
+        appenders = self.appenders[peakName]
+        for name in _arrayNames:
+            appenders[name].append(getattr(store,name))
+        if _INDEX_NAME in appenders:
+            appenders[_INDEX_NAME].append(_np.asarray(store.index.values,dtype='datetime64[ns]'))
+
+    @property
+    def nFrames(self):
+        """
+        The number of frames that have been written for every peak.
+        """
+        return min([appender.nRows for appenders in self.appenders.values() for appender in appenders.values()] or [0])
+
+    def append(self,stores):
+        """
+        Appends the frames of the target fit result stores.
+
+        Parameters
+        ----------
+
+        stores : dictionary
+            FitResultStore instances by peak name, e.g. {'mp': ..., 'ref': ...}, all
+            with the same number of frames.
+        """
+        newPeakNames = [peakName for peakName in stores if peakName not in self.appenders]
+        if newPeakNames and self.nFrames > 0:
+            raise ValueError("fit results of peaks %s cannot be added to existing fit results" % newPeakNames)
+        for peakName in newPeakNames:
+            self.appenders[peakName] = self._createPeak(peakName,stores[peakName].index is not None)
+
+        for peakName,store in stores.items():
+            self._appendStore(peakName,store)
+
+        for appenders in self.appenders.values():
+            for appender in appenders.values():
+                appender.flush()
+
+    def truncate(self,nFrames):
+        """
+        Discards the frames after the first nFrames frames.
+        """
+        for appenders in self.appenders.values():
+            for appender in appenders.values():
+                if appender.nRows > nFrames:
+                    appender.truncate(nFrames)
+                appender.flush()
+
+    def close(self):
+        for appenders in self.appenders.values():
+            for appender in appenders.values():
+                appender.close()
+        self.appenders = {}
+
+
+def countResumableFrames(stores,index):
+    """
+    Returns the number of leading frames of a measurement of which every target store
+    holds the fit result, e.g. to resume an interrupted fit.
+
+    Parameters
+    ----------
+
+    stores : dictionary
+        FitResultStore instances by peak name, as returned by readFitResults.
+    index : pandas.DatetimeIndex
+        The timestamps of the frames of the measurement.
+
+    Frames count as fitted up to the first frame that has a different timestamp in the
+    measurement than in a store, or that has not been fitted (STATUS_NOT_FITTED).
+    """
+    nFrames = min([len(index)] + [len(store) for store in stores.values()])
+    timestamps = _np.asarray(index.values[:nFrames],dtype='datetime64[ns]')
+    for store in stores.values():
+        if store.index is None:
+            return 0
+        valid = (_np.asarray(store.index.values[:nFrames],dtype='datetime64[ns]') == timestamps[:nFrames]) & (store.status[:nFrames] != STATUS_NOT_FITTED)
+        if not valid.all():
+            nFrames = int(_np.argmin(valid))
+    return nFrames
+
+
+def lastUsableParameters(store,default=None):
+    """
+    Returns a copy of the popt of the last frame of the target FitResultStore that can
+    be used as initial parameters of the next fit (see FitResultStore.lastUsableResult),
+    or default if there is none.
+    """
+    result = store.lastUsableResult()
+    return _np.array(result.popt) if result is not None else default
+
+
+def writeFitResults(path,stores):
+    """
+    Writes the fit result stores of a measurement.
+
+    Parameters
+    ----------
+
+    path : string
+        Path to the fit results directory, usually 'fitResults.odmfits'.
+    stores : dictionary
+        FitResultStore instances by peak name, e.g. {'mp': ..., 'ref': ...}.
+    """
+    writer = FitResultsWriter(path)
+    writer.append(stores)
+    writer.close()
+
+
+def readFitResults(path,mmap=True):
+    """
+    Reads the fit result stores of a measurement.
+
+    Parameters
+    ----------
+
+    path : string
+        Path to a fit results directory, or to a legacy fitResults.pcl file, of which
+        the pickled CurveFitResult objects are converted.
+    mmap : boolean
+        If True (default), the arrays of a fit results directory are memory-mapped.
+
+    Returns
+    -------
+
+    A dictionary with a FitResultStore by peak name ('mp' and, if there is a
+    reference peak, 'ref').
+    """
+    if _os.path.isdir(path):
+        return {name: FitResultStore.load(_os.path.join(path,name),mmap)
+                for name in sorted(_os.listdir(path)) if _os.path.isfile(_os.path.join(path,name,'popt.npy'))}
+
+    df = _pd.read_pickle(path)
+    return {column[len('curveFitResult_'):]: FitResultStore.fromCurveFitResults(df[column])
+            for column in df.columns if column.startswith('curveFitResult_')}
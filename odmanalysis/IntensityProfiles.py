@@ -0,0 +1,389 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as _np
+import pandas as _pd
+
+
+class ProfileMatrix(object):
+    """
+    Dense storage for a sequence of intensity profiles of equal length.
+
+    Description
+    -----------
+
+    The profiles are stored as a single (n_frames x n_pixels) array together with
+    an index (usually the timestamps) of length n_frames. Indexing is positional,
+    like pandas.Series.iloc:
+
+        - an integer returns a single profile as a row view of the array
+        - a slice, an integer array or a boolean mask returns a new ProfileMatrix
+
+    A ProfileMatrix can be used everywhere a pandas.Series of intensity profiles
+    is read by position (len(), .iloc[i], iteration).
+
+    The profiles can be a cropped and binned part of the profiles that were measured
+    (see ProfileRegion). Column j then holds the pixels xOffset + j*binning up to
+    xOffset + (j+1)*binning of the measured profiles, and pixelCoordinates gives the
+    measured pixel coordinate of every column.
+
+    Example
+    -------
+
+    >>> profiles = ProfileMatrix.fromSeries(df.intensityProfile)
+    >>> profiles.iloc[0]
+    >>> forward = profiles[(df.direction == 'forward').values]
+    """
+
+    def __init__(self,data,index=None,xOffset=0,binning=1):
+        """
+        Parameters
+        ----------
+
+        data: 2D array-like
+            The intensity profiles, one per row. Arrays (including numpy.memmap
+            instances) are stored without copying.
+        index: pandas.Index or array-like
+            The index labels of the profiles. If None, a range index is used.
+        xOffset: integer
+            The measured pixel of the first column.
+        binning: integer
+            The number of measured pixels per column.
+        """
+        data = _np.asarray(data)
+        if data.ndim != 2:
+            raise ValueError("data must be a 2D array")
+        if index is None:
+            index = _pd.Index(_np.arange(len(data)))
+        elif not isinstance(index,_pd.Index):
+            index = _pd.Index(index)
+        if len(index) != len(data):
+            raise ValueError("index length (%i) does not match the number of profiles (%i)" % (len(index),len(data)))
+
+        self.data = data
+        self.index = index
+        self.xOffset = xOffset
+        self.binning = binning
+
+    @classmethod
+    def fromSeries(cls,intensityProfiles):
+        """
+        Creates a ProfileMatrix from a pandas.Series of 1D intensity profile arrays.
+
+        If all profiles are consecutive rows of the same underlying array (as in
+        the dataframes returned by readODMData), the ProfileMatrix is a view on
+        that array and no data is copied. Otherwise the profiles are stacked into
+        a new array.
+        """
+        rows = intensityProfiles.values
+        if len(rows) == 0:
+            return cls(_np.empty((0,0),dtype=int),intensityProfiles.index)
+
+        data = _sharedBaseView(rows)
+        if data is None:
+            data = _np.vstack(rows)
+        return cls(data,intensityProfiles.index)
+
+    @classmethod
+    def fromDataFrame(cls,df):
+        """
+        Creates a ProfileMatrix from the 'intensityProfile' column of an ODM dataframe.
+        """
+        return cls.fromSeries(df.intensityProfile)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nFrames(self):
+        return self.data.shape[0]
+
+    @property
+    def nPixels(self):
+        return self.data.shape[1]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def values(self):
+        return self.data
+
+    @property
+    def pixelCoordinates(self):
+        """
+        The measured pixel coordinate of the center of every column. Integers if the
+        profiles are not binned.
+        """
+        if self.binning == 1:
+            return self.xOffset + _np.arange(self.nPixels)
+        return self.xOffset + self.binning*_np.arange(self.nPixels) + (self.binning - 1) / 2.
+
+    @property
+    def iloc(self):
+        """
+        Positional indexer, provided for compatibility with pandas.Series.
+        """
+        return self
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self,key):
+        if isinstance(key,(int,long,_np.integer)):
+            return self.data[key]
+        if isinstance(key,_pd.Series):
+            key = key.values
+        if not isinstance(key,slice):
+            key = _np.asarray(key)
+        return ProfileMatrix(self.data[key],self.index[key],self.xOffset,self.binning)
+
+    def __repr__(self):
+        return "<ProfileMatrix: %i frames x %i pixels, %s>" % (self.nFrames,self.nPixels,self.dtype)
+
+    def crop(self,xmin,xmax):
+        """
+        Returns a ProfileMatrix view with only the columns xmin:xmax of every profile.
+        """
+        return ProfileMatrix(self.data[:,xmin:xmax],self.index,self.xOffset + xmin*self.binning,self.binning)
+
+    def window(self,xmin,xmax):
+        """
+        Returns the columns of which the measured pixel coordinate is within
+        [xmin,xmax), like the fit window of an ODAFitSettings instance.
+
+        Returns
+        -------
+
+        xdata: 1D array
+            The measured pixel coordinates of the columns.
+        profiles: ProfileMatrix
+            A view with only those columns.
+        """
+        coordinates = self.pixelCoordinates
+        start,stop = _np.searchsorted(coordinates,[xmin,xmax])
+        return coordinates[start:stop],self.crop(start,stop)
+
+    def fullWidthProfile(self,i):
+        """
+        Returns profile i in measured pixel coordinates, as an array with one value for
+        every measured pixel up to the last column. The pixels outside of the columns
+        and in between the column centers are interpolated, so that the result can be
+        used as a template profile, like the reference profile of a spline fit
+        function.
+        """
+        if self.xOffset == 0 and self.binning == 1:
+            return self.data[i]
+        return _np.interp(_np.arange(self.xOffset + self.nPixels*self.binning),self.pixelCoordinates,self.data[i])
+
+    def toSeries(self,name='intensityProfile'):
+        """
+        Returns a pandas.Series with a row view of the profile array in every cell.
+        """
+        column = _np.empty(len(self),dtype=object)
+        for i,row in enumerate(self.data):
+            column[i] = row
+        return _pd.Series(column,index=self.index,name=name)
+
+
+class ProfileRegion(object):
+    """
+    The pixels of the intensity profiles that are kept when they are read: the
+    pixels xmin:xmax, optionally binned by averaging every 'binning' pixels. A last
+    bin with fewer pixels is left out.
+    """
+
+    def __init__(self,xmin=0,xmax=None,binning=1):
+        if binning < 1:
+            raise ValueError("binning must be at least 1")
+        self.xmin = xmin
+        self.xmax = xmax
+        self.binning = binning
+
+    @classmethod
+    def fromFitSettings(cls,fitSettings,binning=1):
+        """
+        Returns the smallest region that holds the fit windows of all target
+        ODAFitSettings instances. None values in fitSettings are ignored. The region is
+        extended to a whole number of bins.
+        """
+        fitSettings = [settings for settings in fitSettings if settings is not None]
+        xmin = max(0,min(settings.xminBound for settings in fitSettings))
+        xmax = max(settings.xmaxBound for settings in fitSettings)
+        xmax = xmin + -(-(xmax - xmin) // binning) * binning
+        return cls(xmin,xmax,binning)
+
+    def __repr__(self):
+        return "ProfileRegion(xmin=%s, xmax=%s, binning=%i)" % (self.xmin,self.xmax,self.binning)
+
+    def apply(self,profiles,copy=True):
+        """
+        Returns the region of the target profile or (n_profiles x n_pixels) array of
+        profiles. If copy is False and the profiles are not binned, a view is returned.
+        """
+        cropped = _np.asarray(profiles)[...,self.xmin:self.xmax]
+        if self.binning == 1:
+            return cropped.copy() if copy else cropped
+        nBins = cropped.shape[-1] // self.binning
+        binned = cropped[...,:nBins*self.binning].reshape(cropped.shape[:-1] + (nBins,self.binning))
+        return binned.mean(axis=-1)
+
+    def applyToMatrix(self,profileMatrix,copy=True):
+        """
+        Returns a ProfileMatrix with the region of the target ProfileMatrix of
+        measured (not cropped or binned) profiles.
+        """
+        return ProfileMatrix(self.apply(profileMatrix.data,copy),profileMatrix.index,self.xmin,self.binning)
+
+
+def _sharedBaseView(rows):
+    """
+    Returns a 2D view on the common base array of the target sequence of 1D arrays,
+    or None if the arrays are not consecutive rows of the same contiguous array.
+    """
+    first = rows[0]
+    base = first.base if isinstance(first,_np.ndarray) else None
+    if base is None or not isinstance(base,_np.ndarray) or not base.flags.c_contiguous:
+        return None
+    if not all(isinstance(r,_np.ndarray) and r.base is base and r.shape == first.shape and r.strides == first.strides for r in rows):
+        return None
+    if base.dtype != first.dtype or first.ndim != 1 or not first.flags.c_contiguous:
+        return None
+
+    itemsize = first.itemsize
+    nPixels = len(first)
+    basePointer = base.__array_interface__['data'][0]
+    offsets = _np.array([r.__array_interface__['data'][0] for r in rows]) - basePointer
+    expected = offsets[0] + _np.arange(len(rows)) * nPixels * itemsize
+    if offsets[0] % itemsize != 0 or not _np.array_equal(offsets,expected):
+        return None
+
+    start = offsets[0] // itemsize
+    flat = base.reshape(-1)
+    return flat[start:start + len(rows) * nPixels].reshape((len(rows),nPixels))
+
+
+class LazyODMData(object):
+    """
+    Frame-indexed view on a raw ODM measurement whose intensity profiles are not
+    loaded into memory.
+
+    Description
+    -----------
+
+    The scalar columns ('relativeTime', 'actuatorVoltage', 'direction', 'cycleNumber'
+    and any columns that are added later) are kept in an ordinary dataframe, the
+    'frame' attribute. The intensity profiles are a ProfileMatrix that is usually
+    backed by a numpy.memmap, so a profile is only read from disk when it is used.
+
+    Columns can be accessed as attributes or with [] like with a dataframe. The
+    'intensityProfile' column returns the ProfileMatrix.
+    """
+
+    def __init__(self,frame,intensityProfiles):
+        """
+        Parameters
+        ----------
+
+        frame: pandas.DataFrame
+            The scalar columns of the measurement.
+        intensityProfiles: ProfileMatrix
+            The intensity profiles, one for every row of frame.
+        """
+        if len(frame) != len(intensityProfiles):
+            raise ValueError("frame and intensityProfiles must have the same length")
+        self.frame = frame
+        self.intensityProfile = intensityProfiles
+
+    @property
+    def index(self):
+        return self.frame.index
+
+    @property
+    def columns(self):
+        return list(self.frame.columns) + ['intensityProfile']
+
+    @property
+    def iloc(self):
+        return _LazyODMDataILocIndexer(self)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getattr__(self,name):
+        if name != 'frame' and name in self.frame.columns:
+            return self.frame[name]
+        raise AttributeError("'LazyODMData' object has no attribute '%s'" % name)
+
+    def __getitem__(self,key):
+        if isinstance(key,basestring):
+            if key == 'intensityProfile':
+                return self.intensityProfile
+            return self.frame[key]
+        if isinstance(key,list):
+            if 'intensityProfile' in key:
+                raise KeyError("the intensity profiles of a LazyODMData cannot be selected as a dataframe column, use toDataFrame()")
+            return self.frame[key]
+
+        #boolean row mask
+        if isinstance(key,_pd.Series):
+            key = key.values
+        key = _np.asarray(key)
+        return LazyODMData(self.frame[key],self.intensityProfile[key])
+
+    def __setitem__(self,key,value):
+        self.frame[key] = value
+
+    def __repr__(self):
+        return "<LazyODMData: %i frames, columns %s>" % (len(self),self.columns)
+
+    def join(self,other,**kwargs):
+        """
+        Joins other to the scalar columns, see pandas.DataFrame.join.
+        """
+        frame = self.frame.join(other,**kwargs)
+        if not frame.index.equals(self.frame.index):
+            raise ValueError("a join must not change the index of a LazyODMData")
+        return LazyODMData(frame,self.intensityProfile)
+
+    def toDataFrame(self):
+        """
+        Returns an ordinary ODM dataframe, which has an 'intensityProfile' column with
+        one array per row.
+        """
+        df = self.frame.copy()
+        df['intensityProfile'] = self.intensityProfile.toSeries()
+        return df
+
+
+class _LazyODMDataILocIndexer(object):
+    def __init__(self,data):
+        self.data = data
+
+    def __getitem__(self,key):
+        if isinstance(key,(int,long,_np.integer)):
+            row = self.data.frame.iloc[key].copy()
+            row['intensityProfile'] = self.data.intensityProfile[key]
+            return row
+        if not isinstance(key,slice):
+            key = _np.asarray(key)
+        return LazyODMData(self.data.frame.iloc[key],self.data.intensityProfile[key])
@@ -27,15 +27,245 @@ from scipy.stats import chisquare as _chisquare
 import os as _os
 import ConfigParser as _ConfigParser
 from ProgressReporting import StdOutProgressReporter as _StdOutProgressReporter
+from ProgressReporting import InstrumentedStage as _InstrumentedStage
+from ProgressReporting import throttled as _throttled
+from IntensityProfiles import ProfileMatrix, ProfileRegion, LazyODMData
+import RawDataCache as _RawDataCache
+import AnalysisResults as _AnalysisResults
+import FitResults as _FitResults
+import FitCache as _FitCache
+from FitResults import FitResultStore, CurveFitResult
+from FitCache import FitResultCache
+from WarmStart import WarmStartPolicy
 import pickle as _pickle
 import copy as _copy
-import attrdict
+import inspect as _inspect
+from collections import namedtuple as _namedtuple
+import multiprocessing as _mp
+from fitfunctions.BatchFitting import batchCurveFit as _batchCurveFit
 
 
 def ipStringToArray(ipString):    
     return _np.array([int(i) for i in ipString.replace("<","").replace(">","").split(";") if i])
 
-def getActuationDirectionAndCycle(dataframe,inplace=True,startDirection='forward',startCycleNumber=1):
+def parseIntensityProfiles(ipStrings,dtype=int,region=None):
+    """
+    Parses a sequence of intensity profile strings like '<a;b;c;...>' in one go.
+    
+    All non-empty profiles are joined and tokenized by numpy in a single call,
+    which writes the values straight into one contiguous buffer that is returned
+    as a 2D array. This is much faster than calling ipStringToArray on every row.
+    
+    Parameters
+    ----------
+    
+    ipStrings : sequence of strings
+        The intensity profile strings, for example the raw 'intensityProfile'
+        column of a chunk of data.csv. Missing values are treated as empty profiles.
+    dtype : numpy dtype
+        The dtype of the output array.
+    region : ProfileRegion or None
+        If given, only the pixels of this region are kept, binned if the region is
+        binned. For a region that is narrow compared to the profiles, only the pixels
+        up to the end of the region are converted.
+    
+    Returns
+    -------
+    
+    profiles : 2D numpy.ndarray
+        Array of shape (number of non-empty profiles, number of pixels).
+    nonEmpty : 1D numpy.ndarray of bool
+        Mask that is True for every input string that holds a non-empty profile.
+    
+    Raises
+    ------
+    
+    ValueError
+        If the non-empty profiles do not all have the same length.
+    """
+    
+    stripped = _pd.Series(ipStrings).fillna("").astype(str).str.strip("<>; ")
+    nonEmpty = (stripped.str.len() > 0).values
+    stripped = stripped[nonEmpty]
+    
+    nProfiles = len(stripped)
+    if nProfiles == 0:
+        return _np.empty((0,0),dtype=dtype), nonEmpty
+    
+    nPixels = stripped.iloc[0].count(";") + 1
+    #the bulk conversion below cannot tell where the rows end, so rows of different
+    #lengths that add up to the right number of pixels would be mixed up
+    if (stripped.str.count(";") + 1 != nPixels).any():
+        raise ValueError("intensity profiles do not all have the same length")
+    if region is not None and region.xmax is not None and 2*(region.xmax - region.xmin) < nPixels:
+        #splitting off the pixels up to xmax is cheaper than converting all pixels
+        xmin,xmax = region.xmin,min(region.xmax,nPixels)
+        profileStrings = [";".join(ipString.split(";",xmax)[xmin:xmax]) for ipString in stripped.values]
+        values = _np.fromstring(";".join(profileStrings),dtype=dtype,sep=";")
+        if len(values) != nProfiles * (xmax - xmin):
+            raise ValueError("intensity profiles do not all have the same length")
+        return ProfileRegion(0,None,region.binning).apply(values.reshape((nProfiles,xmax - xmin)),copy=False), nonEmpty
+    
+    values = _np.fromstring(";".join(stripped.values),dtype=dtype,sep=";")
+    if len(values) != nProfiles * nPixels:
+        raise ValueError("intensity profiles do not all have the same length")
+    
+    profiles = values.reshape((nProfiles,nPixels))
+    if region is not None:
+        profiles = region.apply(profiles)
+    return profiles, nonEmpty
+
+def getIntensityProfileMatrix(df,region=None):
+    """
+    Returns the intensity profiles of an ODM dataframe as a ProfileMatrix.
+    
+    For dataframes returned by readODMData this does not copy any data.
+    
+    Parameters
+    ----------
+    
+    df : pandas.DataFrame
+        ODM dataframe with an 'intensityProfile' column that holds no empty profiles.
+    region : ProfileRegion or None
+        The region the profiles were read with (see readODMData), which determines
+        the pixel coordinates of the profile matrix.
+    
+    Returns
+    -------
+    
+    profiles : ProfileMatrix
+        The profiles as an (n_frames x n_pixels) matrix with the index of the dataframe.
+    """
+    
+    profiles = ProfileMatrix.fromDataFrame(df)
+    if region is not None:
+        profiles.xOffset,profiles.binning = region.xmin,region.binning
+    return profiles
+
+def _toProfileSeries(profiles,nonEmpty,index):
+    """
+    Wraps the rows of a 2D profile array into an object Series with one (view) array
+    per row. Rows that are not in the nonEmpty mask get an empty array.
+    """
+    
+    column = _np.empty(len(nonEmpty),dtype=object)
+    empty = _np.array([],dtype=profiles.dtype)
+    rows = iter(profiles)
+    for i,isNonEmpty in enumerate(nonEmpty):
+        column[i] = next(rows) if isNonEmpty else empty
+    return _pd.Series(column,index=index)
+
+def _bulkParsedChunks(reader,dropEmptyProfiles=False,region=None):
+    """
+    Generator that converts the raw 'intensityProfile' strings of every chunk of
+    the target pandas reader with parseIntensityProfiles.
+    """
+    
+    for chunk in reader:
+        try:
+            profiles,nonEmpty = parseIntensityProfiles(chunk.intensityProfile.values,region=region)
+            if dropEmptyProfiles:
+                chunk = chunk[nonEmpty].copy()
+                chunk['intensityProfile'] = ProfileMatrix(profiles,chunk.index).toSeries()
+            else:
+                chunk['intensityProfile'] = _toProfileSeries(profiles,nonEmpty,chunk.index)
+        except ValueError:
+            #fall back to row-by-row parsing for profiles of unequal length
+            chunk['intensityProfile'] = chunk.intensityProfile.fillna("").map(ipStringToArray)
+            if region is not None:
+                chunk['intensityProfile'] = chunk.intensityProfile.map(region.apply)
+            if dropEmptyProfiles:
+                chunk = chunk[chunk.intensityProfile.map(len) != 0]
+        yield chunk
+
+def _dropEmptyProfileRows(reader):
+    for chunk in reader:
+        yield chunk[chunk.intensityProfile.map(len) != 0]
+
+ACTUATION_DIRECTIONS = ['forward','backward']
+
+class ActuationState(_namedtuple('ActuationState',['actuatorVoltage','direction','cycleNumber','cycleStartDirection'])):
+    """
+    The state of the actuation direction and cycle detection at the end of a block
+    of measurement data, with which the detection can be continued on the next block.
+    
+    actuatorVoltage: float
+        The actuator voltage of the last row.
+    direction: 'forward' or 'backward'
+        The actuation direction of the last row.
+    cycleNumber: integer
+        The cycle number of the last row.
+    cycleStartDirection: 'forward' or 'backward'
+        The direction in which cycles start. A new cycle starts when the direction
+        changes to this direction.
+    """
+    __slots__ = ()
+
+def calculateActuationDirectionAndCycle(actuatorVoltage,state=None,startDirection='forward',startCycleNumber=1):
+    """
+    Determines the actuation direction and cycle number of a sequence of actuator
+    voltages.
+    
+    The direction is 'backward' where the voltage decreases and 'forward' otherwise.
+    A new cycle starts every time the direction changes back to the direction of the
+    first row.
+    
+    Parameters
+    ----------
+    
+    actuatorVoltage: 1D array-like
+        The actuator voltages.
+    state: ActuationState or None
+        The state at the end of the preceding block of data. If given, startDirection
+        and startCycleNumber are ignored and the detection is continued from the
+        state, so that a measurement can be processed in blocks.
+    startDirection: 'forward' or 'backward'
+        The direction of the first row.
+    startCycleNumber: integer
+        The cycle number of the first row.
+    
+    Returns
+    -------
+    
+    directionCodes: (n,) int8 array
+        Indices into ACTUATION_DIRECTIONS.
+    cycleNumbers: (n,) int32 array
+        The cycle numbers.
+    state: ActuationState
+        The state at the end of the data, to pass on with the next block.
+    """
+    voltage = _np.asarray(actuatorVoltage,dtype=float)
+    n = len(voltage)
+    
+    directionCodes = _np.empty(n,dtype=_np.int8)
+    _np.less(voltage[1:],voltage[:-1],out=directionCodes[1:],casting='unsafe')
+    if state is None:
+        startCode = ACTUATION_DIRECTIONS.index(startDirection)
+        previousCode = startCode
+        cycleNumber = startCycleNumber
+        if n > 0:
+            directionCodes[0] = startCode
+    else:
+        startCode = ACTUATION_DIRECTIONS.index(state.cycleStartDirection)
+        previousCode = ACTUATION_DIRECTIONS.index(state.direction)
+        cycleNumber = state.cycleNumber
+        if n > 0:
+            directionCodes[0] = voltage[0] < state.actuatorVoltage
+    
+    if n == 0:
+        return directionCodes,_np.empty(0,dtype=_np.int32),state
+    
+    #a cycle starts where the direction changes to the start direction
+    cycleStarts = (directionCodes == startCode)
+    cycleStarts[0] &= (previousCode != startCode)
+    cycleStarts[1:] &= (directionCodes[:-1] != startCode)
+    cycleNumbers = _np.cumsum(cycleStarts,dtype=_np.int32)
+    cycleNumbers += cycleNumber
+    
+    newState = ActuationState(voltage[-1],ACTUATION_DIRECTIONS[directionCodes[-1]],int(cycleNumbers[-1]),ACTUATION_DIRECTIONS[startCode])
+    return directionCodes,cycleNumbers,newState
+
+def getActuationDirectionAndCycle(dataframe,inplace=True,startDirection='forward',startCycleNumber=1,state=None):
     """
     Determines the actuation direction from the actuatorVoltage column of the
     target dataframe.
@@ -50,38 +280,50 @@ def getActuationDirectionAndCycle(dataframe,inplace=True,startDirection='forward
         Add column 'direction' and 'cycleNumber' to the target dataframe. If false,
         a new dataframe with the same index as the target dataframe and just these
         two columns is returned.
+    
+    state: ActuationState or None
+        See calculateActuationDirectionAndCycle. Use getActuationDirectionAndCycleIncremental
+        to also obtain the state at the end of the dataframe.
         
     
     Returns
     -------
     
     The target dataframe or a new dataframe depending on the 'inplace' parameter.
+    The 'direction' column is categorical with the categories 'forward' and 'backward',
+    the 'cycleNumber' column has dtype int32.
     
     
     
+    """
+    return getActuationDirectionAndCycleIncremental(dataframe,state,inplace,startDirection,startCycleNumber)[0]
+
+def getActuationDirectionAndCycleIncremental(dataframe,state=None,inplace=True,startDirection='forward',startCycleNumber=1):
+    """
+    Like getActuationDirectionAndCycle, but also returns the state at the end of the
+    dataframe, with which the next block of a measurement can be processed.
+    
+    Returns
+    -------
+    
+    A tuple of the dataframe and the new ActuationState.
     """
     if inplace == True:
         df = dataframe
     else:
         df = _pd.DataFrame(index=dataframe.index)
     
-    df['direction'] = 'forward'
-    df.direction.iloc[0] = startDirection
-    df.direction[dataframe.actuatorVoltage.diff() < 0] = 'backward'
-    
-    s = (df.direction != df.direction.shift(1))
-    baseCycleNumbers = _pd.Series(_np.arange(len(s[s==True])),index=s[s==True].index)
-    baseCycleNumbers = baseCycleNumbers //2
-    
-    df['cycleNumber'] = baseCycleNumbers + startCycleNumber
-    df.cycleNumber.fillna(method='pad',inplace=True)
-    return df
+    directionCodes,cycleNumbers,newState = calculateActuationDirectionAndCycle(dataframe.actuatorVoltage.values,state,startDirection,startCycleNumber)
+    df['direction'] = _pd.Categorical.from_codes(directionCodes,ACTUATION_DIRECTIONS)
+    df['cycleNumber'] = cycleNumbers
+    return df,newState
 
 def removeIncompleteCycles(df,inplace=True):
     if (df.cycleNumber[-1] != df.cycleNumber[-2]):
         df.drop(df.tail(1).index,inplace=inplace)
 
-def readODMData(dataFilePath,progressReporter=_StdOutProgressReporter()):
+@_InstrumentedStage('reading')
+def readODMData(dataFilePath,progressReporter=_StdOutProgressReporter(),useCache=True,lazy=False,region=None):
     """
     Reads a data.csv file that has been written by a LabVIEW ODM Measurement and returns
     it as a dataframe. It also determines the cyclenumber and direction.
@@ -89,6 +331,10 @@ def readODMData(dataFilePath,progressReporter=_StdOutProgressReporter()):
     The data is read from the source file in chunks of 2005 lines. This ensures that also extremely large
     files can be read without memory problems.
     
+    The parsed data is cached in binary form in a 'data.odmcache' directory next to the
+    data file (see the RawDataCache module). Subsequent reads of an unchanged data file
+    memory-map the cached arrays instead of parsing the text again.
+    
     Parameters
     ----------
 
@@ -96,6 +342,21 @@ def readODMData(dataFilePath,progressReporter=_StdOutProgressReporter()):
         Path string to the data.csv file that contains the raw odm data or a stream object.
     progressReporter : ODMAnalysisGui.ProgressReporter
         The ProgressReporter to use. If None (default) a StdOutProgressReporter is used.
+    useCache : boolean
+        If True (default) and dataFilePath is a path, the binary cache is used if it is
+        valid and (re)written otherwise.
+    lazy : boolean
+        If True, a LazyODMData object is returned instead of a dataframe. Its intensity
+        profiles are memory-mapped from the binary cache, which is created chunk by chunk
+        if it is not valid. This allows measurements that are larger than the available
+        memory to be analyzed. dataFilePath must be a path.
+    region : ProfileRegion or None
+        If given, only this region of every intensity profile is kept (binned if the
+        region is binned), e.g. ProfileRegion.fromFitSettings([movingPeakFitSettings,
+        referencePeakFitSettings]) for only the fit windows. Pass the same region to
+        getIntensityProfileMatrix to obtain the profiles with their pixel coordinates.
+        The profiles are cropped from the binary cache if it is valid, and while they
+        are parsed otherwise, in which case no cache is written.
 
     
     Returns
@@ -103,10 +364,60 @@ def readODMData(dataFilePath,progressReporter=_StdOutProgressReporter()):
     dataframe: pandas.DataFrame,
         A pandas dataframe with the data in data.csv. The index is set to the timestamp. The columns 
         'cycleNumber' and 'direction' have been determined from the 'actuatorVoltage' column.
+        Rows with an empty intensity profile are left out. The cells of the 'intensityProfile'
+        column are row views of a single 2D array, use getIntensityProfileMatrix to obtain it.
     """
     
+    if lazy:
+        return _readODMDataLazy(dataFilePath,progressReporter,region)
+    
+    useCache = useCache and isinstance(dataFilePath,basestring)
+    
+    cached = _RawDataCache.readRawDataCache(dataFilePath) if useCache else None
+    if cached is not None:
+        progressReporter.message('loading cached data for %s ...' % dataFilePath)
+        df,profiles = cached
+        if region is not None:
+            profiles = region.applyToMatrix(profiles)
+        df['intensityProfile'] = profiles.toSeries()
+    else:
+        df = _readODMDataFromText(dataFilePath,progressReporter,region)
+        if useCache and region is None:
+            try:
+                _RawDataCache.writeRawDataCache(df,dataFilePath)
+            except (IOError,OSError,ValueError) as e:
+                progressReporter.message('could not write cache: %s' % e)
+    
+    getActuationDirectionAndCycle(df)
+
+    progressReporter.done()
+    
+    return df
+    
+
+def _readODMDataLazy(dataFilePath,progressReporter,region=None):
+    if not isinstance(dataFilePath,basestring):
+        raise TypeError("lazy reading requires a path to the data file")
+    
+    cached = _RawDataCache.readRawDataCache(dataFilePath,mmap=True)
+    if cached is None:
+        progressReporter.message('caching data from %s ...' % dataFilePath)
+        _RawDataCache.buildRawDataCache(dataFilePath,getODMDataReader(dataFilePath,dropEmptyProfiles=True))
+        cached = _RawDataCache.readRawDataCache(dataFilePath,mmap=True)
+    
+    progressReporter.message('mapping cached data for %s ...' % dataFilePath)
+    frame,profiles = cached
+    if region is not None:
+        profiles = region.applyToMatrix(profiles,copy=False)
+    getActuationDirectionAndCycle(frame)
+    
+    progressReporter.done()
+    
+    return LazyODMData(frame,profiles)
+
+def _readODMDataFromText(dataFilePath,progressReporter,region=None):
     progressReporter.message('loading data from %s ...' % dataFilePath)
-    reader = getODMDataReader(dataFilePath)
+    reader = getODMDataReader(dataFilePath,dropEmptyProfiles=True,region=region)
         
     
     chunks=[]
@@ -116,19 +427,33 @@ def readODMData(dataFilePath,progressReporter=_StdOutProgressReporter()):
     
     df = _pd.concat(chunks)
     
-    df = df[df.intensityProfile.map(len) != 0]
-    
-    getActuationDirectionAndCycle(df)
-
-    progressReporter.done()
+    #store all profiles in a single contiguous array
+    df['intensityProfile'] = ProfileMatrix.fromDataFrame(df).toSeries()
     
     return df
+
+_TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S.%f"
+
+def _parsedTimestampChunks(reader):
+    """
+    Generator that converts the timestamp index of every chunk of the target pandas
+    reader. The timestamps are parsed much faster with the format of the LabVIEW ODM
+    measurement software than with the format inference of pandas.read_csv.
+    Timestamps in another format are inferred, and like pandas.read_csv does, left
+    unconverted if that fails.
+    """
     
+    for chunk in reader:
+        try:
+            chunk.index = _pd.to_datetime(chunk.index,format=_TIMESTAMP_FORMAT)
+        except ValueError:
+            chunk.index = _pd.to_datetime(chunk.index,errors='ignore')
+        yield chunk
 
-def getODMDataReader(dataFilePath,chunksize=2005,skipDataRows=0):
+def getODMDataReader(dataFilePath,chunksize=2005,skipDataRows=0,bulkParse=True,dropEmptyProfiles=False,header=True,region=None):
     """
     Reads a data.csv file that has been written by a LabVIEW ODM Measurement and returns
-    a pandas reader object to process the file in chunks.
+    a reader object to process the file in chunks.
     
         
     Parameters
@@ -142,43 +467,79 @@ def getODMDataReader(dataFilePath,chunksize=2005,skipDataRows=0):
         
     skipDataRows : integer
         The amount of rows to skip, excluding the header
+    
+    bulkParse : boolean
+        If True (default), the intensity profiles of each chunk are parsed at once
+        with parseIntensityProfiles. If False, every row is converted separately
+        with ipStringToArray.
+    
+    dropEmptyProfiles : boolean
+        If True, rows with an empty intensity profile are left out of the chunks.
+    
+    header : boolean
+        If False, the data has no header line, like a block of rows that has been
+        read from the middle of a data file.
+    
+    region : ProfileRegion or None
+        If given, only this region of every intensity profile is kept, see
+        parseIntensityProfiles.
         
 
     
     Returns
     -------
-    reader: pandas.csv_reader
+    reader: iterable of pandas.DataFrame
         Reader object for reading the target dataFile in chunks
         
     """
     
+    if bulkParse:
+        readerKwargs = {'dtype': {'intensityProfile': str}}
+    elif region is not None:
+        readerKwargs = {'converters': {'intensityProfile': lambda ipString: region.apply(ipStringToArray(ipString))}}
+    else:
+        readerKwargs = {'converters': {'intensityProfile': ipStringToArray}}
+    
     reader = _pd.read_csv(dataFilePath,
                         sep='\t',
                         header=None,
                         names=['timestamp','relativeTime','actuatorVoltage','intensityProfile'],
                         index_col='timestamp',
-                        parse_dates=True,
-                        skiprows=skipDataRows + 1,
+                        skiprows=skipDataRows + (1 if header else 0),
                         chunksize = chunksize,
-                        converters = {'intensityProfile': ipStringToArray})
+                        **readerKwargs)
+    reader = _parsedTimestampChunks(reader)
     
+    if bulkParse:
+        return _bulkParsedChunks(reader,dropEmptyProfiles,region)
+    elif dropEmptyProfiles:
+        return _dropEmptyProfileRows(reader)
     return reader
 
-def readAnalysisData(dataFilePath,readSettings=True,read_csv_kwargs=dict()):
+@_InstrumentedStage('reading analysis')
+def readAnalysisData(dataFilePath,readSettings=True,read_csv_kwargs=dict(),columns=None):
     """
     Reads the csv-file that was produced by the FitRawODMData script back into a DataFrame. 
     
+    If binary results (see the AnalysisResults module) are found at the target path,
+    or next to the csv file and at least as recent, they are read instead of the csv
+    file, which is much faster.
+    
     Parameters
     ----------
     
     dataFilePath : string
-        Path to the csv file, usually  odmanalysis.csv
+        Path to the csv file, usually  odmanalysis.csv, or to binary results, usually
+        odmanalysis.odmresults
     readSettings : boolean
         If true, attempts to obtain the pixel-to-nanometer ratio from the 'odmSettings.ini'
         file in the same folder as the csv file. An extra column will be added to the 
         output dataframe, called 'displacement_nm'.
     read_csv_kwargs : dictionary
-        Additional keyword arguments to pass to pd.read_csv
+        Additional keyword arguments to pass to pd.read_csv. Only used if the csv
+        file is read.
+    columns : list of strings or None
+        The columns to read. All columns by default.
     
     Returns
     -------
@@ -188,9 +549,17 @@ def readAnalysisData(dataFilePath,readSettings=True,read_csv_kwargs=dict()):
         set to 'timestamp'.
     """
 
-    df = _pd.read_csv(dataFilePath,index_col='timestamp',parse_dates=True,**read_csv_kwargs)
+    binaryResultsPath = _AnalysisResults.findBinaryResults(dataFilePath)
+    if binaryResultsPath is not None:
+        df = _AnalysisResults.readAnalysisResults(binaryResultsPath,columns)
+    else:
+        if columns is not None:
+            read_csv_kwargs = dict(read_csv_kwargs,usecols=['timestamp'] + list(columns))
+        df = _pd.read_csv(dataFilePath,index_col='timestamp',parse_dates=True,**read_csv_kwargs)
     
-    commonpath = _os.path.split(dataFilePath)[0]
+    commonpath = _os.path.split(_os.path.abspath(dataFilePath))[0]
+    if not readSettings or 'displacement' not in df.columns:
+        return df
     try:
         settings = CurveFitSettings.loadFromFile(commonpath + '/odmSettings.ini')
         df['displacement_nm'] = df.displacement * settings.pxToNm
@@ -225,26 +594,61 @@ def readCurveFitSettings(fitSettingsPcl):
     return ffDict
 
 
-def readCurveFitResults(fitResultsPcl):
+def readCurveFitResults(fitResultsPath,mmap=True):
     """
-    Reads pickled CurveFitResults from the target pickle file back into a dataframe.
+    Reads the fit results that were stored by the FitRawODMData script as a
+    dataframe, like the pickled fitResults.pcl dataframe of older versions.
     
     Parameters
     ----------
     
-    fitResultsPcl: string
-        Path to the target pickle file (usually fitResults.pcl)
+    fitResultsPath: string
+        Path to the fit results directory (usually fitResults.odmfits), or to a
+        pickle file of an older version (usually fitResults.pcl).
+    mmap: boolean
+        If True (default), the fit results are memory-mapped instead of read into
+        memory. Not used for pickle files.
         
     Returns
     -------
     
-    dataframe: pandas.DataFrame
-        A dataframe that contains the CurveFitResult objects for each analyzed intensity profile.
-        The index of the dataframe is equal to the 'timestamp' column of the corresponding 'odmanalysis.csv' file.
+    A dataframe with the index of the corresponding 'odmanalysis.csv' file and the
+    column 'curveFitResult_mp' and, if a reference peak was fitted,
+    'curveFitResult_ref', with the CurveFitResult of every analyzed intensity
+    profile. See readFitResultStores for the fit results as arrays.
     """
     
-    df = _pd.read_pickle(fitResultsPcl)
-    return df
+    stores = readFitResultStores(fitResultsPath,mmap)
+    return _pd.DataFrame({name: store.toSeries() for name,store in stores.items()})
+
+
+def readFitResultStores(fitResultsPath,mmap=True):
+    """
+    Reads the fit results that were stored by the FitRawODMData script as
+    FitResultStore instances.
+    
+    Parameters
+    ----------
+    
+    fitResultsPath: string
+        Path to the fit results directory (usually fitResults.odmfits), or to a
+        pickle file of an older version (usually fitResults.pcl).
+    mmap: boolean
+        If True (default), the fit results are memory-mapped instead of read into
+        memory. Not used for pickle files.
+        
+    Returns
+    -------
+    
+    A dictionary with a FitResultStore for every fitted peak, with the keys
+    'curveFitResult_mp' and, if a reference peak was fitted, 'curveFitResult_ref'.
+    The stores give random access to the CurveFitResult of every analyzed intensity
+    profile by frame number, and their index is equal to the 'timestamp' column of
+    the corresponding 'odmanalysis.csv' file.
+    """
+    
+    stores = _FitResults.readFitResults(fitResultsPath,mmap)
+    return {'curveFitResult_' + name: store for name,store in stores.items()}
 
 
 class CurveFitSettings(object):
@@ -268,6 +672,8 @@ class CurveFitSettings(object):
         s.pxToNm = cp.getfloat('PostProcessing','resolution')
         s.xkcd = cp.getboolean('PostProcessing','xkcd')
         s.defaultFitFunction = cp.get('Analysis','defaultFitFunction')
+        if cp.has_option('Analysis','horizontalBinning'):
+            s.hozontalBinning = cp.getint('Analysis','horizontalBinning')
         
         return s
     
@@ -294,8 +700,7 @@ class CurveFitSettings(object):
             self.configFile = _os.path.abspath(filename)
             
         cp = _ConfigParser.SafeConfigParser()
-        configFile = _os.path.abspath(filename)
-        cp.read(configFile)
+        cp.read(self.configFile)
         
         if (not cp.has_section('PostProcessing')):
             cp.add_section('PostProcessing')
@@ -305,6 +710,7 @@ class CurveFitSettings(object):
         cp.set('PostProcessing','resolution',str(self.pxToNm))
         cp.set('PostProcessing','xkcd',str(self.xkcd))
         cp.set('Analysis','defaultFitFunction',self.defaultFitFunction)
+        cp.set('Analysis','horizontalBinning',str(self.hozontalBinning))
         
         with file(self.configFile,'w') as fp:
             cp.write(fp)
@@ -348,8 +754,7 @@ class OpticsSettings(object):
             self.configFile = _os.path.abspath(filename)
             
         cp = _ConfigParser.SafeConfigParser()
-        configFile = _os.path.abspath(filename)
-        cp.read(configFile)
+        cp.read(self.configFile)
         
         if (not cp.has_section('Optics')):
             cp.add_section('Optics')
@@ -374,83 +779,458 @@ class ODAFitSettings(object):
                 'estimatorValues': self.estimatorValuesDict}
     
 
-class CurveFitResult(object):
-    def __init__(self):
-        self.popt = None
-        self.pcov = None
-        self.chisquare = None
-
-
 
-
-def calculatePeakDisplacements(intensityProfiles, peakFitSettings, progressReporter = None, pInitial = None, **curveFitKwargs):
+@_InstrumentedStage('fitting')
+def calculatePeakDisplacements(intensityProfiles, peakFitSettings, progressReporter = None, pInitial = None, nJobs = 1, executor = None, blockSize = None, solver = 'curve_fit', cache = None, warmStartPolicy = None, actuatorVoltage = None, **curveFitKwargs):
     """
     Fits an ODM FitFunction to the target Series of intensity profiles.
     
+    The fit of every profile is started from the result of the fit of the previous
+    profile. With a WarmStartPolicy, only plausible fit results are used as initial
+    parameters, and fits that fail or are not plausible are repeated from the
+    initial parameters estimated from the template profile.
+    
+    When fitting in parallel, the profiles are split into contiguous blocks that are
+    fitted in separate processes. Every block is started from the result of a short
+    serial pre-fit over every n-th profile (see _fitProfilesParallel).
+    
+    With the 'batched' solver, blocks of profiles are fitted at once with the vectorized
+    Levenberg-Marquardt solver of fitfunctions.batchCurveFit (see _fitProfilesBatched).
+    
+    Fit functions with their own fitting engine (a fitProfiles method, like the
+    TemplateMatchingSpline) fit all profiles with it in the current process, unless the
+    batched solver is chosen.
+    
     Parameters
     ----------
     
-    intensityProfiles : pandas.Series of 1D numpy.ndarray
-        A series of intensityProfiles that will be curve fit
+    intensityProfiles : pandas.Series of 1D numpy.ndarray or ProfileMatrix
+        A series of intensityProfiles that will be curve fit. The fit window of the
+        fit settings is in measured pixel coordinates, so profiles that were read
+        with a ProfileRegion must be passed as a ProfileMatrix with that region (see
+        getIntensityProfileMatrix).
     peakFitSettings : ODAFitSettings instance
         The curve fit settings to use for curve fitting
     progressReporter : ProgressReporter instance
         The ProgressReporter to use for displaying progress information. 
-        A StdOutProgressReporter is used by default.
+        A StdOutProgressReporter is used by default. Progress is passed on at most
+        10 times per second (see ProgressReporting.ThrottledProgressReporter).
+    pInitial : sequence of floats
+        The initial parameters for the fit of the first profile. If None, they are
+        estimated from the reference intensity profile of the fit settings. Template
+        based fit functions are initialized with the reference intensity profile also
+        when pInitial is given.
+    nJobs : integer
+        The number of processes to fit with. 1 (default) fits serially in the current
+        process, -1 uses all cpu's.
+    executor : multiprocessing.Pool, concurrent.futures.Executor or similar
+        An existing pool to fit the blocks with. Only its 'map' method is used. If given,
+        nJobs is only used to determine the default block size.
+    blockSize : integer
+        The number of profiles per parallel block. By default the profiles are split
+        into 4 blocks per process. For the 'batched' solver, the number of profiles that
+        is fitted at once (default 1000).
+    solver : string
+        'curve_fit' (default) fits every profile with scipy.optimize.curve_fit, 'batched'
+        uses fitfunctions.batchCurveFit. nJobs and executor are ignored for the batched
+        solver, which only uses curve_fit (with curveFitKwargs) for profiles that do not
+        converge.
+    cache : FitCache.FitResultCache or None
+        A cache of fit results. If it holds the results of a fit of the same profiles
+        with the same settings, initial parameters and options, those are returned
+        without fitting. Otherwise the new fit results are added to it.
+    warmStartPolicy : WarmStart.WarmStartPolicy or None
+        The checks of the fit results before they are used as initial parameters. With
+        a policy, fits that raise are stored as NaN with STATUS_FAILED instead of
+        aborting the fit, and the status of the other frames is STATUS_RECOVERED for
+        fits that were repeated successfully from the estimated initial parameters and
+        STATUS_IMPLAUSIBLE for fits that did not pass the checks (see the FitResults
+        module). It is not used by fit functions with their own fitting engine, and
+        by the batched solver only for the profiles that it fits with curve_fit.
+    actuatorVoltage : pandas.Series or array-like or None
+        The actuator voltage of every profile. If given, the predictor of the warm
+        start policy predicts the initial parameters from the voltage and actuation
+        direction instead of the frame number (see the WarmStart module).
     curveFitKwargs : Keyword arguments that will be passed to the curve_fit
-        function (scipy.optimization).
+        function (scipy.optimization). If the fit function has an analytic jacobian,
+        it is passed as 'jac' unless another one is given.
     
     
     Returns
     -------
 
-    A dataframe with the calculated displacements that has the same index as the input
-    intensity profile Series.
+    A dataframe with the same index as the input intensity profile Series, with the
+    columns 'displacement', 'chiSquare' and 'curveFitResult'. The fit results of all
+    profiles are stored in a single FitResultStore, of which the 'curveFitResult'
+    column holds a CurveFitResult view for every profile.
     """
     
     if not progressReporter:
         progressReporter = _StdOutProgressReporter()
+    #progress is reported for every profile, which is far more often than it can be displayed
+    progressReporter = _throttled(progressReporter)
+    
+    if not isinstance(intensityProfiles,ProfileMatrix):
+        intensityProfiles = ProfileMatrix.fromSeries(intensityProfiles)
     
     fitFunction = peakFitSettings.fitFunction
     index=intensityProfiles.index
     
-    if pInitial is not None:        
-        p0 = pInitial
-    else:
-        templateProfile = peakFitSettings.referenceIntensityProfile if peakFitSettings.referenceIntensityProfile is not None else intensityProfiles.iloc[0]
-        estimatesDict = fitFunction.estimateInitialParameters(templateProfile, **peakFitSettings.estimatorValuesDict)
-        p0 = estimatesDict.values()
+    estimate = None
+    if pInitial is None or getattr(peakFitSettings,'referenceIntensityProfile',None) is not None:
+        #template based fit functions (like the splines) are initialized by the estimate,
+        #also when the fit starts from pInitial, e.g. with fit settings read from a file
+        estimate = estimateInitialParameters(peakFitSettings,intensityProfiles.fullWidthProfile(0))
+    p0 = pInitial if pInitial is not None else estimate
+    
+    if actuatorVoltage is not None:
+        actuatorVoltage = _np.asarray(actuatorVoltage,dtype=float)
+        if len(actuatorVoltage) != len(index):
+            raise ValueError("actuatorVoltage length (%i) does not match the number of profiles (%i)" % (len(actuatorVoltage),len(index)))
+    
+    fallbackP0 = None
+    if warmStartPolicy is not None:
+        fallbackP0 = estimate if estimate is not None else _estimateFallbackParameters(peakFitSettings,intensityProfiles.fullWidthProfile(0))
         
-    xmin = peakFitSettings.xminBound
-    xmax = peakFitSettings.xmaxBound
-    xdata = _np.arange(len(intensityProfiles.iloc[0]))[xmin:xmax]
+    xdata,profiles = intensityProfiles.window(peakFitSettings.xminBound,peakFitSettings.xmaxBound)
+    profiles = profiles.data
     
-    progress = 0.0
     total = len(index)
-    curveFitResults = total*[None]
-    for i in range(total):
-         ydata = intensityProfiles.iloc[i][xmin:xmax]
-         popt,pcov = _curve_fit(fitFunction,\
-                  xdata = xdata,\
-                  ydata = ydata,\
-                  p0 = p0,**curveFitKwargs)
-         p0 = popt
-         
-         curveFitResult = {}       
-
-         curveFitResult['popt'] = popt
-         curveFitResult['pcov'] = pcov         
-         curveFitResult['chiSquare'] = _chisquare(ydata,fitFunction(xdata,*popt))[0]
-         curveFitResult['curveFitResult'] = attrdict.AttrDict(curveFitResult)
-         curveFitResult['displacement'] = fitFunction.getDisplacement(*popt)
-         
-         curveFitResults[i] = curveFitResult
-         
-         progress += 1
-         progressReporter.progress(progress / total * 100)
-    
-    df = _pd.DataFrame(index=index,data=curveFitResults)
+    if nJobs < 0:
+        nJobs = _mp.cpu_count()
+    
+    if solver == 'curve_fit' and getattr(fitFunction,'fitProfiles',None) is not None:
+        engine = 'fitProfiles'
+    elif solver == 'batched':
+        engine = 'batched'
+    elif solver != 'curve_fit':
+        raise ValueError("unknown solver: %s" % solver)
+    elif (nJobs > 1 or executor is not None) and total > 1:
+        engine = 'parallel'
+    else:
+        engine = 'serial'
+    
+    if cache is not None:
+        #the results of parallel fits depend on the block boundaries
+        templateProfile = getattr(peakFitSettings,'referenceIntensityProfile',None)
+        cacheKey = _FitCache.getFitCacheKey(peakFitSettings,xdata,profiles,p0,templateProfile,engine=engine,
+                                            nJobs=nJobs if engine == 'parallel' else None,blockSize=blockSize,curveFitKwargs=curveFitKwargs,
+                                            warmStartPolicy=vars(warmStartPolicy) if warmStartPolicy is not None else None,
+                                            actuatorVoltage=actuatorVoltage if warmStartPolicy is not None else None)
+        store = cache.get(cacheKey)
+        if store is not None and len(store) == total:
+            store.index = index
+            progressReporter.done()
+            return getPeakDisplacementDataFrame(store,fitFunction)
+    
+    if engine == 'fitProfiles':
+        fitResults = fitFunction.fitProfiles(xdata,profiles,p0,progressCallback=lambda n: progressReporter.progress(n / total * 100),**curveFitKwargs)
+    elif engine == 'batched':
+        fitResults = _fitProfilesBatched(fitFunction,xdata,profiles,p0,curveFitKwargs,blockSize,progressReporter,warmStartPolicy,fallbackP0)
+    elif engine == 'parallel':
+        fitResults = _fitProfilesParallel(fitFunction,xdata,profiles,p0,curveFitKwargs,nJobs,executor,blockSize,progressReporter,
+                                          warmStartPolicy,fallbackP0,actuatorVoltage)
+    else:
+        fitResults = _fitProfiles(fitFunction,xdata,profiles,p0,curveFitKwargs,
+                                  progressCallback=lambda n: progressReporter.progress(n / total * 100),
+                                  warmStartPolicy=warmStartPolicy,fallbackP0=fallbackP0,actuatorVoltage=actuatorVoltage)
+    
+    store = FitResultStore.fromResults(fitResults,index)
+    if cache is not None:
+        cache.put(cacheKey,store)
+    df = getPeakDisplacementDataFrame(store,fitFunction)
     
     progressReporter.done()
     
-    return df
\ No newline at end of file
+    return df
+
+
+def getPeakDisplacementDataFrame(fitResultStore,fitFunction):
+    """
+    Returns the fit results in the target FitResultStore as a dataframe like the one
+    returned by calculatePeakDisplacements, with the columns 'displacement',
+    'chiSquare' and 'curveFitResult'.
+    """
+    df = _pd.DataFrame(index=fitResultStore.index)
+    df['chiSquare'] = fitResultStore.chiSquare
+    df['curveFitResult'] = fitResultStore.toSeries()
+    df['displacement'] = fitFunction.getDisplacement(*fitResultStore.popt.T) if len(fitResultStore) else []
+    return df
+
+
+def estimateInitialParameters(peakFitSettings,templateProfile=None):
+    """
+    Estimates the initial fit parameters from the estimator values of the target fit
+    settings. Fit functions that are based on a template profile (like the spline
+    fit functions) are initialized with it.
+    
+    Parameters
+    ----------
+    
+    peakFitSettings : ODAFitSettings instance
+        The fit settings.
+    templateProfile : 1D numpy.ndarray
+        The profile to estimate the parameters from, if the fit settings have no
+        referenceIntensityProfile.
+    
+    Returns
+    -------
+    
+    A list with the initial parameters, in the order of the arguments of the fit
+    function.
+    """
+    if getattr(peakFitSettings,'referenceIntensityProfile',None) is not None:
+        templateProfile = peakFitSettings.referenceIntensityProfile
+    fitFunction = peakFitSettings.fitFunction
+    estimatesDict = fitFunction.estimateInitialParameters(templateProfile, **peakFitSettings.estimatorValuesDict)
+    #the estimates are returned as a dict, which has no order
+    parameterNames = _inspect.getargspec(fitFunction.__call__).args[2:]
+    if set(parameterNames) != set(estimatesDict):
+        return list(estimatesDict.values())
+    return [estimatesDict[name] for name in parameterNames]
+
+def _estimateFallbackParameters(peakFitSettings,templateProfile):
+    """
+    Estimates the initial fit parameters like estimateInitialParameters, without
+    initializing the fit function of the fit settings with the template profile.
+    """
+    settings = _copy.copy(peakFitSettings)
+    settings.fitFunction = _copy.deepcopy(peakFitSettings.fitFunction)
+    return estimateInitialParameters(settings,templateProfile)
+
+
+_PREFIT_STEPS_PER_BLOCK = 16
+_BATCHED_PREFIT_STRIDE = 16
+
+def _fitProfiles(fitFunction,xdata,profiles,p0,curveFitKwargs,progressCallback=None,warmStartPolicy=None,fallbackP0=None,actuatorVoltage=None):
+    """
+    Fits fitFunction to every row of profiles, starting every fit from the result of
+    the previous one. The analytic jacobian of the fit function is passed to curve_fit
+    if it has one and curveFitKwargs does not specify another. With a
+    WarmStartPolicy, the profiles are fitted with _fitProfilesWithPolicy.
+    
+    Returns
+    -------
+    
+    A list with a (popt,pcov,chiSquare) tuple for every profile, or a
+    (popt,pcov,chiSquare,status) tuple with a WarmStartPolicy.
+    """
+    
+    curveFitKwargs = _withJacobian(fitFunction,curveFitKwargs)
+    if warmStartPolicy is not None:
+        return _fitProfilesWithPolicy(fitFunction,xdata,profiles,p0,curveFitKwargs,warmStartPolicy,
+                                      fallbackP0 if fallbackP0 is not None else p0,progressCallback,actuatorVoltage)
+    results = []
+    for ydata in profiles:
+        popt,pcov = _curve_fit(fitFunction,xdata=xdata,ydata=ydata,p0=p0,**curveFitKwargs)
+        p0 = popt
+        results.append((popt,pcov,_chisquare(ydata,fitFunction(xdata,*popt))[0]))
+        if progressCallback is not None:
+            progressCallback(len(results))
+    return results
+
+def _tryCurveFit(fitFunction,xdata,ydata,p0,curveFitKwargs):
+    """
+    Returns the (popt,pcov,chiSquare) of a curve_fit, or None if it fails.
+    """
+    
+    try:
+        popt,pcov = _curve_fit(fitFunction,xdata=xdata,ydata=ydata,p0=p0,**curveFitKwargs)
+    except (RuntimeError,ValueError):
+        return None
+    return popt,pcov,_chisquare(ydata,fitFunction(xdata,*popt))[0]
+
+def _fitProfilesWithPolicy(fitFunction,xdata,profiles,p0,curveFitKwargs,warmStartPolicy,fallbackP0,progressCallback=None,actuatorVoltage=None):
+    """
+    Fits fitFunction to every row of profiles, starting every fit from the initial
+    parameters of a WarmStartTracker.
+    
+    Fits are limited to warmStartMaxfev function evaluations. A fit that fails or is
+    not plausible is repeated from fallbackP0, with the maxfev of curveFitKwargs as
+    long as no fit has been accepted yet. Fits that still fail are stored as NaN.
+    The positions of the fits for the predictor of the tracker are the actuator
+    voltages, if given, or the frame numbers.
+    
+    Returns
+    -------
+    
+    A list with a (popt,pcov,chiSquare,status) tuple for every profile. The status is
+    None for fits that were plausible at the first attempt.
+    """
+    
+    warmKwargs = curveFitKwargs
+    #maxfev is an argument of the Levenberg-Marquardt solver only
+    if warmStartPolicy.warmStartMaxfev is not None and 'bounds' not in curveFitKwargs and curveFitKwargs.get('method') in (None,'lm'):
+        warmKwargs = dict(curveFitKwargs,maxfev=min(warmStartPolicy.warmStartMaxfev,curveFitKwargs.get('maxfev',_np.inf)))
+    
+    tracker = warmStartPolicy.createTracker(fitFunction,xdata,p0)
+    nParameters = len(p0)
+    failed = (_np.full(nParameters,_np.nan),_np.full((nParameters,nParameters),_np.nan),_np.nan,_FitResults.STATUS_FAILED)
+    results = []
+    for i,ydata in enumerate(profiles):
+        position = actuatorVoltage[i] if actuatorVoltage is not None else i
+        result = _tryCurveFit(fitFunction,xdata,ydata,tracker.initialParameters(position),warmKwargs)
+        if result is not None and tracker.isPlausible(result[0],result[2]):
+            tracker.accept(result[0],result[2],position)
+            results.append(result + (None,))
+        else:
+            #a profile that needs more evaluations when the previous fits did not is an outlier
+            retry = _tryCurveFit(fitFunction,xdata,ydata,fallbackP0,warmKwargs if tracker.nAccepted else curveFitKwargs)
+            if retry is not None and tracker.isPlausible(retry[0],retry[2]):
+                tracker.accept(retry[0],retry[2],position)
+                results.append(retry + (_FitResults.STATUS_RECOVERED,))
+            else:
+                tracker.reject()
+                candidates = [r for r in (result,retry) if r is not None and _np.isfinite(r[0]).all()]
+                if candidates:
+                    best = min(candidates,key=lambda r: r[2] if _np.isfinite(r[2]) else _np.inf)
+                    results.append(best + (_FitResults.STATUS_IMPLAUSIBLE,))
+                else:
+                    results.append(failed)
+        if progressCallback is not None:
+            progressCallback(len(results))
+    return results
+
+def _withJacobian(fitFunction,curveFitKwargs):
+    """
+    Returns a copy of curveFitKwargs with the analytic jacobian of fitFunction as 'jac',
+    unless it has no jacobian or curveFitKwargs already specifies one.
+    """
+    
+    jacobian = getattr(fitFunction,'jacobian',None)
+    if jacobian is None or 'jac' in curveFitKwargs or 'Dfun' in curveFitKwargs:
+        return curveFitKwargs
+    return dict(curveFitKwargs,jac=jacobian)
+
+def _fitProfileBlock(args):
+    """
+    Helper for fitting a block of profiles in a worker process with _fitProfiles.
+    """
+    
+    fitFunction,xdata,profiles,p0,curveFitKwargs,warmStartPolicy,fallbackP0,actuatorVoltage = args
+    return _fitProfiles(fitFunction,xdata,profiles,p0,curveFitKwargs,warmStartPolicy=warmStartPolicy,fallbackP0=fallbackP0,actuatorVoltage=actuatorVoltage)
+
+def _fitProfilesParallel(fitFunction,xdata,profiles,p0,curveFitKwargs,nJobs,executor,blockSize,progressReporter,warmStartPolicy=None,fallbackP0=None,actuatorVoltage=None):
+    """
+    Fits the profiles in contiguous blocks in a pool of processes.
+    
+    Every block needs its own initial parameters that are close to the result for its
+    first profile. They are obtained by a serial pre-fit of every n-th profile, where
+    n is chosen such that there are _PREFIT_STEPS_PER_BLOCK pre-fit steps per block.
+    The block sizes are a multiple of n, so the first profile of every block is part of
+    the pre-fit.
+    """
+    
+    total = len(profiles)
+    if blockSize is None:
+        blockSize = int(_np.ceil(total / (4.0 * max(nJobs,1))))
+    stride = max(1,blockSize // _PREFIT_STEPS_PER_BLOCK)
+    blockSize = max(stride,(blockSize // stride) * stride)
+    
+    progressReporter.message('pre-fitting every %ith profile...' % stride)
+    preFitResults = _fitProfiles(fitFunction,xdata,profiles[::stride],p0,curveFitKwargs,
+                                 warmStartPolicy=warmStartPolicy,fallbackP0=fallbackP0,
+                                 actuatorVoltage=actuatorVoltage[::stride] if actuatorVoltage is not None else None)
+    
+    preFitStore = FitResultStore.fromResults(preFitResults)
+    blockStarts = range(0,total,blockSize)
+    tasks = [(fitFunction,xdata,profiles[start:start + blockSize],_FitResults.lastUsableParameters(preFitStore.slice(0,start // stride + 1),p0),
+              curveFitKwargs,warmStartPolicy,fallbackP0,actuatorVoltage[start:start + blockSize] if actuatorVoltage is not None else None)
+             for start in blockStarts]
+    
+    pool = executor if executor is not None else _mp.Pool(nJobs)
+    try:
+        progressReporter.message('fitting %i blocks of %i profiles...' % (len(tasks),blockSize))
+        mapFunction = pool.imap if hasattr(pool,'imap') else pool.map
+        results = []
+        for blockResults in mapFunction(_fitProfileBlock,tasks):
+            results += blockResults
+            progressReporter.progress(len(results) / total * 100)
+    finally:
+        if executor is None:
+            pool.close()
+            pool.join()
+    
+    return results
+
+def _batchedInitialParameters(fitFunction,xdata,ydata,p0,curveFitKwargs,jacobian):
+    """
+    Returns the initial parameters of every profile of a block for the batched solver.
+    
+    The first profile is fitted with curve_fit, starting from p0. Every
+    _BATCHED_PREFIT_STRIDE-th profile and the last profile are then fitted with the
+    batched solver, starting from that result, and the initial parameters of the other
+    profiles are interpolated between the results of these pre-fits. Neighbouring
+    pre-fits may have found equivalent parameters that differ a lot (like a harmonic
+    that is shifted by a whole period), of which the average fits neither; profiles
+    between those start from the result of the nearest pre-fit instead. p0 is
+    returned if none of the pre-fits converge.
+    """
+    
+    firstResult = _tryCurveFit(fitFunction,xdata,ydata[0],p0,_withJacobian(fitFunction,curveFitKwargs))
+    if firstResult is not None and _np.isfinite(firstResult[0]).all():
+        p0 = firstResult[0]
+    
+    nProfiles = len(ydata)
+    preFitIndex = _np.unique(_np.r_[_np.arange(0,nProfiles,_BATCHED_PREFIT_STRIDE),nProfiles - 1])
+    preFit = _batchCurveFit(fitFunction,xdata,ydata[preFitIndex],p0,jacobian=jacobian)
+    preFitIndex,popt = preFitIndex[preFit.converged],preFit.popt[preFit.converged]
+    if len(preFitIndex) == 0:
+        return p0
+    
+    positions = _np.arange(nProfiles)
+    after = _np.clip(_np.searchsorted(preFitIndex,positions),0,len(preFitIndex) - 1)
+    before = _np.maximum(after - 1,0)
+    pBefore,pAfter = popt[before],popt[after]
+    #0 at the pre-fit before and 1 at the pre-fit after every profile
+    weight = _np.clip((positions - preFitIndex[before]) / _np.maximum(preFitIndex[after] - preFitIndex[before],1),0,1)[:,_np.newaxis]
+    seeds = pBefore + weight*(pAfter - pBefore)
+    inconsistent = (_np.abs(pAfter - pBefore) > 0.5*(_np.abs(pBefore) + _np.abs(pAfter))).any(axis=1)
+    seeds[inconsistent] = _np.where(weight < 0.5,pBefore,pAfter)[inconsistent]
+    return seeds
+
+def _fitProfilesBatched(fitFunction,xdata,profiles,p0,curveFitKwargs,blockSize,progressReporter,warmStartPolicy=None,fallbackP0=None):
+    """
+    Fits the profiles in blocks with the batched Levenberg-Marquardt solver.
+    
+    Every profile of a block starts from its own initial parameters (see
+    _batchedInitialParameters), so that few iterations are needed for all of them. The
+    next block starts from the result for the last profile of the previous block.
+    Profiles for which the fit does not converge are fitted again, starting from the
+    result of the nearest preceding profile that did converge, and finally with
+    curve_fit (with the warm start checks of warmStartPolicy, if given).
+    """
+    
+    total = len(profiles)
+    if blockSize is None:
+        blockSize = 1000
+    jacobian = getattr(fitFunction,'jacobian',None)
+    
+    results = []
+    for start in range(0,total,blockSize):
+        ydata = profiles[start:start + blockSize]
+        batchResult = _batchCurveFit(fitFunction,xdata,ydata,_batchedInitialParameters(fitFunction,xdata,ydata,p0,curveFitKwargs,jacobian),jacobian=jacobian)
+        popt,pcov,chiSquare,converged = batchResult.popt,batchResult.pcov,batchResult.chiSquare,batchResult.converged
+        
+        if not converged.all() and converged.any():
+            retry = _np.flatnonzero(~converged)
+            previousConverged = _np.maximum.accumulate(_np.where(converged,_np.arange(len(converged)),-1))[retry]
+            seeds = _np.where((previousConverged >= 0)[:,_np.newaxis],popt[_np.maximum(previousConverged,0)],_np.asarray(p0,dtype=float))
+            retryResult = _batchCurveFit(fitFunction,xdata,ydata[retry],seeds,jacobian=jacobian)
+            popt[retry],pcov[retry],chiSquare[retry] = retryResult.popt,retryResult.pcov,retryResult.chiSquare
+            converged[retry] = retryResult.converged
+        
+        blockResults = zip(popt,pcov,chiSquare)
+        blockStore = FitResultStore.fromResults(blockResults)
+        for i in _np.flatnonzero(~converged):
+            pStart = _FitResults.lastUsableParameters(blockStore.slice(0,i),p0)
+            blockResults[i] = _fitProfiles(fitFunction,xdata,ydata[i:i+1],pStart,curveFitKwargs,
+                                           warmStartPolicy=warmStartPolicy,fallbackP0=fallbackP0)[0]
+            blockStore.setResult(i,*blockResults[i])
+        
+        results += blockResults
+        #the next block starts from the last usable fit of this block, or else from the same p0
+        p0 = _FitResults.lastUsableParameters(blockStore,p0)
+        progressReporter.progress(len(results) / total * 100)
+    
+    return results
\ No newline at end of file
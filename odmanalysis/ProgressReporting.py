@@ -17,10 +17,38 @@
 Created on Thu Dec 19 10:29:54 2013
 
 @author: jkokorian
+
+Besides progress reporting, this module measures the stages of an analysis. Every
+function that is decorated with BasicProgressReporter or InstrumentedStage (reading,
+fitting, writing, every plot) records its wall time, CPU time, number of items,
+throughput and peak memory use, and sends the record to the instrumentation sinks
+that have been added with addInstrumentationSink:
+
+    - CollectingSink: keeps the records in memory
+    - SummaryTableSink: prints a table with the totals per stage when it is closed
+    - JsonLinesSink: writes every record as a line of JSON to a file
+
+Nothing is measured as long as no sink has been added. The sinks can also be set
+with the ODM_INSTRUMENTATION environment variable, which applies to every script:
+'summary' prints a summary table at exit, any other value is the path of a JSON
+lines file that the records are appended to.
 """
 
 
 import sys
+import os
+import time
+import json
+import atexit
+import threading
+import functools
+import pandas as pd
+import numpy as np
+try:
+    import resource
+except ImportError:
+    #not available on Windows
+    resource = None
 
 class ProgressReporter(object):
     """
@@ -39,11 +67,97 @@ class ProgressReporter(object):
         pass
         
 
+class RateLimiter(object):
+    """
+    Decides when a frequent event, like the progress of a loop, should be delivered.
+    
+    Example
+    -------
+    
+    >>> limiter = RateLimiter(minInterval=0.1)
+    >>> for i in range(n):
+    ...     doWork(i)
+    ...     if limiter.ready():
+    ...         redraw()
+    """
+    def __init__(self, minInterval = 0.1, minCount = 1):
+        """
+        Parameters
+        ----------
+        
+        minInterval: float
+            The minimum time in seconds between two deliveries.
+        
+        minCount: int
+            The minimum number of calls to ready() between two deliveries. The clock
+            is only read when this number is reached.
+        """
+        self.minInterval = minInterval
+        self.minCount = minCount
+        self.count = 0
+        self.lastTime = None
+    
+    def ready(self):
+        """
+        Returns True if the event should be delivered. The first call always returns True.
+        """
+        self.count += 1
+        if self.count < self.minCount:
+            return False
+        now = time.time()
+        if self.lastTime is not None and now - self.lastTime < self.minInterval:
+            return False
+        self.count = 0
+        self.lastTime = now
+        return True
+
+
+class ThrottledProgressReporter(ProgressReporter):
+    """
+    A ProgressReporter that passes progress on to another ProgressReporter at a limited
+    rate. Messages, the completion of a task (100%) and done() are always passed on.
+    """
+    def __init__(self, progressReporter, minInterval = 0.1, minCount = 1):
+        """
+        Parameters
+        ----------
+        
+        progressReporter: ProgressReporter instance
+            The ProgressReporter to pass the progress on to.
+        
+        minInterval, minCount:
+            See RateLimiter.
+        """
+        super(ThrottledProgressReporter,self).__init__()
+        self.progressReporter = progressReporter
+        self.rateLimiter = RateLimiter(minInterval,minCount)
+    
+    def progress(self,progress, message=""):
+        if progress >= 100 or self.rateLimiter.ready():
+            self.progressReporter.progress(progress,message)
+    
+    def message(self,message):
+        self.progressReporter.message(message)
+    
+    def done(self):
+        self.progressReporter.done()
+
+
+def throttled(progressReporter, minInterval = 0.1):
+    """
+    Returns the target ProgressReporter wrapped in a ThrottledProgressReporter, unless it
+    is already throttled or does nothing with progress.
+    """
+    if isinstance(progressReporter,ThrottledProgressReporter) or type(progressReporter) is ProgressReporter:
+        return progressReporter
+    return ThrottledProgressReporter(progressReporter,minInterval)
+
+
 class StreamReporter(object):
     """
     A ProgressReporter that reports to a stream object.
     """
-    def __init__(self,stream):
+    def __init__(self,stream,minInterval=0.1):
         """
         Parameters
         ----------
@@ -51,12 +165,20 @@ class StreamReporter(object):
         stream: any stream-like object
             The stream to which progress is reported. The target stream object
             should at least have 'write' and 'flush' methods.
+        
+        minInterval: float
+            The minimum time in seconds between two progress updates. Progress that
+            is reported sooner after the previous update is not written, unless the
+            task is complete.
         """
         super(StreamReporter,self).__init__()
         self.stream = stream
         self.lastMessage = ""
+        self.rateLimiter = RateLimiter(minInterval)
 
     def progress(self,progress, message=""):
+        if progress < 100 and not self.rateLimiter.ready():
+            return
         s = "%s %d%%\r" % (message,progress)
         if (s != self.lastMessage):
             self.stream.write(s)
@@ -80,8 +202,8 @@ class StdOutProgressReporter(StreamReporter):
     """
     A ProgressReporter that reports to the standard output stream.
     """
-    def __init__(self):
-        StreamReporter.__init__(self,sys.stdout)
+    def __init__(self,minInterval=0.1):
+        StreamReporter.__init__(self,sys.stdout,minInterval)
     
 
 class BasicProgressReporter(object):
@@ -124,7 +246,7 @@ class BasicProgressReporter(object):
     exited
     """
     
-    def __init__(self, entryMessage = None, exitMessage = "Done"):
+    def __init__(self, entryMessage = None, exitMessage = "Done", stageName = None, itemCount = None):
         """
         Parameters
         ----------
@@ -134,10 +256,15 @@ class BasicProgressReporter(object):
         
         exitMessage: string
             The message that will be displayed when the decorated function exits
+        
+        stageName, itemCount:
+            See InstrumentedStage. Every call of the decorated function is measured
+            as a stage.
         """
         self.entryMessage = entryMessage
         self.exitMessage = exitMessage
         self.p = StdOutProgressReporter()
+        self.instrumentedStage = InstrumentedStage(stageName,itemCount)
         
     def __call__(self,f):
         if self.entryMessage is None:
@@ -159,4 +286,263 @@ class BasicProgressReporter(object):
             return result
         
         wrapped_f.func_name = f.func_name
-        return wrapped_f
\ No newline at end of file
+        return self.instrumentedStage(wrapped_f)
+
+
+_sinks = []
+_sinksLock = threading.Lock()
+
+def addInstrumentationSink(sink):
+    """
+    Adds a sink that receives a record of every measured stage.
+    """
+    with _sinksLock:
+        _sinks.append(sink)
+    return sink
+
+def removeInstrumentationSink(sink):
+    """
+    Removes a sink that was added with addInstrumentationSink and closes it.
+    """
+    with _sinksLock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+    sink.close()
+
+def _publish(record):
+    with _sinksLock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        sink.record(record)
+
+
+def _cpuTime():
+    """
+    The CPU time of the process and of the child processes that have finished.
+    """
+    return sum(os.times()[:4])
+
+def _peakMemoryMB():
+    """
+    The peak resident memory of the process in MB, or None if it is not available.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on Mac OS
+    return maxrss / 1024.0**2 if sys.platform == 'darwin' else maxrss / 1024.0
+
+
+class StageMeasurement(object):
+    """
+    Measures a single stage. Use measureStage to create one.
+    
+    The items attribute can be set while the stage runs, to record the number of
+    items (profiles, rows, ...) that the stage processed.
+    """
+    def __init__(self,stageName,items=None):
+        self.stageName = stageName
+        self.items = items
+    
+    def __enter__(self):
+        self.startTime = time.time()
+        self.startCpuTime = _cpuTime()
+        self.startPeakMemoryMB = _peakMemoryMB()
+        return self
+    
+    def __exit__(self,excType,excValue,traceback):
+        wallTime = time.time() - self.startTime
+        peakMemoryMB = _peakMemoryMB()
+        record = {'stage': self.stageName,
+                  'startTime': self.startTime,
+                  'wallTime': wallTime,
+                  'cpuTime': _cpuTime() - self.startCpuTime,
+                  'items': self.items,
+                  'itemsPerSecond': self.items / wallTime if self.items is not None and wallTime > 0 else None,
+                  'peakMemoryMB': peakMemoryMB,
+                  'memoryIncreaseMB': peakMemoryMB - self.startPeakMemoryMB if peakMemoryMB is not None else None,
+                  'thread': threading.current_thread().name,
+                  'failed': excType is not None}
+        _publish(record)
+        return False
+
+class _NullMeasurement(object):
+    items = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,excType,excValue,traceback):
+        return False
+
+def measureStage(stageName,items=None):
+    """
+    Returns a context manager that measures the enclosed code as a stage.
+    
+    Example
+    -------
+    
+    >>> with measureStage('export') as stage:
+    ...     df.to_csv(path)
+    ...     stage.items = len(df)
+    """
+    if not _sinks:
+        return _NullMeasurement()
+    return StageMeasurement(stageName,items)
+
+
+def _defaultItemCount(result,*args,**kwargs):
+    """
+    The length of the result if it is a dataframe, series or array, otherwise the
+    length of the first such argument, or None.
+    """
+    for value in (result,) + args:
+        if isinstance(value,(pd.DataFrame,pd.Series,np.ndarray)):
+            return len(value)
+    return None
+
+
+class InstrumentedStage(object):
+    """
+    Decorator that measures every call of a function as a stage, without reporting
+    progress.
+    
+    Example
+    -------
+    
+    >>> @InstrumentedStage('fitting')
+    ... def fit(profiles):
+    ...     pass
+    """
+    
+    def __init__(self, stageName = None, itemCount = None):
+        """
+        Parameters
+        ----------
+        
+        stageName: string
+            The name of the stage. The name of the decorated function by default.
+        
+        itemCount: function
+            A function that returns the number of items that a call processed. It is
+            called with the result and the arguments of the call. By default the
+            length of the result, or of the first argument, that is a dataframe,
+            series or array is used.
+        """
+        self.stageName = stageName
+        self.itemCount = itemCount if itemCount is not None else _defaultItemCount
+    
+    def __call__(self,f):
+        if self.stageName is None:
+            self.stageName = f.func_name
+        
+        @functools.wraps(f)
+        def measured_f(*args,**kwargs):
+            if not _sinks:
+                return f(*args,**kwargs)
+            with StageMeasurement(self.stageName) as stage:
+                result = f(*args,**kwargs)
+                stage.items = self.itemCount(result,*args,**kwargs)
+            return result
+        
+        return measured_f
+
+
+class InstrumentationSink(object):
+    """
+    Abstract class definition for a sink of stage records.
+    
+    A record is a dictionary with the keys 'stage', 'startTime', 'wallTime',
+    'cpuTime', 'items', 'itemsPerSecond', 'peakMemoryMB', 'memoryIncreaseMB',
+    'thread' and 'failed'. Times are in seconds. The CPU time is that of the whole
+    process, so it includes other threads. The peak memory is the peak resident
+    memory of the process at the end of the stage, memoryIncreaseMB the amount by
+    which the stage raised it.
+    """
+    def record(self,record):
+        pass
+    
+    def close(self):
+        pass
+
+
+class CollectingSink(InstrumentationSink):
+    """
+    An InstrumentationSink that keeps the records in memory.
+    """
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+    
+    def record(self,record):
+        with self.lock:
+            self.records.append(record)
+    
+    def summary(self):
+        """
+        Returns a dataframe with the totals per stage, in the order in which the
+        stages were first recorded.
+        """
+        with self.lock:
+            records = pd.DataFrame(list(self.records),columns=['stage','wallTime','cpuTime','items','peakMemoryMB'])
+        stages = records.groupby('stage',sort=False)
+        summary = pd.DataFrame({'calls': stages.size(),
+                                'wallTime': stages.wallTime.sum(),
+                                'cpuTime': stages.cpuTime.sum(),
+                                'items': stages['items'].sum(min_count=1),
+                                'peakMemoryMB': stages.peakMemoryMB.max()},
+                               columns=['calls','wallTime','cpuTime','items','itemsPerSecond','peakMemoryMB'])
+        summary['itemsPerSecond'] = summary['items'] / summary.wallTime
+        return summary
+
+
+class SummaryTableSink(CollectingSink):
+    """
+    An InstrumentationSink that writes a table with the totals per stage to a stream
+    when it is closed.
+    """
+    def __init__(self,stream=None):
+        super(SummaryTableSink,self).__init__()
+        self.stream = stream
+    
+    def close(self):
+        stream = self.stream if self.stream is not None else sys.stdout
+        if self.records:
+            stream.write("\n%s\n" % self.summary().to_string(float_format=lambda x: "%.3f" % x))
+            stream.flush()
+
+
+class JsonLinesSink(InstrumentationSink):
+    """
+    An InstrumentationSink that appends every record as a line of JSON to a file.
+    """
+    def __init__(self,path):
+        self.path = path
+        self.stream = open(path,'a')
+        self.lock = threading.Lock()
+    
+    def record(self,record):
+        line = json.dumps(record)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+    
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+def enableInstrumentationFromEnvironment(variable='ODM_INSTRUMENTATION'):
+    """
+    Adds the sink that the target environment variable specifies, see the module
+    documentation. The sink is closed at exit.
+    """
+    value = os.environ.get(variable)
+    if not value:
+        return None
+    sink = SummaryTableSink(sys.stderr) if value == 'summary' else JsonLinesSink(value)
+    addInstrumentationSink(sink)
+    atexit.register(removeInstrumentationSink,sink)
+    return sink
+
+enableInstrumentationFromEnvironment()
\ No newline at end of file
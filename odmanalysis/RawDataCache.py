@@ -0,0 +1,326 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Binary cache of parsed raw ODM data.
+
+The cache of 'data.csv' is a directory 'data.odmcache' next to it that holds the
+parsed columns as .npy files, which can be memory-mapped on later loads:
+
+    - profiles.npy: the (n_frames x n_pixels) intensity profile matrix
+    - timestamp.npy, relativeTime.npy, actuatorVoltage.npy: one value per frame
+    - source.json: fingerprint of the data.csv file the cache was created from
+"""
+
+import os as _os
+import json as _json
+import shutil as _shutil
+import hashlib as _hashlib
+import numpy as _np
+import pandas as _pd
+from IntensityProfiles import ProfileMatrix
+
+CACHE_VERSION = 1
+
+_HASH_BLOCK_SIZE = 1024*1024
+_columnNames = ['timestamp','relativeTime','actuatorVoltage']
+
+
+def getCachePath(dataFilePath):
+    """
+    Returns the path of the cache directory for the target data file.
+    """
+    return _os.path.splitext(_os.path.abspath(dataFilePath))[0] + '.odmcache'
+
+
+def getSourceFingerprint(dataFilePath):
+    """
+    Returns a dictionary with the size, modification time and a content hash of
+    the target file.
+
+    The hash is computed from the size and the first and last megabyte of the
+    file, so that it stays cheap for files of many gigabytes.
+    """
+    stat = _os.stat(dataFilePath)
+    md5 = _hashlib.md5(str(stat.st_size))
+    with open(dataFilePath,'rb') as f:
+        md5.update(f.read(_HASH_BLOCK_SIZE))
+        if stat.st_size > _HASH_BLOCK_SIZE:
+            f.seek(max(_HASH_BLOCK_SIZE,stat.st_size - _HASH_BLOCK_SIZE))
+            md5.update(f.read(_HASH_BLOCK_SIZE))
+
+    return {'version': CACHE_VERSION,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': md5.hexdigest()}
+
+
+def isCacheValid(dataFilePath):
+    """
+    Returns True if a cache exists for the target data file and was created from
+    a file with the same size, modification time and content hash.
+    """
+    fingerprintFile = _os.path.join(getCachePath(dataFilePath),'source.json')
+    if not _os.path.isfile(fingerprintFile):
+        return False
+
+    try:
+        with open(fingerprintFile,'r') as f:
+            cached = _json.load(f)
+    except ValueError:
+        return False
+
+    stat = _os.stat(dataFilePath)
+    if cached.get('version') != CACHE_VERSION or cached.get('size') != stat.st_size or cached.get('mtime') != stat.st_mtime:
+        return False
+
+    return cached == getSourceFingerprint(dataFilePath)
+
+
+class NpyAppender(object):
+    """
+    Writes a .npy file row block by row block, without knowing the final number
+    of rows in advance.
+
+    The header is written with room for any row count and is rewritten with the
+    actual shape when the appender is flushed or closed.
+    """
+
+    _HEADER_LENGTH = 128
+
+    def __init__(self,path,append=False):
+        """
+        Parameters
+        ----------
+
+        path : string
+            Path to the .npy file.
+        append : boolean
+            If True and the file exists, rows are appended to the existing rows. The
+            file must have been written by an NpyAppender.
+        """
+        self.path = path
+        self.dtype = None
+        self.rowShape = None
+        self.nRows = 0
+        if append and _os.path.isfile(path):
+            self.stream = open(path,'r+b')
+            _np.lib.format.read_magic(self.stream)
+            shape,fortranOrder,self.dtype = _np.lib.format.read_array_header_1_0(self.stream)
+            if self.stream.tell() != self._HEADER_LENGTH or fortranOrder:
+                self.stream.close()
+                raise ValueError("%s was not written by an NpyAppender" % path)
+            self.rowShape = shape[1:]
+            self.truncate(shape[0])
+        else:
+            self.stream = open(path,'wb')
+
+    def append(self,block):
+        """
+        Appends the rows of the target array to the file.
+        """
+        block = _np.ascontiguousarray(block)
+        if self.dtype is None:
+            self.dtype = block.dtype
+            self.rowShape = block.shape[1:]
+            self._writeHeader()
+        elif block.shape[1:] != self.rowShape:
+            raise ValueError("rows of shape %s cannot be appended to rows of shape %s" % (block.shape[1:],self.rowShape))
+        else:
+            block = block.astype(self.dtype,copy=False)
+
+        self.stream.write(block.tostring())
+        self.nRows += len(block)
+
+    def truncate(self,nRows):
+        """
+        Discards the rows after the first nRows rows, including any incompletely
+        written row.
+        """
+        self.nRows = nRows
+        self.stream.seek(self._HEADER_LENGTH + self.nRows*self.dtype.itemsize*int(_np.prod(self.rowShape)))
+        self.stream.truncate()
+
+    def flush(self):
+        """
+        Updates the header with the current number of rows and flushes the file, so
+        that other readers can load the rows that have been appended so far.
+        """
+        if self.dtype is not None:
+            self._writeHeader()
+        self.stream.flush()
+
+    def close(self):
+        if self.dtype is None:
+            self.dtype = _np.dtype(float)
+            self.rowShape = ()
+        self._writeHeader()
+        self.stream.close()
+
+    def _writeHeader(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (_np.lib.format.dtype_to_descr(self.dtype),(self.nRows,) + self.rowShape)
+        header = header.ljust(self._HEADER_LENGTH - len(_np.lib.format.magic(1,0)) - 3) + '\n'
+        position = self.stream.tell()
+        self.stream.seek(0)
+        self.stream.write(_np.lib.format.magic(1,0))
+        self.stream.write(_np.uint16(len(header)).astype('<u2').tostring())
+        self.stream.write(header)
+        self.stream.seek(max(position,self._HEADER_LENGTH))
+
+
+class RawDataCacheWriter(object):
+    """
+    Writes the cache of a data file chunk by chunk, so that data files that are
+    larger than the available memory can be cached.
+
+    The cache is written to a temporary directory that replaces the existing cache
+    when the writer is closed.
+    """
+
+    def __init__(self,dataFilePath):
+        self.dataFilePath = dataFilePath
+        self.cachePath = getCachePath(dataFilePath)
+        self.tempPath = self.cachePath + '.tmp'
+        if _os.path.exists(self.tempPath):
+            _shutil.rmtree(self.tempPath)
+        _os.makedirs(self.tempPath)
+
+        self.fingerprint = getSourceFingerprint(dataFilePath)
+        self.appenders = {name: NpyAppender(_os.path.join(self.tempPath,name + '.npy')) for name in _columnNames + ['profiles']}
+
+    def writeChunk(self,df):
+        """
+        Appends an ODM dataframe chunk without empty intensity profiles to the cache.
+
+        Raises
+        ------
+
+        ValueError: if the timestamps of the chunk have not been parsed, which the
+        cache cannot hold.
+        """
+        if not _np.issubdtype(df.index.dtype,_np.datetime64):
+            raise ValueError("the timestamps of %s could not be parsed" % self.dataFilePath)
+        self.appenders['profiles'].append(ProfileMatrix.fromDataFrame(df).data)
+        self.appenders['timestamp'].append(df.index.values)
+        self.appenders['relativeTime'].append(df.relativeTime.values)
+        self.appenders['actuatorVoltage'].append(df.actuatorVoltage.values)
+
+    def close(self):
+        for appender in self.appenders.values():
+            appender.close()
+
+        with open(_os.path.join(self.tempPath,'source.json'),'w') as f:
+            _json.dump(self.fingerprint,f)
+
+        if _os.path.exists(self.cachePath):
+            _shutil.rmtree(self.cachePath)
+        _os.rename(self.tempPath,self.cachePath)
+
+    def abort(self):
+        """
+        Discards the cache that has been written, leaving the existing cache as it is.
+        """
+        for appender in self.appenders.values():
+            appender.stream.close()
+        _shutil.rmtree(self.tempPath)
+
+
+def writeRawDataCache(df,dataFilePath):
+    """
+    Writes the parsed raw data of the target data file to its cache directory.
+
+    Parameters
+    ----------
+
+    df : pandas.DataFrame
+        ODM dataframe as read from dataFilePath, without empty intensity profiles.
+    dataFilePath : string
+        Path to the data.csv file the dataframe was read from.
+    """
+    writer = RawDataCacheWriter(dataFilePath)
+    try:
+        writer.writeChunk(df)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def buildRawDataCache(dataFilePath,chunks):
+    """
+    Writes the cache of the target data file from an iterable of dataframe chunks,
+    keeping only one chunk in memory at a time.
+
+    Parameters
+    ----------
+
+    dataFilePath : string
+        Path to the data.csv file the chunks are read from.
+    chunks : iterable of pandas.DataFrame
+        ODM dataframe chunks without empty intensity profiles, usually a reader
+        returned by getODMDataReader.
+    """
+    writer = RawDataCacheWriter(dataFilePath)
+    try:
+        for chunk in chunks:
+            if len(chunk) > 0:
+                writer.writeChunk(chunk)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def readRawDataCache(dataFilePath,mmap=True):
+    """
+    Reads the cached raw data of the target data file.
+
+    Parameters
+    ----------
+
+    dataFilePath : string
+        Path to the data.csv file.
+    mmap : boolean
+        If True (default), the arrays are memory-mapped instead of read into memory.
+
+    Returns
+    -------
+
+    frame : pandas.DataFrame
+        Dataframe with the 'relativeTime' and 'actuatorVoltage' columns, indexed by timestamp.
+    profiles : ProfileMatrix
+        The intensity profiles with the same index as frame.
+
+    None is returned if there is no valid cache for the target file, or if the cache
+    cannot be loaded.
+    """
+    if not isCacheValid(dataFilePath):
+        return None
+
+    cachePath = getCachePath(dataFilePath)
+    mmapMode = 'r' if mmap else None
+    try:
+        columns = {name: _np.load(_os.path.join(cachePath,name + '.npy'),mmap_mode=mmapMode) for name in _columnNames + ['profiles']}
+    except ValueError:
+        #e.g. a cache with timestamps that were not parsed, which holds python objects
+        return None
+
+    index = _pd.DatetimeIndex(_np.asarray(columns['timestamp']),name='timestamp')
+    frame = _pd.DataFrame({'relativeTime': _np.asarray(columns['relativeTime']),
+                           'actuatorVoltage': _np.asarray(columns['actuatorVoltage'])},
+                          index=index,columns=['relativeTime','actuatorVoltage'])
+    profiles = ProfileMatrix(columns['profiles'],index)
+
+    return frame,profiles
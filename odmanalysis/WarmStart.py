@@ -0,0 +1,317 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Choice of the initial parameters in sequential curve fitting.
+
+The fit of every profile is started from the result of the fit of the previous
+profile. Without checks, a single bad fit (of a spike or a dropped frame) becomes the
+initial guess of all following fits, which then take many evaluations or fail. A
+WarmStartPolicy checks every fit result before it is used as an initial guess:
+
+    - the chi-square may not be more than maxChiSquareRatio times the median
+      chi-square of the recently accepted fits
+    - the displacement may not jump by more than maxDisplacementJump pixels from the
+      previously accepted fit
+
+Fits that fail these checks, or that do not converge at all, are repeated from the
+initial parameters that were estimated from the template profile. See
+ODMAnalysis.calculatePeakDisplacements for how the results are marked with the
+STATUS_* codes of the FitResults module.
+
+The initial parameters of the next fit are predicted from the accepted fits by a
+predictor:
+
+    - 'previous': the result of the last accepted fit
+    - 'linear': linear extrapolation of the last accepted fits
+    - 'kalman': a constant velocity Kalman filter of the accepted fits
+
+The predictions are made in frame numbers or, if the actuator voltage of every
+profile is known, in volts. The linear and Kalman predictors then keep a separate
+slope for both actuation directions ('forward' where the voltage increases and
+'backward' where it decreases), so that they predict the turn at the end of a sweep.
+"""
+
+import numpy as _np
+
+#the velocity variance of a new Kalman filter, relative to the measurement variance
+_INITIAL_VELOCITY_VARIANCE = 1e6
+
+
+def _direction(step):
+    return 'backward' if step < 0 else 'forward'
+
+
+class PreviousPredictor(object):
+    """
+    Predicts the parameters of the last accepted fit.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last = None
+
+    def predict(self,position):
+        """
+        Returns the predicted parameters at the target position (a frame number or
+        actuator voltage), or None if there are no accepted fits.
+        """
+        return self.last
+
+    def update(self,popt,position):
+        """
+        Adds the parameters of an accepted fit at the target position.
+        """
+        self.last = _np.asarray(popt,dtype=float)
+
+
+class LinearPredictor(object):
+    """
+    Extrapolates the parameters of the last accepted fit with the slope between the
+    last two accepted fits in the same direction.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lastPosition = None
+        self.lastPopt = None
+        self.slopes = {}
+
+    def predict(self,position):
+        if self.lastPopt is None:
+            return None
+        step = position - self.lastPosition
+        slope = self.slopes.get(_direction(step))
+        if slope is None:
+            return self.lastPopt
+        return self.lastPopt + slope*step
+
+    def update(self,popt,position):
+        popt = _np.asarray(popt,dtype=float)
+        if self.lastPopt is not None and position != self.lastPosition:
+            step = position - self.lastPosition
+            self.slopes[_direction(step)] = (popt - self.lastPopt) / step
+        self.lastPosition = position
+        self.lastPopt = popt
+
+
+class KalmanPredictor(object):
+    """
+    Predicts the parameters with a Kalman filter of the position and velocity of every
+    parameter, with white noise acceleration.
+
+    The process noise is relative to the variance of the fitted parameters, so that a
+    single filter gain serves parameters of every scale.
+    """
+
+    def __init__(self,processNoise=1.):
+        """
+        Parameters
+        ----------
+
+        processNoise : float
+            The variance of the change in velocity per frame (or volt), relative to
+            the variance of the fitted parameters. Larger values follow changes in
+            velocity faster, smaller values average out more of the fit noise.
+        """
+        self.processNoise = processNoise
+        self.reset()
+
+    def reset(self):
+        self.lastPosition = None
+        self.direction = None
+        #the state (x,P) of the filter by direction, where x holds the parameters and
+        #their velocities and P is their (relative) covariance matrix
+        self.states = {}
+
+    def _propagate(self,position):
+        """
+        Returns the direction and predicted state (x,P) at the target position.
+        """
+        step = position - self.lastPosition
+        direction = _direction(step) if step != 0 else self.direction
+        x,P = self.states[self.direction]
+        if direction != self.direction:
+            #continue from the current parameters, with the velocity of the last time in this direction
+            previous = self.states.get(direction)
+            if previous is not None:
+                x,P = _np.array([x[0],previous[0][1]]),_np.array([[P[0,0],0],[0,previous[1][1,1]]])
+            else:
+                x,P = _np.array([x[0],_np.zeros_like(x[0])]),_np.array([[P[0,0],0],[0,_INITIAL_VELOCITY_VARIANCE]])
+        F = _np.array([[1.,step],[0.,1.]])
+        Q = self.processNoise * abs(step) * _np.array([[step**2/3.,step/2.],[step/2.,1.]])
+        return direction,_np.dot(F,x),_np.dot(_np.dot(F,P),F.T) + Q
+
+    def predict(self,position):
+        if self.lastPosition is None:
+            return None
+        direction,x,P = self._propagate(position)
+        return x[0]
+
+    def update(self,popt,position):
+        popt = _np.asarray(popt,dtype=float)
+        if self.lastPosition is None:
+            self.direction = 'forward'
+            self.states = {self.direction: (_np.array([popt,_np.zeros_like(popt)]),_np.diag([1.,_INITIAL_VELOCITY_VARIANCE]))}
+        else:
+            direction,x,P = self._propagate(position)
+            gain = P[:,0] / (P[0,0] + 1.)
+            x = x + _np.outer(gain,popt - x[0])
+            P = P - _np.outer(gain,P[0])
+            self.direction = direction
+            self.states[direction] = (x,P)
+        self.lastPosition = position
+
+
+PREDICTORS = {'previous': PreviousPredictor,
+              'linear': LinearPredictor,
+              'kalman': KalmanPredictor}
+
+
+class WarmStartPolicy(object):
+    """
+    The settings of the warm start checks. Use createTracker to apply them to a
+    sequence of fits.
+    """
+
+    def __init__(self,maxChiSquareRatio=10.,maxDisplacementJump=None,predictor='previous',processNoise=1.,historyLength=10,resetAfter=5,warmStartMaxfev=1000):
+        """
+        Parameters
+        ----------
+
+        maxChiSquareRatio : float or None
+            The maximum ratio of the chi-square of a fit and the median chi-square of
+            the last historyLength accepted fits. None disables the check.
+        maxDisplacementJump : float or None
+            The maximum difference in pixels between the displacement of a fit and that
+            of the previously accepted fit. By default a quarter of the width of the
+            fit window.
+        predictor : string
+            The predictor of the initial parameters: 'previous', 'linear' or 'kalman'
+            (see PREDICTORS).
+        processNoise : float
+            The relative process noise of the 'kalman' predictor (see KalmanPredictor).
+        historyLength : integer
+            The number of accepted fits of which the chi-square is remembered.
+        resetAfter : integer
+            The number of consecutive rejected fits after which the accepted fits are
+            forgotten, so that a lasting change (like a real jump of the peak) is
+            accepted again.
+        warmStartMaxfev : integer or None
+            The maximum number of function evaluations per fit. Fits that need more are
+            repeated from the estimated initial parameters, which may use the maxfev
+            of the curve fit arguments until the first fit has been accepted. Only
+            used with the Levenberg-Marquardt solver of curve_fit.
+        """
+        if predictor not in PREDICTORS:
+            raise ValueError("unknown predictor: %s" % predictor)
+        self.maxChiSquareRatio = maxChiSquareRatio
+        self.maxDisplacementJump = maxDisplacementJump
+        self.predictor = predictor
+        self.processNoise = processNoise
+        self.historyLength = historyLength
+        self.resetAfter = resetAfter
+        self.warmStartMaxfev = warmStartMaxfev
+
+    def __repr__(self):
+        return "WarmStartPolicy(%s)" % ", ".join("%s=%r" % item for item in sorted(vars(self).items()))
+
+    def createTracker(self,fitFunction,xdata,p0):
+        """
+        Returns a WarmStartTracker for fitting a sequence of profiles, starting from p0.
+        """
+        return WarmStartTracker(self,fitFunction,xdata,p0)
+
+    def createPredictor(self):
+        """
+        Returns a new predictor of the initial parameters.
+        """
+        if self.predictor == 'kalman':
+            return KalmanPredictor(self.processNoise)
+        return PREDICTORS[self.predictor]()
+
+
+class WarmStartTracker(object):
+    """
+    Keeps track of the accepted fits in a sequence of fits. The position of a fit is
+    its frame number or the actuator voltage of its profile.
+    """
+
+    def __init__(self,policy,fitFunction,xdata,p0):
+        self.policy = policy
+        self.fitFunction = fitFunction
+        self.maxDisplacementJump = policy.maxDisplacementJump
+        if self.maxDisplacementJump is None:
+            self.maxDisplacementJump = (xdata[-1] - xdata[0]) / 4. if len(xdata) else _np.inf
+        self.p0 = _np.asarray(p0,dtype=float)
+        self.predictor = policy.createPredictor()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the accepted fits.
+        """
+        self.predictor.reset()
+        self.nAccepted = 0
+        self.recentChiSquare = []
+        self.lastDisplacement = None
+        self.rejected = 0
+
+    def initialParameters(self,position):
+        """
+        Returns the initial parameters of the fit at the target position.
+        """
+        prediction = self.predictor.predict(position)
+        if prediction is None or not _np.isfinite(prediction).all():
+            return self.p0
+        return prediction
+
+    def isPlausible(self,popt,chiSquare):
+        """
+        Returns True if the target fit result passes the checks of the policy.
+        """
+        if not (_np.isfinite(popt).all() and _np.isfinite(chiSquare)):
+            return False
+        if self.policy.maxChiSquareRatio is not None and self.recentChiSquare:
+            #the chi-square is negative for fits with negative intensities
+            if abs(chiSquare) > self.policy.maxChiSquareRatio * _np.median(_np.abs(self.recentChiSquare)):
+                return False
+        if self.lastDisplacement is not None:
+            if abs(self.fitFunction.getDisplacement(*popt) - self.lastDisplacement) > self.maxDisplacementJump:
+                return False
+        return True
+
+    def accept(self,popt,chiSquare,position):
+        """
+        Uses the target fit result at the target position for the initial parameters
+        of the next fits.
+        """
+        self.predictor.update(popt,position)
+        self.nAccepted += 1
+        self.recentChiSquare = (self.recentChiSquare + [chiSquare])[-self.policy.historyLength:]
+        self.lastDisplacement = self.fitFunction.getDisplacement(*popt)
+        self.rejected = 0
+
+    def reject(self):
+        """
+        Registers a fit that was not accepted.
+        """
+        self.rejected += 1
+        if self.rejected >= self.policy.resetAfter:
+            self.reset()
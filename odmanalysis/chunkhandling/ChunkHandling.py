@@ -20,39 +20,94 @@ Created on Sun Dec 15 13:50:25 2013
 """
 
 import os as _os
+from cStringIO import StringIO as _StringIO
 import pandas as _pd
 from threading import Thread as _Thread
 import multiprocessing as _mp
 import odmanalysis as _odm
-import odmanalysis.gui as _gui
 import odmanalysis.fitfunctions as _ff
+import odmanalysis.AnalysisResults as _AnalysisResults
+import odmanalysis.FitResults as _FitResults
 from odmanalysis.ProgressReporting import BasicProgressReporter as _BasicProgressReporter
 
 
 class ChunkReader(object):
     """
     Reads the target raw ODM data file into a dataframe. For subsequent calls of
-    'read', the file is reopened every time and reading continues where the last read ended.
+    'read_next', reading continues where the last read ended.
+    
+    The reader remembers the byte offset up to which the file has been read and seeks
+    to it directly, so every call only reads and parses the data that has been
+    appended since the previous call. A partially written last line is buffered until
+    it is complete. If the file has been truncated or replaced by a new file, reading
+    starts again from the beginning of the new file.
+    
+    If maxBytes is given, at most maxBytes are read per call, so that the chunks
+    have a bounded size when the reader falls behind (see hasUnreadData).
     """
-    def __init__(self,path):
+    def __init__(self,path,maxBytes=None):
         self.nlinesRead = 0
         self.path = path
         self.dataframes = []
+        self.offset = 0
+        self.partialLine = ''
+        self.headerRead = False
+        self.fileId = None
+        self.maxBytes = maxBytes
+    
+    def hasUnreadData(self):
+        """
+        Returns True if the file is larger than the part that has been read.
+        """
+        try:
+            return _os.path.getsize(self.path) > self.offset
+        except OSError:
+            return False
+    
+    def _readNewLines(self,progressReporter=None):
+        """
+        Returns the complete lines that have been appended to the file since the last
+        read, without the header line.
+        """
+        with open(self.path,'rb') as stream:
+            stat = _os.fstat(stream.fileno())
+            fileId = (stat.st_dev,stat.st_ino)
+            if (self.fileId is not None and fileId != self.fileId) or stat.st_size < self.offset:
+                if (progressReporter):
+                    progressReporter.message("%s has been truncated or replaced, reading from the start" % self.path)
+                self.offset = 0
+                self.partialLine = ''
+                self.headerRead = False
+                self.nlinesRead = 0
+            self.fileId = fileId
+            
+            stream.seek(self.offset)
+            data = stream.read(self.maxBytes if self.maxBytes else -1)
+        
+        self.offset += len(data)
+        
+        lines = (self.partialLine + data).split('\n')
+        self.partialLine = lines.pop()
+        if not self.headerRead and lines:
+            lines = lines[1:]
+            self.headerRead = True
+        lines = [line for line in lines if line.strip()]
+        self.nlinesRead += len(lines)
+        return '\n'.join(lines)
     
     @_BasicProgressReporter(entryMessage="Reading...",exitMessage="")
     def read_next(self,progressReporter=None):
         df = None
         
-        with file(self.path,'r') as stream:
-            reader = _odm.getODMDataReader(stream,chunksize=1000, skipDataRows=self.nlinesRead)
+        newLines = self._readNewLines(progressReporter)
+        if newLines:
+            reader = _odm.getODMDataReader(_StringIO(newLines),chunksize=1000, header=False, dropEmptyProfiles=True)
             
             chunks = [chunk for chunk in reader if chunk is not None]
             if len(chunks) > 0:
                 df = _pd.concat(chunks)
-                df = df[df.intensityProfile.map(len) > 0]
         
         if (df is not None):
-            self.nlinesRead += len(df.index)
             if (progressReporter):
                 progressReporter.message("%i new lines read" % len(df.index))
         
@@ -62,46 +117,94 @@ class ChunkReader(object):
 
 class ChunkWriter(object):
     """
-    Appends an ODM analysis dataframe (chunk) to a csv file.
+    Appends an ODM analysis dataframe (chunk) to a csv file and, optionally, to the
+    binary results next to it (see odmanalysis.AnalysisResults).
     """
-    def __init__(self,outputFile):
+    def __init__(self,outputFile,binaryResults=True):
         self.outputFile = outputFile
         self.outStream = None
+        self.headerWritten = False
+        self.binaryResults = binaryResults
+        self.resultsWriter = None
     
     @_BasicProgressReporter(entryMessage="Writing...",exitMessage="Done")
     def writeDataFrame(self,df):
-        header = False
+        header = not self.headerWritten
         if self.outStream is None:
-            if _os.path.exists(self.outputFile):
+            if header and _os.path.exists(self.outputFile):
                 _os.remove(self.outputFile)
             self.outStream = file(self.outputFile,'a')
-            header = True
+        self.headerWritten = True
         
         exportColumns = ['relativeTime','cycleNumber','direction','actuatorVoltage','displacement','displacement_mp','chiSquare_mp']
         if ('displacement_ref' in df.columns):
             exportColumns +=['displacement_ref','chiSquare_ref']
         df[exportColumns].to_csv(self.outStream,index_label='timestamp',header=header)
+        self.outStream.flush()
+        
+        if self.binaryResults:
+            if self.resultsWriter is None:
+                self.resultsWriter = _AnalysisResults.AnalysisResultsWriter(_AnalysisResults.getBinaryResultsPath(self.outputFile),append=not header)
+            self.resultsWriter.append(df[exportColumns])
+    
+    def close(self):
+        """
+        Flushes and closes the output file. A subsequent write reopens it and appends.
+        """
+        if self.outStream is not None:
+            self.outStream.close()
+            self.outStream = None
+        if self.resultsWriter is not None:
+            self.resultsWriter.close()
+            self.resultsWriter = None
         
 class ChunkedODMDataProcessor(object):
     """
     Instances of this class process chunks of raw odm dataframes.
     """
     
-    def __init__(self,commonPath):
+    def __init__(self,commonPath,movingPeakFitSettings=None,referencePeakFitSettings=None,interactive=True,warmStartPolicy=None,predictByVoltage=False):
         """
         Parameters
         ----------
         
-        inputFile: string
-            path to the file that is being processed
+        commonPath: string
+            path to the folder of the file that is being processed
+        movingPeakFitSettings: ODAFitSettings instance or None
+            The fit settings of the moving peak. If None, they are asked from the
+            user when the first dataframe is processed.
+        referencePeakFitSettings: ODAFitSettings instance or None
+            The fit settings of the reference peak, if there is one.
+        interactive: boolean
+            If False, the gui is never shown and processing a dataframe without
+            moving peak fit settings raises a ValueError.
+        warmStartPolicy: WarmStartPolicy instance or None
+            The checks and the predictor of the initial parameters of the fits. By
+            default a WarmStartPolicy with its default settings (see fitDataFrame).
+        predictByVoltage: boolean
+            If True, the initial parameters are predicted from the actuator voltage and
+            actuation direction instead of the frame number.
         """
         self.commonPath = commonPath
         self.curveFitSettings = None
-        self.movingPeakFitSettings = None
-        self.referencePeakFitSettings = None
+        self.movingPeakFitSettings = movingPeakFitSettings
+        self.referencePeakFitSettings = referencePeakFitSettings
+        self.interactive = interactive
+        self.warmStartPolicy = warmStartPolicy
+        self.predictByVoltage = predictByVoltage
         self.popt_mp_previous = None
         self.popt_ref_previous = None
         self.lastDataFrame = None
+        self.actuationState = None
+    
+    @classmethod
+    def fromFitSettingsFile(cls,commonPath,fitSettingsFile):
+        """
+        Creates a non-interactive processor with the fit settings from a fitSettings.pcl
+        file, as written by FitRawODMData (see odmanalysis.readCurveFitSettings).
+        """
+        settingsDict = _odm.readCurveFitSettings(fitSettingsFile)
+        return cls(commonPath,settingsDict['movingPeakFitSettings'],settingsDict.get('referencePeakFitSettings'),interactive=False)
         
     
     def processDataFrame(self,df):
@@ -125,48 +228,107 @@ class ChunkedODMDataProcessor(object):
         
         print "processing %s - %s" % (df.index.min(),df.index.max())
         
-        if not self.curveFitSettings:
+        self.ensureFitSettings(df)
+        df = fitDataFrame(df,self.movingPeakFitSettings,self.referencePeakFitSettings,self.popt_mp_previous,self.popt_ref_previous,
+                          self.warmStartPolicy,self.predictByVoltage)
+        self.updateInitialParameters(df)
+        return self.finishDataFrame(df)
+    
+    def ensureFitSettings(self,df):
+        """
+        Asks the fit settings from the user, using the profiles of the target dataframe,
+        if they are not known yet, and estimates the initial fit parameters.
+        """
+        if not self.movingPeakFitSettings and not self.interactive:
+            raise ValueError("no fit settings for the moving peak")
+        
+        if not self.movingPeakFitSettings and not self.curveFitSettings:
             globalSettings = _odm.CurveFitSettings.loadFromFileOrCreateDefault('./CurveFitScriptSettings.ini')
             settings = _odm.CurveFitSettings.loadFromFileOrCreateDefault(self.commonPath + '/odmSettings.ini',prototype=globalSettings)
+            import odmanalysis.gui as _gui
             _gui.getSettingsFromUser(settings)
             self.curveFitSettings = settings
             settings.saveToFile()
         
         if not self.movingPeakFitSettings:
             q = _mp.Queue() #it is nescessary to host all gui elements in their own process, because the cannot be spawned from another thread than the main one.
-            p = _mp.Process(target=_getPeakFitSettingsFromUser, args=(q,df,settings))
+            p = _mp.Process(target=_getPeakFitSettingsFromUser, args=(q,df,self.curveFitSettings))
             p.start()
             settingsDict = q.get()
             p.join()
             self.movingPeakFitSettings = settingsDict['movingPeakFitSettings']
             self.referencePeakFitSettings = settingsDict['referencePeakFitSettings']
-           
-        df_movingPeak = _odm.calculatePeakDisplacements(df.intensityProfile, self.movingPeakFitSettings, pInitial = self.popt_mp_previous, factor=100,maxfev=20000)
-        
-        df_movingPeak.rename(columns = lambda columnName: columnName + "_mp",inplace=True)
-        df = df.join(df_movingPeak)
-        self.popt_mp_previous = df.curveFitResult_mp[-1].popt
-        
-        if (self.referencePeakFitSettings is not None):
-            df_referencePeak = _odm.calculatePeakDisplacements(df.intensityProfile, self.referencePeakFitSettings, pInitial = self.popt_ref_previous, factor=100,maxfev=20000)
-            df_referencePeak.rename(columns = lambda columnName: columnName + "_ref",inplace=True)
-            df = df.join(df_referencePeak)
-            self.popt_ref_previous = df.curveFitResult_ref[-1].popt
-            df['displacement'] = df.displacement_mp - df.displacement_ref
-        else:
-            df['displacement'] = df.displacement_mp
-        
-        if (self.lastDataFrame is not None):
-            tail = self.lastDataFrame.iloc[-2:]
-            dfC = _pd.concat([tail,df])
-            _odm.getActuationDirectionAndCycle(dfC,startDirection = tail.direction.iloc[1],startCycleNumber = tail.cycleNumber.iloc[1])
-            df = dfC.iloc[2:]
-        else:
-            _odm.getActuationDirectionAndCycle(df)
+        
+        #fix the profile the fit functions are initialized with, so that the
+        #displacements of all chunks are relative to the same profile
+        for fitSettings in [self.movingPeakFitSettings,self.referencePeakFitSettings]:
+            if fitSettings is not None and getattr(fitSettings,'referenceIntensityProfile',None) is None:
+                fitSettings.referenceIntensityProfile = df.intensityProfile.iloc[0]
+        
+        if self.popt_mp_previous is None:
+            self.popt_mp_previous = _odm.estimateInitialParameters(self.movingPeakFitSettings)
+        if self.referencePeakFitSettings is not None and self.popt_ref_previous is None:
+            self.popt_ref_previous = _odm.estimateInitialParameters(self.referencePeakFitSettings)
+    
+    def updateInitialParameters(self,df):
+        """
+        Uses the last usable fit results of the target fitted dataframe as the initial
+        parameters for the next dataframe.
+        """
+        #the fit results are views on the store of the fits of the whole dataframe
+        last = df.curveFitResult_mp.iloc[-1]
+        self.popt_mp_previous = _FitResults.lastUsableParameters(last.store.slice(0,last.frameIndex + 1),self.popt_mp_previous)
+        if 'curveFitResult_ref' in df.columns:
+            last = df.curveFitResult_ref.iloc[-1]
+            self.popt_ref_previous = _FitResults.lastUsableParameters(last.store.slice(0,last.frameIndex + 1),self.popt_ref_previous)
+    
+    def finishDataFrame(self,df):
+        """
+        Determines the actuation direction and cycle number of a fitted dataframe,
+        continuing from the previous dataframe. Fitted dataframes must be passed in
+        the order of the measurement.
+        """
+        df,self.actuationState = _odm.getActuationDirectionAndCycleIncremental(df,self.actuationState)
         
         self.lastDataFrame = df
         
         return df
+
+
+def fitDataFrame(df,movingPeakFitSettings,referencePeakFitSettings=None,pInitialMovingPeak=None,pInitialReferencePeak=None,warmStartPolicy=None,predictByVoltage=False):
+    """
+    Fits the moving peak and, if there are reference peak fit settings, the reference
+    peak in the intensity profiles of the target dataframe. Implausible fits are
+    repeated from the estimated initial parameters, and the initial parameters of the
+    other fits are predicted from the previous fits by the predictor of the warm
+    start policy (by default a WarmStartPolicy with its default settings). With
+    predictByVoltage, they are predicted from the actuatorVoltage column.
+    
+    Returns
+    -------
+    
+    The dataframe joined with the fit results of the moving peak (columns with suffix
+    '_mp') and reference peak (suffix '_ref') and the 'displacement' column.
+    """
+    if warmStartPolicy is None:
+        warmStartPolicy = _odm.WarmStartPolicy()
+    actuatorVoltage = df.actuatorVoltage if predictByVoltage else None
+    df_movingPeak = _odm.calculatePeakDisplacements(df.intensityProfile, movingPeakFitSettings, pInitial = pInitialMovingPeak, warmStartPolicy=warmStartPolicy,
+                                                    actuatorVoltage=actuatorVoltage, factor=100,maxfev=20000)
+    
+    df_movingPeak.rename(columns = lambda columnName: columnName + "_mp",inplace=True)
+    df = df.join(df_movingPeak)
+    
+    if (referencePeakFitSettings is not None):
+        df_referencePeak = _odm.calculatePeakDisplacements(df.intensityProfile, referencePeakFitSettings, pInitial = pInitialReferencePeak, warmStartPolicy=warmStartPolicy,
+                                                            actuatorVoltage=actuatorVoltage, factor=100,maxfev=20000)
+        df_referencePeak.rename(columns = lambda columnName: columnName + "_ref",inplace=True)
+        df = df.join(df_referencePeak)
+        df['displacement'] = df.displacement_mp - df.displacement_ref
+    else:
+        df['displacement'] = df.displacement_mp
+    
+    return df
             
 
 
@@ -246,6 +408,7 @@ def _getPeakFitSettingsFromUser(q,df,settings):
     Use it by starting a Process (multiprocessing module) that executes this function.
     """
     
+    import odmanalysis.gui as _gui
     movingPeakFitFunction = _ff.createFitFunction(settings.defaultFitFunction)
     movingPeakFitSettings = _gui.getPeakFitSettingsFromUser(df.intensityProfile.iloc[0],movingPeakFitFunction,
                                                        estimatorPromptPrefix="Moving peak:",
@@ -0,0 +1,465 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Streaming analysis of a data file that is being written by a running measurement.
+
+A StreamingPipeline chains three PipelineStage threads: a reader that reads the
+newly appended rows of the data file, a processor that fits them and a writer
+that appends the results to the output file. The stages are connected by bounded
+queues, so that a slow stage either blocks the stages before it (backpressure) or,
+with the 'drop' policy, causes the oldest unprocessed chunks to be discarded.
+Every stage keeps metrics of its latency and queue depth.
+
+With more than one worker, the processor stage hands the chunks to a
+ParallelChunkFitter, which fits them in a pool of processes, and an 'ordering'
+stage puts the fitted chunks back in the order of the measurement before the
+actuation direction and cycle are determined and the results are written.
+"""
+
+import time as _time
+import sys as _sys
+import traceback as _traceback
+import multiprocessing as _mp
+from threading import Thread as _Thread, Lock as _Lock, BoundedSemaphore as _BoundedSemaphore
+from Queue import Queue as _Queue, Full as _Full, Empty as _Empty
+from ChunkHandling import fitDataFrame as _fitDataFrame
+
+#sentinel that is passed through the queues to stop the stages
+_STOP = object()
+
+
+class _StreamItem(object):
+    """
+    A value that is passed between stages, with the time at which the data it
+    originates from was announced to the pipeline.
+    """
+    __slots__ = ('value','createdTime')
+
+    def __init__(self,value,createdTime):
+        self.value = value
+        self.createdTime = createdTime
+
+
+class StageMetrics(object):
+    """
+    Thread-safe counters of the items that went through a pipeline stage.
+
+    Latencies are in seconds. The waiting time is the time an item spent in the
+    input queue of the stage, the processing time is the time the stage action took
+    and the end-to-end latency is the time from the moment the data was announced to
+    the pipeline until the stage finished with it.
+    """
+    def __init__(self):
+        self._lock = _Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lastError = None
+        self.totalWaitingTime = 0.
+        self.totalProcessingTime = 0.
+        self.maxProcessingTime = 0.
+        self.lastEndToEndLatency = None
+        self.maxEndToEndLatency = 0.
+
+    def record(self,waitingTime,processingTime,endToEndLatency):
+        with self._lock:
+            self.processed += 1
+            self.totalWaitingTime += waitingTime
+            self.totalProcessingTime += processingTime
+            self.maxProcessingTime = max(self.maxProcessingTime,processingTime)
+            self.lastEndToEndLatency = endToEndLatency
+            self.maxEndToEndLatency = max(self.maxEndToEndLatency,endToEndLatency)
+
+    def recordDrop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def recordError(self,error):
+        with self._lock:
+            self.errors += 1
+            self.lastError = repr(error)
+
+    def toDict(self):
+        with self._lock:
+            n = max(self.processed,1)
+            return {'processed': self.processed,
+                    'dropped': self.dropped,
+                    'errors': self.errors,
+                    'lastError': self.lastError,
+                    'meanWaitingTime': self.totalWaitingTime / n,
+                    'meanProcessingTime': self.totalProcessingTime / n,
+                    'maxProcessingTime': self.maxProcessingTime,
+                    'lastEndToEndLatency': self.lastEndToEndLatency,
+                    'maxEndToEndLatency': self.maxEndToEndLatency}
+
+
+class PipelineStage(_Thread):
+    """
+    Thread that applies an action to every item of its input queue and puts the
+    results on its output queue.
+
+    Exceptions raised by the action are printed and counted in the metrics, after
+    which the stage continues with the next item. The stage stops when it receives
+    the stop sentinel, after it has called its onStop callable and passed the
+    sentinel on to its output queue.
+    
+    While the action runs, the item it was called for is available as currentItem.
+    """
+
+    def __init__(self,name,action,inputQueue,outputQueue=None,policy='block',iterate=False,onStop=None,discardNoneValues=True):
+        """
+        Parameters
+        ----------
+
+        name: string
+            The name of the stage in the metrics.
+        action: callable
+            Called with every input value. Its return value is put on the output queue.
+        inputQueue: Queue.Queue
+            The queue to take the input values from.
+        outputQueue: Queue.Queue or None
+            The queue to put the results on.
+        policy: 'block' or 'drop'
+            What to do if the output queue is full. 'block' waits until there is room,
+            'drop' discards the oldest item in the output queue.
+        iterate: boolean
+            If True, the action returns an iterable of which every element is put on
+            the output queue separately.
+        onStop: callable or None
+            Called without arguments when the stage stops.
+        discardNoneValues: boolean
+            If True, None results are not put on the output queue.
+        """
+        super(PipelineStage,self).__init__(name=name)
+        if policy not in ('block','drop'):
+            raise ValueError("policy must be 'block' or 'drop'")
+        self.daemon = True
+        self.action = action
+        self.inputQueue = inputQueue
+        self.outputQueue = outputQueue
+        self.policy = policy
+        self.iterate = iterate
+        self.onStop = onStop
+        self.discardNoneValues = discardNoneValues
+        self.metrics = StageMetrics()
+        self.currentItem = None
+
+    def run(self):
+        while True:
+            item,queuedTime = self.inputQueue.get()
+            if item is _STOP:
+                if self.onStop is not None:
+                    self.onStop()
+                if self.outputQueue is not None:
+                    self.outputQueue.put((_STOP,None))
+                break
+
+            start = _time.time()
+            self.currentItem = item
+            try:
+                value = self.action(item.value)
+                results = value if self.iterate else [value]
+                for result in results:
+                    self.emit(_StreamItem(result,item.createdTime))
+            except Exception as e:
+                self.metrics.recordError(e)
+                _traceback.print_exc(file=_sys.stderr)
+            self.currentItem = None
+            end = _time.time()
+            self.metrics.record(start - queuedTime,end - start,end - item.createdTime)
+
+    def emit(self,item):
+        if self.outputQueue is None or (item.value is None and self.discardNoneValues):
+            return
+
+        if self.policy == 'block':
+            self.outputQueue.put((item,_time.time()))
+            return
+
+        while True:
+            try:
+                self.outputQueue.put_nowait((item,_time.time()))
+                return
+            except _Full:
+                try:
+                    self.outputQueue.get_nowait()
+                    self.metrics.recordDrop()
+                except _Empty:
+                    pass
+
+
+def _fitChunkInWorker(args):
+    try:
+        return _fitDataFrame(*args),None
+    except Exception:
+        return None,_traceback.format_exc()
+
+
+class ParallelChunkFitter(object):
+    """
+    Fits chunks of raw ODM data in a pool of worker processes and returns the fitted
+    chunks in the order in which they were submitted.
+    
+    Every chunk is fitted starting from the fit results of the last chunk that had
+    completed when it was submitted. The number of chunks that are being fitted or
+    waiting to be put back in order is bounded, so that submit blocks when the
+    workers cannot keep up.
+    
+    The results of the submitted chunks are put on submittedQueue in the order of
+    submission, and collect waits for them in that order.
+    
+    The worker processes are started by start, which should be called before any
+    other threads are started: processes that are forked while another thread holds
+    a lock (of sys.stdout, for instance) can deadlock.
+    """
+    
+    def __init__(self,dataProcessor,nWorkers,maxChunksInProgress=None,chunkTimeout=None):
+        """
+        Parameters
+        ----------
+        
+        dataProcessor: ChunkedODMDataProcessor instance
+            The processor that holds the fit settings and the state of the actuation
+            direction and cycle detection.
+        nWorkers: integer
+            The number of worker processes, -1 for all cpu's.
+        maxChunksInProgress: integer or None
+            The maximum number of chunks that have been submitted but not collected.
+            Twice the number of workers by default.
+        chunkTimeout: float or None
+            The maximum time in seconds that collect waits for a chunk to be fitted,
+            after which the chunk is skipped. None waits forever, which hangs if a
+            worker process is killed.
+        """
+        if nWorkers < 0:
+            nWorkers = _mp.cpu_count()
+        self.dataProcessor = dataProcessor
+        self.nWorkers = nWorkers
+        self.maxChunksInProgress = maxChunksInProgress if maxChunksInProgress else 2*nWorkers
+        self.chunkTimeout = chunkTimeout
+        self.submittedQueue = _Queue()
+        self.pool = None
+        
+        self._slots = _BoundedSemaphore(self.maxChunksInProgress)
+        self._lock = _Lock()
+        self._nSubmitted = 0
+        self._lastCompleted = -1
+        self._nLost = 0
+    
+    def start(self):
+        if self.pool is None:
+            self.pool = _mp.Pool(self.nWorkers)
+    
+    def submit(self,df,createdTime=None):
+        """
+        Submits a chunk for fitting. Blocks while the maximum number of chunks is in
+        progress. The (sequenceNumber,AsyncResult) of the chunk is put on
+        submittedQueue.
+        """
+        self.dataProcessor.ensureFitSettings(df)
+        self.start()
+        
+        self._slots.acquire()
+        sequenceNumber = self._nSubmitted
+        self._nSubmitted += 1
+        with self._lock:
+            args = (df,self.dataProcessor.movingPeakFitSettings,self.dataProcessor.referencePeakFitSettings,
+                    self.dataProcessor.popt_mp_previous,self.dataProcessor.popt_ref_previous,
+                    self.dataProcessor.warmStartPolicy,self.dataProcessor.predictByVoltage)
+        
+        createdTime = _time.time() if createdTime is None else createdTime
+        #the callback only passes on the initial parameters, the results are collected in order by collect
+        callback = lambda result: self._completed(sequenceNumber,result)
+        asyncResult = self.pool.apply_async(_fitChunkInWorker,(args,),callback=callback)
+        self.submittedQueue.put((_StreamItem((sequenceNumber,asyncResult),createdTime),_time.time()))
+    
+    def _completed(self,sequenceNumber,result):
+        df,error = result
+        if df is not None:
+            with self._lock:
+                if sequenceNumber > self._lastCompleted:
+                    self.dataProcessor.updateInitialParameters(df)
+                    self._lastCompleted = sequenceNumber
+    
+    def collect(self,value):
+        """
+        Takes a (sequenceNumber,AsyncResult) tuple from submittedQueue, waits for the
+        chunk to be fitted and returns the finished chunk. Raises a RuntimeError if
+        the chunk failed to fit or was not fitted within chunkTimeout, in which case
+        it is skipped.
+        """
+        sequenceNumber,asyncResult = value
+        try:
+            df,error = asyncResult.get(self.chunkTimeout)
+        except _mp.TimeoutError:
+            self._nLost += 1
+            df,error = None,"the chunk was not fitted within %s seconds" % self.chunkTimeout
+        except Exception:
+            #raised in the pool, e.g. when the result cannot be pickled
+            df,error = None,_traceback.format_exc()
+        finally:
+            self._slots.release()
+        if error is not None:
+            raise RuntimeError("fitting chunk %i failed:\n%s" % (sequenceNumber,error))
+        return self.dataProcessor.finishDataFrame(df)
+    
+    def close(self):
+        """
+        Waits for the submitted chunks to be fitted and stops the worker processes.
+        The workers are terminated instead if a chunk was not fitted within
+        chunkTimeout, because the pool would wait for it forever.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            if self._nLost:
+                self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+class StreamingPipeline(object):
+    """
+    Reads, processes and writes the data that is appended to a data file, in three
+    threads that are connected by bounded queues.
+
+    Call notify whenever the data file may have changed, for instance from a watchdog
+    event handler or a polling loop. Notifications that arrive while the reader is
+    busy are coalesced. Call stop to process the remaining data, flush the writer and
+    stop the threads.
+
+    The delay between a notification and the moment the corresponding rows have been
+    written is bounded by the queue size, the size of the chunks (see
+    ChunkReader.maxBytes) and the processing time per chunk, provided the processor
+    keeps up on average or the 'drop' policy is used.
+    """
+
+    def __init__(self,chunkReader,dataProcessor,chunkWriter,queueSize=4,policy='block',nWorkers=1,chunkTimeout=None):
+        """
+        Parameters
+        ----------
+
+        chunkReader: ChunkReader instance
+            The reader of the data file.
+        dataProcessor: ChunkedODMDataProcessor instance
+            The processor of the chunks, which should not need user interaction.
+        chunkWriter: ChunkWriter instance
+            The writer of the results. It is closed when the pipeline stops.
+        queueSize: integer
+            The maximum number of chunks in each of the queues between the stages.
+        policy: 'block' or 'drop'
+            What the reader does when the queue of the processor is full. 'block'
+            (default) waits, so that new data accumulates in the data file and is read
+            as a larger chunk later. 'drop' discards the oldest chunk in the queue to
+            keep the delay bounded when the processor cannot keep up.
+        nWorkers: integer
+            The number of processes to fit with (-1 for all cpu's). If not 1, the
+            chunks are fitted concurrently by a ParallelChunkFitter.
+        chunkTimeout: float or None
+            The maximum time in seconds to wait for a chunk to be fitted by the
+            ParallelChunkFitter, after which it is skipped. None waits forever.
+        """
+        self.chunkReader = chunkReader
+        self.dataProcessor = dataProcessor
+        self.chunkWriter = chunkWriter
+
+        self.notificationQueue = _Queue(1)
+        self.rawDataQueue = _Queue(queueSize)
+        self.resultQueue = _Queue(queueSize)
+
+        self.readerStage = PipelineStage('reader',self._readAvailableChunks,self.notificationQueue,self.rawDataQueue,policy=policy,iterate=True)
+        self.writerStage = PipelineStage('writer',chunkWriter.writeDataFrame,self.resultQueue,onStop=chunkWriter.close)
+        if nWorkers == 1:
+            self.fitter = None
+            self.processorStage = PipelineStage('processor',dataProcessor.processDataFrame,self.rawDataQueue,self.resultQueue)
+            self.stages = [self.readerStage,self.processorStage,self.writerStage]
+        else:
+            self.fitter = ParallelChunkFitter(dataProcessor,nWorkers,chunkTimeout=chunkTimeout)
+            #the pool is closed when all chunks have been collected, which does not wait forever for lost chunks
+            self.processorStage = PipelineStage('processor',self._submitChunk,self.rawDataQueue,self.fitter.submittedQueue)
+            self.orderingStage = PipelineStage('ordering',self.fitter.collect,self.fitter.submittedQueue,self.resultQueue,onStop=self.fitter.close)
+            self.stages = [self.readerStage,self.processorStage,self.orderingStage,self.writerStage]
+        self.startTime = None
+
+    def _readAvailableChunks(self,value):
+        while True:
+            df = self.chunkReader.read_next()
+            if df is not None:
+                yield df
+            if not self.chunkReader.hasUnreadData():
+                break
+
+    def _submitChunk(self,df):
+        self.fitter.submit(df,self.processorStage.currentItem.createdTime)
+
+    def start(self):
+        self.startTime = _time.time()
+        if self.fitter is not None:
+            self.fitter.start()
+        for stage in self.stages:
+            stage.start()
+
+    def notify(self):
+        """
+        Announces that the data file may have changed. Never blocks.
+        """
+        now = _time.time()
+        try:
+            self.notificationQueue.put_nowait((_StreamItem(None,now),now))
+        except _Full:
+            pass
+
+    def stop(self,timeout=None):
+        """
+        Reads and processes the data that has not been read yet, writes all results,
+        closes the writer and stops the threads.
+
+        Returns
+        -------
+
+        True if all stages stopped within the timeout.
+        """
+        now = _time.time()
+        self.notificationQueue.put((_StreamItem(None,now),now))
+        self.notificationQueue.put((_STOP,None))
+        deadline = None if timeout is None else _time.time() + timeout
+        for stage in self.stages:
+            stage.join(None if deadline is None else max(deadline - _time.time(),0))
+        return not any(stage.is_alive() for stage in self.stages)
+
+    def isRunning(self):
+        return any(stage.is_alive() for stage in self.stages)
+
+    def getMetrics(self):
+        """
+        Returns a dictionary with the metrics of every stage, the depth of the queue in
+        front of it and the end-to-end latency of the pipeline, which is that of the
+        writer stage.
+        """
+        stages = {}
+        for stage in self.stages:
+            metrics = stage.metrics.toDict()
+            metrics['queueDepth'] = stage.inputQueue.qsize()
+            metrics['queueSize'] = stage.inputQueue.maxsize
+            stages[stage.name] = metrics
+
+        writerMetrics = stages[self.writerStage.name]
+        return {'uptime': _time.time() - self.startTime if self.startTime else 0.,
+                'rowsRead': self.chunkReader.nlinesRead,
+                'bytesRead': self.chunkReader.offset,
+                'dropped': sum(metrics['dropped'] for metrics in stages.values()),
+                'lastEndToEndLatency': writerMetrics['lastEndToEndLatency'],
+                'maxEndToEndLatency': writerMetrics['maxEndToEndLatency'],
+                'stages': stages}
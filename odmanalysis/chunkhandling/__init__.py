@@ -17,4 +17,5 @@
 
 #odmanalysis.fitfunctions
 
-from .ChunkHandling import *
\ No newline at end of file
+from .ChunkHandling import *
+from .Streaming import *
@@ -0,0 +1,236 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Batched Levenberg-Marquardt least-squares fitting of many intensity profiles at once.
+
+The fit functions are evaluated for all profiles in a single call by broadcasting:
+x has shape (1, n_pixels) and every parameter has shape (n_profiles, 1). This works
+for every fit function whose __call__ only uses numpy operations (Gaussian, Harmonic,
+Jaapian, DualHarmonic, Sinc, Merlijnian and the spline functions), but not for
+BoundedSpline.
+"""
+
+from __future__ import division as _division
+import numpy as _np
+
+
+class BatchCurveFitResult(object):
+    """
+    Results of batchCurveFit. All attributes are arrays with one entry per profile.
+
+    Attributes
+    ----------
+
+    popt: (n_profiles x n_parameters) array
+        The optimal parameters.
+    pcov: (n_profiles x n_parameters x n_parameters) array
+        The estimated covariance of popt, scaled like scipy.optimize.curve_fit does.
+        Filled with inf where it cannot be estimated.
+    chiSquare: (n_profiles,) array
+        The chi-square statistic of every fit, as calculated by scipy.stats.chisquare.
+    converged: (n_profiles,) boolean array
+        True for the profiles for which the fit converged within maxIterations.
+    nIterations: integer
+        The number of iterations that were run.
+    nfev: integer
+        The number of (batched) function evaluations, including those for the
+        finite-difference jacobian.
+    """
+
+    def __init__(self,popt,pcov,chiSquare,converged,nIterations,nfev):
+        self.popt = popt
+        self.pcov = pcov
+        self.chiSquare = chiSquare
+        self.converged = converged
+        self.nIterations = nIterations
+        self.nfev = nfev
+
+
+def evaluateBatch(fitFunction,xdata,P):
+    """
+    Evaluates fitFunction for every parameter set in P.
+
+    Parameters
+    ----------
+
+    fitFunction: FitFunction
+        The fit function to evaluate.
+    xdata: (n_pixels,) array
+        The x-values.
+    P: (n_profiles x n_parameters) array
+        One parameter set per row.
+
+    Returns
+    -------
+
+    A (n_profiles x n_pixels) array with the function values.
+    """
+    x = _np.asarray(xdata,dtype=float)[_np.newaxis,:]
+    y = fitFunction(x,*[P[:,j:j+1] for j in range(P.shape[1])])
+    return _np.broadcast_to(y,(P.shape[0],x.shape[1]))
+
+
+def _finiteDifferenceJacobian(fitFunction,xdata,P,f):
+    """
+    Forward-difference jacobian of shape (n_profiles x n_pixels x n_parameters),
+    with the same step sizes as MINPACK uses in scipy.optimize.leastsq.
+    """
+    eps = _np.sqrt(_np.finfo(float).eps)
+    J = _np.empty(f.shape + (P.shape[1],))
+    for j in range(P.shape[1]):
+        h = eps * _np.abs(P[:,j])
+        h[h == 0] = eps
+        Ph = P.copy()
+        Ph[:,j] += h
+        J[:,:,j] = (evaluateBatch(fitFunction,xdata,Ph) - f) / h[:,_np.newaxis]
+    return J
+
+
+def _solveDamped(A,g,damping):
+    """
+    Solves (A + damping*diag(A)) delta = g for every profile.
+    """
+    diagonal = _np.einsum('nii->ni',A)
+    Ad = A.copy()
+    idx = _np.arange(A.shape[1])
+    Ad[:,idx,idx] += damping[:,_np.newaxis] * _np.maximum(diagonal,1e-12)
+    try:
+        return _np.linalg.solve(Ad,g[:,:,_np.newaxis])[:,:,0]
+    except _np.linalg.LinAlgError:
+        return _np.einsum('nij,nj->ni',_np.linalg.pinv(Ad),g)
+
+
+def batchCurveFit(fitFunction,xdata,ydata,p0,maxIterations=200,ftol=1.49012e-8,xtol=1.49012e-8,jacobian=None):
+    """
+    Fits fitFunction to many profiles at once with a batched Levenberg-Marquardt algorithm.
+
+    Every profile has its own damping parameter and convergence state, profiles that
+    have converged are not updated anymore.
+
+    Parameters
+    ----------
+
+    fitFunction: FitFunction
+        The fit function. Its __call__ method must support broadcasting (see the module
+        documentation).
+    xdata: (n_pixels,) array
+        The x-values, shared by all profiles.
+    ydata: (n_profiles x n_pixels) array
+        The profiles to fit.
+    p0: (n_parameters,) or (n_profiles x n_parameters) array
+        The initial parameters, either shared by all profiles or one set per profile.
+    maxIterations: integer
+        The maximum number of iterations.
+    ftol: float
+        Relative tolerance on the sum of squares.
+    xtol: float
+        Relative tolerance on the parameters.
+    jacobian: callable or None
+        Function jacobian(xdata,*params) that returns the derivatives with respect to all
+        parameters stacked along the last axis, supporting the same broadcasting as
+        fitFunction. If None, a forward-difference approximation is used.
+
+    Returns
+    -------
+
+    A BatchCurveFitResult.
+    """
+    xdata = _np.asarray(xdata,dtype=float)
+    Y = _np.asarray(ydata,dtype=float)
+    nProfiles,nPixels = Y.shape
+    P = _np.array(_np.broadcast_to(_np.asarray(p0,dtype=float),(nProfiles,len(_np.atleast_2d(p0)[0]))))
+    nParameters = P.shape[1]
+
+    f = _np.array(evaluateBatch(fitFunction,xdata,P))
+    nfev = 1
+    r = Y - f
+    cost = (r**2).sum(axis=1)
+
+    damping = _np.full(nProfiles,1e-3)
+    active = _np.ones(nProfiles,dtype=bool)
+    converged = _np.zeros(nProfiles,dtype=bool)
+
+    iteration = 0
+    while iteration < maxIterations and active.any():
+        iteration += 1
+        idx = _np.flatnonzero(active)
+        Pa = P[idx]
+
+        if jacobian is not None:
+            J = _np.broadcast_to(jacobian(xdata[_np.newaxis,:],*[Pa[:,j:j+1] for j in range(nParameters)]),(len(idx),nPixels,nParameters))
+        else:
+            J = _finiteDifferenceJacobian(fitFunction,xdata,Pa,f[idx])
+            nfev += nParameters
+
+        #matmul uses blas for the products, einsum does not
+        A = _np.matmul(J.transpose(0,2,1),J)
+        g = _np.matmul(r[idx][:,_np.newaxis,:],J)[:,0]
+
+        delta = _solveDamped(A,g,damping[idx])
+        Pnew = Pa + delta
+        fnew = evaluateBatch(fitFunction,xdata,Pnew)
+        nfev += 1
+        rnew = Y[idx] - fnew
+        costNew = (rnew**2).sum(axis=1)
+
+        accepted = _np.isfinite(costNew) & (costNew <= cost[idx])
+        acceptedIdx = idx[accepted]
+        relativeReduction = (cost[idx] - costNew) / _np.maximum(cost[idx],_np.finfo(float).tiny)
+        smallStep = _np.sqrt((delta**2).sum(axis=1)) <= xtol * (_np.sqrt((Pa**2).sum(axis=1)) + xtol)
+        done = accepted & ((relativeReduction <= ftol) | smallStep)
+
+        P[acceptedIdx] = Pnew[accepted]
+        f[acceptedIdx] = fnew[accepted]
+        r[acceptedIdx] = rnew[accepted]
+        cost[acceptedIdx] = costNew[accepted]
+
+        damping[acceptedIdx] /= 10.
+        rejectedIdx = idx[~accepted]
+        damping[rejectedIdx] *= 10.
+
+        #a rejected step with a negligible size also means that no progress can be made
+        stalled = ~accepted & smallStep
+        diverged = ~accepted & ~smallStep & (damping[idx] > 1e16)
+        converged[idx[done | stalled]] = True
+        active[idx[done | stalled | diverged]] = False
+
+    pcov = estimateCovariance(fitFunction,xdata,P,f,cost,nPixels,jacobian)
+    chiSquare = (r**2 / f).sum(axis=1)
+
+    return BatchCurveFitResult(P,pcov,chiSquare,converged,iteration,nfev)
+
+
+def estimateCovariance(fitFunction,xdata,P,f,cost,nPixels,jacobian):
+    """
+    Estimates the covariance of the parameters P of every profile from the jacobian at P,
+    scaled with the sum of squared residuals cost like scipy.optimize.curve_fit does.
+    """
+    nProfiles,nParameters = P.shape
+    if jacobian is not None:
+        J = _np.broadcast_to(jacobian(xdata[_np.newaxis,:],*[P[:,j:j+1] for j in range(nParameters)]),(nProfiles,nPixels,nParameters))
+    else:
+        J = _finiteDifferenceJacobian(fitFunction,xdata,P,f)
+    A = _np.matmul(J.transpose(0,2,1),J)
+
+    pcov = _np.full((nProfiles,nParameters,nParameters),_np.inf)
+    if nPixels <= nParameters:
+        return pcov
+
+    invertible = _np.abs(_np.linalg.det(A)) > 0
+    if invertible.any():
+        scale = cost[invertible] / (nPixels - nParameters)
+        pcov[invertible] = _np.linalg.inv(A[invertible]) * scale[:,_np.newaxis,_np.newaxis]
+    return pcov
@@ -0,0 +1,114 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Non-iterative sub-pixel displacement estimation by FFT cross-correlation.
+
+The shift of every profile with respect to a reference profile is the position of
+the maximum of their cross-correlation. The cross-correlation of all profiles is
+computed with a single FFT of the profile matrix. Its maximum is first located on
+whole pixels and then refined on successively finer grids by evaluating the
+upsampled cross-correlation directly from the cross-power spectrum (a matrix-
+multiply DFT, as in Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008)).
+"""
+
+from __future__ import division as _division
+import numpy as _np
+
+_ZOOM = 10
+
+
+def _fftLength(n):
+    return int(2**_np.ceil(_np.log2(max(n,2))))
+
+
+def crossCorrelationShifts(xdata,profiles,reference,upsampleFactor=100,shiftRange=None):
+    """
+    Calculates the shift of every profile with respect to a reference profile.
+
+    Parameters
+    ----------
+
+    xdata: (n_pixels,) array
+        The pixel positions of the profiles, which must be consecutive whole pixels.
+    profiles: (n_profiles x n_pixels) array
+        The profiles, usually the cropped rows of a ProfileMatrix.
+    reference: 1D array
+        The reference profile, with a value for every pixel from 0 onwards.
+    upsampleFactor: integer
+        The shifts are located on a grid of 1/upsampleFactor pixel, after which the
+        maximum is refined by parabolic interpolation.
+    shiftRange: tuple of 2 integers or None
+        The range of whole-pixel shifts to search. By default all shifts for which the
+        reference covers xdata, or -n_pixels/4 to n_pixels/4 if there are fewer than 3.
+
+    Returns
+    -------
+
+    A (n_profiles,) array with the shift of every profile, such that
+    profile(x) ~ reference(x - shift).
+    """
+    xdata = _np.asarray(xdata)
+    profiles = _np.atleast_2d(_np.asarray(profiles,dtype=float))
+    reference = _np.asarray(reference,dtype=float)
+    nProfiles,nPixels = profiles.shape
+    if nPixels < 2 or _np.any(_np.diff(xdata) != 1) or xdata[0] != int(xdata[0]):
+        raise ValueError("xdata must be consecutive whole pixels")
+    first,last = int(xdata[0]),int(xdata[-1])
+
+    if shiftRange is None:
+        shiftRange = (last - (len(reference) - 1),first)
+        if shiftRange[1] - shiftRange[0] < 2:
+            shiftRange = (-(nPixels//4),nPixels//4)
+    minShift,maxShift = shiftRange
+
+    n = _fftLength(max(len(reference) + max(maxShift - first,0),last - minShift,last) + 1)
+    padded = _np.zeros((nProfiles,n))
+    padded[:,first:last + 1] = profiles - profiles.mean(axis=1)[:,_np.newaxis]
+    paddedReference = _np.zeros(n)
+    paddedReference[:len(reference)] = reference - reference.mean()
+
+    crossPower = _np.fft.rfft(padded,axis=1) * _np.conj(_np.fft.rfft(paddedReference))
+
+    #whole-pixel maximum
+    shifts = _np.arange(minShift,maxShift + 1)
+    correlation = _np.fft.irfft(crossPower,n,axis=1)[:,shifts % n]
+    best = shifts[correlation.argmax(axis=1)].astype(float)
+
+    #refinement on successively finer grids, from the one-sided spectrum of a real signal
+    k = _np.arange(crossPower.shape[1])
+    weights = _np.full(len(k),2.)
+    weights[0] = 1
+    if n % 2 == 0:
+        weights[-1] = 1
+    omega = 2*_np.pi*k/n
+    weightedPower = crossPower * weights
+
+    step = 1.
+    offsets = _np.arange(-_ZOOM,_ZOOM + 1)
+    while step > 1./upsampleFactor:
+        step = max(step/_ZOOM,1./upsampleFactor)
+        kernel = _np.exp(1j*_np.outer(omega,offsets*step))
+        upsampled = (weightedPower * _np.exp(1j*_np.outer(best,omega))).dot(kernel).real
+        i = _np.clip(upsampled.argmax(axis=1),1,len(offsets) - 2)
+        rows = _np.arange(nProfiles)
+        left,center,right = upsampled[rows,i - 1],upsampled[rows,i],upsampled[rows,i + 1]
+        best = best + offsets[i]*step
+        if step <= 1./upsampleFactor:
+            curvature = left - 2*center + right
+            fraction = _np.where(curvature < 0,0.5*(left - right) / _np.where(curvature < 0,curvature,-1),0)
+            best = best + _np.clip(fraction,-0.5,0.5)*step
+
+    return best
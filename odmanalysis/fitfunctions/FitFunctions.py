@@ -23,8 +23,12 @@ import numpy as np
 
 from scipy.interpolate import InterpolatedUnivariateSpline
 from scipy.ndimage.filters import gaussian_filter
+from scipy.optimize import curve_fit
 from scipy import vectorize
 from collections import OrderedDict
+from .TemplateMatching import SplineTemplate, matchTemplate, estimateParameters, solveScaleAndOffset
+from .BatchFitting import batchCurveFit, estimateCovariance
+from .CrossCorrelation import crossCorrelationShifts
 
 class EstimatorDefinition(object):
     def __init__(self,id,promptMessage=None):
@@ -52,6 +56,22 @@ class FitFunction(object):
     def __call__(self,x,intensityProfile,peakCoordinates, lowerValleyCoordinates, upperValleyCoordinates, minBound,maxBound):
         raise NotImplementedError("override this method")
         
+    """
+    Returns the derivatives of the fit-function with respect to all parameters,
+    stacked along the last axis, or None if the fit-function has no analytic
+    derivatives. Override with a method jacobian(self,x,*parameters) that supports
+    the same broadcasting as __call__.
+    """
+    jacobian = None
+    
+    """
+    A dedicated fitting engine for many profiles, or None if the profiles are fitted
+    with curve_fit. Override with a method
+    fitProfiles(self,xdata,profiles,p0,progressCallback=None,**curveFitKwargs) that
+    returns a (popt,pcov,chiSquare) tuple for every profile.
+    """
+    fitProfiles = None
+    
     """
     Returns the name of this fit function
     """
@@ -72,6 +92,18 @@ class FitFunction(object):
         return estimators
 
 
+def _stackDerivatives(*derivatives):
+    """
+    Stacks the derivatives with respect to every parameter along a new last axis,
+    broadcasting constants to the shape of the others.
+    """
+    shape = np.broadcast(*derivatives).shape
+    jacobian = np.empty(shape + (len(derivatives),))
+    for i,derivative in enumerate(derivatives):
+        jacobian[...,i] = derivative
+    return jacobian
+
+
 class DisplacementFitFunction(FitFunction):
     def __init__(self):
         super(DisplacementFitFunction,self).__init__()
@@ -102,6 +134,16 @@ class Gaussian(DisplacementFitFunction,BeamWidthFitFunction):
         
     def __call__(self,x,mu,sigma,A,a1,a0):
         return A*(1/(sigma * np.sqrt(2*np.pi)) * np.exp(-1/2 * ((x-mu)/sigma)**2)) + 0.003*a1*(x-mu) + a0
+    
+    def jacobian(self,x,mu,sigma,A,a1,a0):
+        k = -1/2 #same exponent factor as in __call__
+        u = (x-mu)/sigma
+        peak = 1/(sigma * np.sqrt(2*np.pi)) * np.exp(k * u**2)
+        return _stackDerivatives(-A*peak*2*k*u/sigma - 0.003*a1,
+                                 -A*peak*(1 + 2*k*u**2)/sigma,
+                                 peak,
+                                 0.003*(x-mu),
+                                 1)
         
     
     def getName(self):
@@ -120,6 +162,15 @@ class Harmonic(DisplacementFitFunction):
      
     def __call__(self,x,x0,A,f,a1,a0):
         return A * np.cos(2.*np.pi*f*(x-x0)) + a1 * (1 + 0.0003*x) + a0
+    
+    def jacobian(self,x,x0,A,f,a1,a0):
+        phase = 2.*np.pi*f*(x-x0)
+        sine = 2.*np.pi*A*np.sin(phase)
+        return _stackDerivatives(f*sine,
+                                 np.cos(phase),
+                                 -(x-x0)*sine,
+                                 1 + 0.0003*x,
+                                 1)
                   
     def estimateInitialParameters(self,intensityProfile,peakCoordinates, lowerValleyCoordinates, upperValleyCoordinates, minBound,maxBound):
         return {'x0': peakCoordinates[0],
@@ -146,6 +197,19 @@ class Merlijnian(DisplacementFitFunction, BeamWidthFitFunction):
     
     def __call__(self,x,a1,a2,a3,a4,a5,a6):
         return -(1/(a1+(x-a2)**2)+1/(a1+(x-a3)**2)) * a4 * (x-a5)**2 * (1. + 0.0003*x) + a6        
+    
+    def jacobian(self,x,a1,a2,a3,a4,a5,a6):
+        d2 = a1+(x-a2)**2
+        d3 = a1+(x-a3)**2
+        lorentzians = 1/d2 + 1/d3
+        slope = 1. + 0.0003*x
+        envelope = a4 * (x-a5)**2 * slope
+        return _stackDerivatives(envelope * (1/d2**2 + 1/d3**2),
+                                 -envelope * 2*(x-a2)/d2**2,
+                                 -envelope * 2*(x-a3)/d3**2,
+                                 -lorentzians * (x-a5)**2 * slope,
+                                 lorentzians * a4 * 2*(x-a5) * slope,
+                                 1)
         
     def estimateInitialParameters(self,intensityProfile,peakCoordinates, lowerValleyCoordinates, upperValleyCoordinates, minBound,maxBound):
         return {'a1': np.sqrt(peakCoordinates[0]-lowerValleyCoordinates[0]),
@@ -174,6 +238,27 @@ class Jaapian(DisplacementFitFunction, BeamWidthFitFunction):
             return (1-contrast)+contrast * (1-(Gamma**2)/4 * 1/((Gamma/2)**2 + (x - w/2 - x0)**2))*(1-(Gamma**2)/4 * 1/((Gamma/2)**2 + (x + w/2 - x0)**2))
         
         return A*L(x,w,Gamma,contrast,x0)+a0
+    
+    def jacobian(self,x,w,Gamma,contrast,x0,A,a0):
+        g = Gamma**2/4.
+        u1 = x - w/2. - x0
+        u2 = x + w/2. - x0
+        d1 = g + u1**2
+        d2 = g + u2**2
+        p1 = 1 - g/d1
+        p2 = 1 - g/d2
+        #derivatives of p1 and p2 with respect to u1, u2 and Gamma
+        dp1du = 2*g*u1/d1**2
+        dp2du = 2*g*u2/d2**2
+        dp1dGamma = -u1**2/d1**2 * Gamma/2.
+        dp2dGamma = -u2**2/d2**2 * Gamma/2.
+        L = (1-contrast) + contrast * p1 * p2
+        return _stackDerivatives(A*contrast*(-dp1du*p2 + p1*dp2du)/2.,
+                                 A*contrast*(dp1dGamma*p2 + p1*dp2dGamma),
+                                 A*(p1*p2 - 1),
+                                 -A*contrast*(dp1du*p2 + p1*dp2du),
+                                 L,
+                                 1)
         
     def estimateInitialParameters(self,intensityProfile,peakCoordinates, lowerValleyCoordinates, upperValleyCoordinates, minBound,maxBound):
         return {'w': upperValleyCoordinates[0] - lowerValleyCoordinates[0],
@@ -204,6 +289,14 @@ class DualHarmonic(DisplacementFitFunction):
     def __call__(self,x,x0,w,a1,a2,a0):
         return a1*np.cos(w*(x-x0)) + a2*np.cos(2*w*(x-x0)) + a0
     
+    def jacobian(self,x,x0,w,a1,a2,a0):
+        d = x-x0
+        return _stackDerivatives(a1*w*np.sin(w*d) + 2*a2*w*np.sin(2*w*d),
+                                 -a1*d*np.sin(w*d) - 2*a2*d*np.sin(2*w*d),
+                                 np.cos(w*d),
+                                 np.cos(2*w*d),
+                                 1)
+    
     def estimateInitialParameters(self,intensityProfile,peakCoordinates,lowerValleyCoordinates,upperValleyCoordinates,minBound,maxBound):
         a0 = (minBound[1] + maxBound[1])/2
         a1 = (peakCoordinates[1]-a0)/2
@@ -228,6 +321,9 @@ class Spline(DisplacementFitFunction):
     def __call__(self,x,x0):
         return self.spline(x-x0)
     
+    def jacobian(self,x,x0):
+        return _stackDerivatives(-self.spline(x-x0,nu=1))
+    
     def estimateInitialParameters(self,intensityProfile,**kwargs):
         xValues = np.arange(len(intensityProfile))
         yValues = gaussian_filter(intensityProfile,2)
@@ -252,6 +348,9 @@ class ScaledSpline(DisplacementFitFunction):
     def __call__(self,x,x0,A,a0):
         return A*self.spline(x-x0)+a0
     
+    def jacobian(self,x,x0,A,a0):
+        return _stackDerivatives(-A*self.spline(x-x0,nu=1),self.spline(x-x0),1)
+    
     def estimateInitialParameters(self,intensityProfile,filter_sigma=2,**kwargs):
         xValues = np.arange(len(intensityProfile))
         yValues = gaussian_filter(intensityProfile,filter_sigma)
@@ -280,6 +379,9 @@ class ScaledSpline1(DisplacementFitFunction):
     def __call__(self,x,x0,A,a0):
         return A*self.spline(x-x0)+a0
     
+    def jacobian(self,x,x0,A,a0):
+        return _stackDerivatives(-A*self.spline(x-x0,nu=1),self.spline(x-x0),1)
+    
     def estimateInitialParameters(self,intensityProfile,filter_sigma=1,**kwargs):
         xValues = np.arange(len(intensityProfile))
         yValues = gaussian_filter(intensityProfile,filter_sigma)
@@ -308,6 +410,9 @@ class ScaledSpline0(DisplacementFitFunction):
     def __call__(self,x,x0,A,a0):
         return A*self.spline(x-x0)+a0
     
+    def jacobian(self,x,x0,A,a0):
+        return _stackDerivatives(-A*self.spline(x-x0,nu=1),self.spline(x-x0),1)
+    
     def estimateInitialParameters(self,intensityProfile,filter_sigma=0,**kwargs):
         xValues = np.arange(len(intensityProfile))
         yValues = gaussian_filter(intensityProfile,filter_sigma)
@@ -325,6 +430,101 @@ class ScaledSpline0(DisplacementFitFunction):
         estimators = []
         return estimators
 
+class TemplateMatchingSpline(ScaledSpline):
+    """
+    ScaledSpline that is evaluated from the cached polynomial coefficients of a
+    SplineTemplate and that fits many profiles at once.
+    
+    Profiles are fitted in blocks: initial parameters for every profile are estimated
+    with TemplateMatching.estimateParameters, after which all profiles of the block are
+    fitted with batchCurveFit. Profiles for which that does not converge are fitted with
+    matchTemplate and finally with curve_fit, starting from the result of the previous
+    profile.
+    """
+    def __init__(self,blockSize=1000,maxShiftPerFrame=5):
+        super(TemplateMatchingSpline,self).__init__()
+        self.template = None
+        self.blockSize = blockSize
+        self.maxShiftPerFrame = maxShiftPerFrame
+        
+    def getName(self):
+        return "Scaled Spline (template matching)"
+    
+    def __call__(self,x,x0,A,a0):
+        values,derivatives = self.template.evaluate(x-x0)
+        return A*values+a0
+    
+    def jacobian(self,x,x0,A,a0):
+        values,derivatives = self.template.evaluate(x-x0)
+        return _stackDerivatives(-A*derivatives,values,1)
+    
+    def estimateInitialParameters(self,intensityProfile,filter_sigma=2,**kwargs):
+        valuesDict = super(TemplateMatchingSpline,self).estimateInitialParameters(intensityProfile,filter_sigma,**kwargs)
+        self.template = SplineTemplate(self.spline)
+        return valuesDict
+    
+    def fitProfiles(self,xdata,profiles,p0,progressCallback=None,**curveFitKwargs):
+        curveFitKwargs.setdefault('jac',self.jacobian)
+        results = []
+        for start in range(0,len(profiles),self.blockSize):
+            block = np.asarray(profiles[start:start + self.blockSize],dtype=float)
+            pInitial = estimateParameters(self.template,xdata,block,p0[0],self.maxShiftPerFrame)
+            if pInitial is not None:
+                batchResult = batchCurveFit(self,xdata,block,pInitial,jacobian=self.jacobian)
+            
+            for i,ydata in enumerate(block):
+                if pInitial is not None and batchResult.converged[i]:
+                    popt,pcov,chiSquare = batchResult.popt[i],batchResult.pcov[i],batchResult.chiSquare[i]
+                else:
+                    popt,pcov,chiSquare,converged = matchTemplate(self.template,xdata,ydata,p0)
+                    if not converged:
+                        popt,pcov = curve_fit(self,xdata,ydata,p0,**curveFitKwargs)
+                        f = self(xdata,*popt)
+                        chiSquare = ((ydata - f)**2 / f).sum()
+                p0 = popt
+                results.append((popt,pcov,chiSquare))
+            
+            if progressCallback is not None:
+                progressCallback(len(results))
+        return results
+
+class FFTCrossCorrelation(TemplateMatchingSpline):
+    """
+    Non-iterative alternative to curve fitting for long measurements. The shift of every
+    profile with respect to the (filtered) reference profile is calculated by FFT
+    cross-correlation, after which scale and offset are solved by linear least squares.
+    The model and parameters are those of the ScaledSpline.
+    """
+    def __init__(self,blockSize=4096,upsampleFactor=100):
+        super(FFTCrossCorrelation,self).__init__(blockSize)
+        self.reference = None
+        self.upsampleFactor = upsampleFactor
+    
+    def getName(self):
+        return "FFT cross-correlation"
+    
+    def estimateInitialParameters(self,intensityProfile,filter_sigma=2,**kwargs):
+        valuesDict = super(FFTCrossCorrelation,self).estimateInitialParameters(intensityProfile,filter_sigma,**kwargs)
+        self.reference = self.spline(np.arange(len(intensityProfile)))
+        return valuesDict
+    
+    def fitProfiles(self,xdata,profiles,p0,progressCallback=None,**curveFitKwargs):
+        results = []
+        for start in range(0,len(profiles),self.blockSize):
+            block = np.asarray(profiles[start:start + self.blockSize],dtype=float)
+            shifts = crossCorrelationShifts(xdata,block,self.reference,self.upsampleFactor)
+            P = solveScaleAndOffset(self.template,xdata,block,shifts)
+            f = self(xdata[np.newaxis,:],P[:,0:1],P[:,1:2],P[:,2:3])
+            residuals = block - f
+            cost = (residuals**2).sum(axis=1)
+            pcov = estimateCovariance(self,xdata,P,f,cost,len(xdata),self.jacobian)
+            chiSquare = (residuals**2 / f).sum(axis=1)
+            results += zip(P,pcov,chiSquare)
+            
+            if progressCallback is not None:
+                progressCallback(len(results))
+        return results
+
 class BoundedSpline(DisplacementFitFunction):
     def __init__(self):
         super(BoundedSpline,self).__init__()
@@ -351,6 +551,11 @@ class BoundedSpline(DisplacementFitFunction):
             #return (1.0 if xValue > self.xmin and xValue < self.xmax else np.NaN)
         
         return boundedSpline(x)
+    
+    def jacobian(self,x,x0,A,a0):
+        #outside of the bounds the function is constant
+        inside = (x >= self.xmin) & (x <= self.xmax)
+        return _stackDerivatives(-A*self.spline(x-x0,nu=1)*inside,self.spline(x-x0)*inside,inside)
         
         
     def estimateInitialParameters(self,intensityProfile,splineMinBound,splineMaxBound,**kwargs):
@@ -389,6 +594,14 @@ class Sinc(DisplacementFitFunction):
 
         
         return sinc(x)
+    
+    def jacobian(self,x,w,A,c,x0):
+        z = w*(x-x0)
+        dsinc = (z*np.cos(z) - np.sin(z))/z**2
+        return _stackDerivatives(A*dsinc*(x-x0),
+                                 np.sin(z)/z,
+                                 1,
+                                 -A*dsinc*w)
             
         
     def estimateInitialParameters(self,intensityProfile,peakCoordinates, lowerValleyCoordinates, upperValleyCoordinates, minBound,maxBound):
@@ -415,6 +628,11 @@ class SafeScaledSpline(DisplacementFitFunction):
     def __call__(self,x,x0,A,a0):
         return np.clip(A,0.8,1.2)*self.spline(x-x0)+a0
     
+    def jacobian(self,x,x0,A,a0):
+        return _stackDerivatives(-np.clip(A,0.8,1.2)*self.spline(x-x0,nu=1),
+                                 self.spline(x-x0)*((A >= 0.8) & (A <= 1.2)),
+                                 1)
+    
     def estimateInitialParameters(self,intensityProfile,filter_sigma=2,**kwargs):
         xValues = np.arange(len(intensityProfile))
         yValues = gaussian_filter(intensityProfile,filter_sigma)
@@ -432,7 +650,7 @@ class SafeScaledSpline(DisplacementFitFunction):
 
 
 def createFitFunctions():
-    return [Merlijnian(),Gaussian(),Harmonic(),Jaapian(),Sinc(),DualHarmonic(),Spline(),ScaledSpline0(),ScaledSpline1(),ScaledSpline(),BoundedSpline()]
+    return [Merlijnian(),Gaussian(),Harmonic(),Jaapian(),Sinc(),DualHarmonic(),Spline(),ScaledSpline0(),ScaledSpline1(),ScaledSpline(),TemplateMatchingSpline(),FFTCrossCorrelation(),BoundedSpline()]
 
 def createFitFunction(name):
     fitFunctionsDict = {ff.getName() : ff for ff in createFitFunctions()}
@@ -0,0 +1,306 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Sub-pixel template matching of intensity profiles against a spline template.
+
+The model is the same as that of the ScaledSpline fit function,
+
+    y = A * spline(x - x0) + a0
+
+but instead of evaluating the spline with scipy on every iteration, the cubic
+polynomial coefficients of the spline are computed once for every pixel interval.
+The spline and its derivative can then be evaluated with a few vectorized
+multiply-adds, and shift, scale and offset are solved by Gauss-Newton.
+"""
+
+from __future__ import division as _division
+import numpy as _np
+
+_SAMPLE_POINTS = _np.array([0,1/3.,2/3.,1])
+_INVERSE_VANDERMONDE = _np.linalg.inv(_np.vander(_SAMPLE_POINTS,4,increasing=True))
+
+
+class SplineTemplate(object):
+    """
+    Piecewise cubic representation of a spline on unit intervals.
+
+    A cubic spline with knots on whole pixel positions (like the
+    InterpolatedUnivariateSpline instances of the spline fit functions) is a single
+    cubic polynomial on every pixel interval, so the representation is exact.
+    Outside of the knot range the first and last polynomials are extrapolated, like
+    InterpolatedUnivariateSpline does.
+    """
+
+    def __init__(self,spline):
+        """
+        Parameters
+        ----------
+
+        spline: scipy.interpolate.UnivariateSpline
+            A cubic spline with knots on whole pixel positions.
+        """
+        knots = spline.get_knots()
+        self.xmin = int(_np.ceil(knots[0]))
+        self.xmax = int(_np.floor(knots[-1]))
+        intervalStarts = _np.arange(self.xmin,max(self.xmax,self.xmin + 1))
+
+        samples = spline((intervalStarts[:,_np.newaxis] + _SAMPLE_POINTS).ravel()).reshape((-1,4))
+        #columns are the coefficients of 1, u, u**2 and u**3
+        self.coefficients = samples.dot(_INVERSE_VANDERMONDE.T)
+
+    def evaluate(self,t):
+        """
+        Evaluates the spline and its first derivative.
+
+        Parameters
+        ----------
+
+        t: array-like
+            The positions to evaluate the spline at.
+
+        Returns
+        -------
+
+        values, derivatives: numpy.ndarray
+            Arrays of the same shape as t.
+        """
+        t = _np.asarray(t,dtype=float)
+        idx = _np.clip(_np.floor(t).astype(int) - self.xmin,0,len(self.coefficients) - 1)
+        u = t - (idx + self.xmin)
+        c = self.coefficients[idx]
+        c0,c1,c2,c3 = c[...,0],c[...,1],c[...,2],c[...,3]
+        values = ((c3*u + c2)*u + c1)*u + c0
+        derivatives = (3*c3*u + 2*c2)*u + c1
+        return values,derivatives
+
+    def evaluateUnitSpaced(self,t0,n):
+        """
+        Evaluates the spline and its first derivative at t0 + arange(n).
+
+        All positions have the same offset within their pixel interval, so the
+        polynomials of a contiguous range of intervals can be evaluated with a single
+        matrix-vector product. Equivalent to evaluate(t0 + arange(n)).
+        """
+        i0 = int(_np.floor(t0))
+        start = i0 - self.xmin
+        if start < 0 or start + n > len(self.coefficients):
+            return self.evaluate(t0 + _np.arange(n))
+
+        u = t0 - i0
+        c = self.coefficients[start:start + n]
+        values = c.dot([1.,u,u*u,u*u*u])
+        derivatives = c[:,1:].dot([1.,2*u,3*u*u])
+        return values,derivatives
+
+
+def _solve3(A,b):
+    """
+    Solves the 3x3 system A x = b with Cramer's rule, which is much faster than
+    numpy.linalg.solve for a single small system. Raises numpy.linalg.LinAlgError if
+    A is singular.
+    """
+    (a,b_,c),(d,e,f),(g,h,i) = A.tolist()
+    y0,y1,y2 = b.tolist()
+    cofactor0 = e*i - f*h
+    cofactor1 = f*g - d*i
+    cofactor2 = d*h - e*g
+    determinant = a*cofactor0 + b_*cofactor1 + c*cofactor2
+    if determinant == 0 or not _np.isfinite(determinant):
+        raise _np.linalg.LinAlgError("singular matrix")
+    return _np.array([(y0*cofactor0 + b_*(f*y2 - y1*i) + c*(y1*h - e*y2)) / determinant,
+                      (a*(y1*i - f*y2) + y0*cofactor1 + c*(d*y2 - y1*g)) / determinant,
+                      (a*(e*y2 - y1*h) + b_*(y1*g - d*y2) + y0*cofactor2) / determinant])
+
+
+def matchTemplate(template,xdata,ydata,p0,maxIterations=20,xtol=1.49012e-8,ftol=1.49012e-8):
+    """
+    Fits A * template(x - x0) + a0 to a profile by Gauss-Newton with step halving.
+
+    Parameters
+    ----------
+
+    template: SplineTemplate
+        The template to match.
+    xdata: (n_pixels,) array
+        The x-values.
+    ydata: (n_pixels,) array
+        The profile.
+    p0: sequence of 3 floats
+        Initial values of x0, A and a0.
+    maxIterations: integer
+        The maximum number of Gauss-Newton iterations.
+    xtol: float
+        Relative tolerance on the parameters.
+    ftol: float
+        Relative tolerance on the sum of squares.
+
+    Returns
+    -------
+
+    popt: (3,) array
+        The optimal x0, A and a0.
+    pcov: (3 x 3) array
+        The estimated covariance of popt, scaled like scipy.optimize.curve_fit does.
+    chiSquare: float
+        The chi-square statistic of the fit, as calculated by scipy.stats.chisquare.
+    converged: boolean
+        False if the fit did not converge, in which case the other results are those
+        of the last accepted iteration.
+    """
+    xdata = _np.asarray(xdata,dtype=float)
+    ydata = _np.asarray(ydata,dtype=float)
+    p = _np.array(p0,dtype=float)
+
+    if len(xdata) > 1 and _np.all(_np.diff(xdata) == 1):
+        evaluate = lambda x0: template.evaluateUnitSpaced(xdata[0] - x0,len(xdata))
+    else:
+        evaluate = lambda x0: template.evaluate(xdata - x0)
+
+    s,ds = evaluate(p[0])
+    r = ydata - (p[1]*s + p[2])
+    cost = r.dot(r)
+
+    J = _np.empty((len(xdata),3))
+    J[:,2] = 1
+    converged = False
+    for iteration in range(maxIterations):
+        J[:,0] = -p[1]*ds
+        J[:,1] = s
+        try:
+            delta = _solve3(J.T.dot(J),J.T.dot(r))
+        except _np.linalg.LinAlgError:
+            break
+
+        #at the optimum rounding errors can make every step increase the cost
+        if _np.sqrt(delta.dot(delta)) <= xtol*(_np.sqrt(p.dot(p)) + xtol):
+            converged = True
+            break
+
+        step = 1.
+        while step > 1e-3:
+            pNew = p + step*delta
+            sNew,dsNew = evaluate(pNew[0])
+            rNew = ydata - (pNew[1]*sNew + pNew[2])
+            costNew = rNew.dot(rNew)
+            if costNew <= cost:
+                break
+            step /= 2
+        else:
+            break
+
+        reduction = (cost - costNew) / max(cost,_np.finfo(float).tiny)
+        p,s,ds,r,cost = pNew,sNew,dsNew,rNew,costNew
+        if reduction <= ftol or _np.sqrt((step*delta).dot(step*delta)) <= xtol*(_np.sqrt(p.dot(p)) + xtol):
+            converged = True
+            break
+
+    J[:,0] = -p[1]*ds
+    J[:,1] = s
+    pcov = _np.full((3,3),_np.inf)
+    if len(xdata) > 3:
+        try:
+            pcov = _np.linalg.inv(J.T.dot(J)) * cost / (len(xdata) - 3)
+        except _np.linalg.LinAlgError:
+            pass
+
+    f = ydata - r
+    chiSquare = (r**2 / f).sum()
+    return p,pcov,chiSquare,converged
+
+
+def estimateParameters(template,xdata,profiles,x0,maxShiftPerFrame=5):
+    """
+    Estimates shift, scale and offset of many profiles at once, as initial parameters
+    for a least-squares fit.
+
+    The shift is tracked over the profiles by normalized cross-correlation with the
+    template at whole-pixel shifts, searching within maxShiftPerFrame pixels of the
+    shift of the previous profile, and refined by parabolic interpolation of the
+    correlation peak. Scale and offset are then solved by linear least squares.
+
+    Parameters
+    ----------
+
+    template: SplineTemplate
+        The template to match.
+    xdata: (n_pixels,) array
+        The x-values, which must be consecutive whole pixels.
+    profiles: (n_profiles x n_pixels) array
+        The profiles.
+    x0: float
+        The shift of the profile preceding the first profile.
+    maxShiftPerFrame: integer
+        The maximum shift between consecutive profiles, in pixels.
+
+    Returns
+    -------
+
+    A (n_profiles x 3) array with x0, A and a0 for every profile, or None if the
+    shift cannot be searched because xdata are no consecutive whole pixels or there
+    are fewer than 3 shifts at which the template covers all of xdata.
+    """
+    xdata = _np.asarray(xdata,dtype=float)
+    profiles = _np.asarray(profiles,dtype=float)
+    if len(xdata) < 2 or _np.any(_np.diff(xdata) != 1) or xdata[0] != _np.floor(xdata[0]):
+        return None
+
+    #template values at whole pixels xmin..xmax
+    samples = _np.append(template.coefficients[:,0],template.coefficients[-1].sum())
+    minLag = int(xdata[-1]) - template.xmax
+    maxLag = int(xdata[0]) - template.xmin
+    if maxLag - minLag < 2:
+        return None
+
+    lags = _np.arange(minLag,maxLag + 1)
+    shifted = samples[(int(xdata[0]) - template.xmin - lags)[:,_np.newaxis] + _np.arange(len(xdata))]
+    shifted = shifted - shifted.mean(axis=1)[:,_np.newaxis]
+    shifted /= _np.maximum(_np.sqrt((shifted**2).sum(axis=1)),_np.finfo(float).tiny)[:,_np.newaxis]
+    correlation = (profiles - profiles.mean(axis=1)[:,_np.newaxis]).dot(shifted.T)
+
+    nLags = len(lags)
+    best = _np.empty(len(profiles),dtype=int)
+    lag = int(_np.clip(round(x0) - minLag,0,nLags - 1))
+    for i,row in enumerate(correlation):
+        lower = max(lag - maxShiftPerFrame,0)
+        lag = lower + int(row[lower:lag + maxShiftPerFrame + 1].argmax())
+        best[i] = lag
+
+    rows = _np.arange(len(profiles))
+    inner = _np.clip(best,1,nLags - 2)
+    left,center,right = correlation[rows,inner - 1],correlation[rows,inner],correlation[rows,inner + 1]
+    curvature = left - 2*center + right
+    offset = _np.where(curvature < 0,0.5*(left - right) / _np.where(curvature < 0,curvature,-1),0)
+    shifts = lags[inner] + _np.where(best == inner,_np.clip(offset,-0.5,0.5),best - inner)
+
+    return solveScaleAndOffset(template,xdata,profiles,shifts)
+
+
+def solveScaleAndOffset(template,xdata,profiles,shifts):
+    """
+    Solves the scale A and offset a0 of every profile for the target shifts by linear
+    least squares.
+
+    Returns
+    -------
+
+    A (n_profiles x 3) array with x0, A and a0 for every profile.
+    """
+    s,ds = template.evaluate(xdata - shifts[:,_np.newaxis])
+    sCentered = s - s.mean(axis=1)[:,_np.newaxis]
+    sVariance = (sCentered**2).sum(axis=1)
+    A = _np.where(sVariance > 0,(sCentered*profiles).sum(axis=1) / _np.where(sVariance > 0,sVariance,1),1)
+    a0 = profiles.mean(axis=1) - A*s.mean(axis=1)
+    return _np.column_stack((shifts,A,a0))
@@ -17,4 +17,5 @@
 
 #odmanalysis.fitfunctions
 
-from .FitFunctions import *
\ No newline at end of file
+from .FitFunctions import *
+from .BatchFitting import batchCurveFit, BatchCurveFitResult, evaluateBatch
\ No newline at end of file
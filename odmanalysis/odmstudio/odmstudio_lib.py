@@ -4,8 +4,8 @@ import pandas as pd
 import numpy as np
 import odmanalysis as odm
 from odmanalysis.odmstudio.odmstudio_framework import RegisterSourceReader
+from odmanalysis.ProgressReporting import RateLimiter
 import cv2
-import time
     
 class DataSource(q.QObject):
     
@@ -37,7 +37,12 @@ class DataSource(q.QObject):
 
     @property
     def intensityProfiles(self):
-        return self.sourceDataFrame['intensityProfile']
+        """
+        The intensity profiles of the source dataframe as an odm.ProfileMatrix.
+        """
+        if self.__intensityProfiles is None:
+            self.__intensityProfiles = odm.ProfileMatrix.fromDataFrame(self.sourceDataFrame)
+        return self.__intensityProfiles
 
     @property
     def currentIndexLocation(self):
@@ -70,6 +75,7 @@ class DataSource(q.QObject):
     def __init__(self):
         q.QObject.__init__(self)
         self.__sourceDataFrame = DataSource.createDefaultSourceDataFrame()
+        self.__intensityProfiles = None
         self.__resultsDataFrame = DataSource.createDefaultResultsDataFrame()
         self.__resultArrays = {}
         self.__currentIloc = 0
@@ -83,6 +89,7 @@ class DataSource(q.QObject):
 
     def setSourceDataFrame(self,dataframe):
         self.__sourceDataFrame = dataframe
+        self.__intensityProfiles = None
         self.__resultsDataFrame = pd.DataFrame(index=dataframe.index)
         self.sourceDataChanged.emit(dataframe)
         self.resultDataChanged.emit(self.__resultsDataFrame)
@@ -168,6 +175,9 @@ class SourceReader(q.QObject):
         self.statusMessageChanged.emit(message)
 
     def _setProgress(self,progress):
+        #the signal carries whole percentages, so only changes of those are emitted
+        if self._progress is not None and int(progress) == int(self._progress):
+            return
         self._progress = progress
         self.progressChanged.emit(progress)
 
@@ -183,6 +193,7 @@ class SourceReader(q.QObject):
         """
         
         self.__dataSource.clear()
+        self._progress = None
         
         
 
@@ -314,16 +325,25 @@ class TrackableFeature(q.QObject):
         Searches all the intensityProfiles in the dataSource for the feature
         """
 
-        updateInterval = 10
+        findAllPositions = getattr(self.tracker,'findAllPositions',None)
+        if findAllPositions is not None:
+            start = self.dataSource.currentIndexLocation
+            self._trackedPositions[start:] = findAllPositions(self.dataSource.intensityProfiles[start:])
+            self.dataSource.setCurrentIndexLocation(self.dataSource.sourceLength - 1)
+            self.dataSource.refreshResults()
+            return
+
+        #every refresh redraws the plots, so they are refreshed at most 10 times per second
+        refreshLimiter = RateLimiter(minInterval=0.1)
 
         for i in range(self.dataSource.currentIndexLocation, self.dataSource.sourceLength):
             position = self.tracker.findNextPosition(self.dataSource.intensityProfiles.iloc[i])
             self._trackedPositions[i] = position
-            self.dataSource.refreshResults()
-            if i%10 == 0:
+            if refreshLimiter.ready():
                 self.dataSource.setCurrentIndexLocation(i)
-                time.sleep(0.01)
+                self.dataSource.refreshResults()
 
+        self.dataSource.setCurrentIndexLocation(self.dataSource.sourceLength - 1)
         self.dataSource.refreshResults()
             
 
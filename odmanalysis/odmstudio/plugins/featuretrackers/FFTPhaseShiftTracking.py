@@ -1,8 +1,11 @@
 from odmanalysis.odmstudio import odmstudio_lib as lib
 from odmanalysis.odmstudio import odmstudio_framework as fw
 from odmanalysis.odmstudio.odmstudio_gui import PlotController
+from odmanalysis.fitfunctions.CrossCorrelation import crossCorrelationShifts
+from scipy.ndimage.filters import gaussian_filter
 from PyQt4 import QtCore as q
 from PyQt4 import QtGui as qt
+import numpy as np
 
 @fw.RegisterFeatureTracker()
 class FFTPhaseShiftTracker(lib.FeatureTracker):
@@ -13,12 +16,24 @@ class FFTPhaseShiftTracker(lib.FeatureTracker):
     
     def __init__(self):
         lib.FeatureTracker.__init__(self)
+        self.reference = None
+        self.xValues = np.array([])
+        self.upsampleFactor = 100
+        
+    def initialize(self,intensityProfile):
+        self.reference = gaussian_filter(np.asarray(intensityProfile,dtype=float),1)
+        self.xValues = np.arange(len(intensityProfile))
         
     def findNextPosition(self, intensityProfile):
+        return self.findAllPositions(np.atleast_2d(intensityProfile))[0]
+    
+    def findAllPositions(self, intensityProfiles):
         """
-        TODO: implement
+        Returns the shifts with respect to the reference profile of all rows of the
+        target 2D array or odm.ProfileMatrix, calculated in one go by FFT cross-correlation.
         """
-        return super(FFTTracker, self).findPosition(intensityProfile)
+        profiles = np.asarray(getattr(intensityProfiles,'data',intensityProfiles))[:,self.rangeSlice]
+        return crossCorrelationShifts(self.xValues[self.rangeSlice],profiles,self.reference,self.upsampleFactor)
 
 
 @fw.RegisterWidgetFor(FFTPhaseShiftTracker)
@@ -32,7 +47,7 @@ class FFTPhaseShiftTrackerWidget(qt.QWidget,PlotController):
         self.setLayout(layout)
 
     def connectToPlotWidget(self, plotWidget):
-        return super(CurveFitTrackerWidget, self).connectToPlotWidget(plotWidget)
+        return super(FFTPhaseShiftTrackerWidget, self).connectToPlotWidget(plotWidget)
 
     def disconnectPlotWidget(self):
-        pass
\ No newline at end of file
+        pass
@@ -15,7 +15,7 @@ class CsvReader(lib.SourceReader):
         super(CsvReader, self).read(path)
         
         self._setStatusMessage("reading...")
-        reader = odm.getODMDataReader(path,chunksize=500)
+        reader = odm.getODMDataReader(path,chunksize=500,dropEmptyProfiles=True)
         
         lineCount = float(sum(1 for line in open(path)))
         chunks = []
@@ -3,6 +3,7 @@ from odmanalysis.odmstudio import odmstudio_framework as framework
 import pandas as pd
 import numpy as np
 import cv2
+from odmanalysis.ProgressReporting import RateLimiter
 
 @framework.RegisterSourceReader("Video files", extensions=('avi','mpg'), maxNumberOfFiles=1)
 class VideoReader(lib.SourceReader):
@@ -27,6 +28,7 @@ class VideoReader(lib.SourceReader):
         np.arange(frameCount)/frameRate
 
         framesRead = 0
+        refreshLimiter = RateLimiter(minInterval=0.1)
         intensityProfiles = []
         timeSteps = np.arange(frameCount)/frameRate
 
@@ -38,12 +40,13 @@ class VideoReader(lib.SourceReader):
             intensityProfiles.append(line)
 
             framesRead += 1
-            self.dataSource.setSourceDataFrame(pd.DataFrame(data={'intensityProfile': intensityProfiles, 'timeStep': timeSteps[0:framesRead]}))
+            #every new source dataframe redraws the views, so they are updated at most 10 times per second
+            if refreshLimiter.ready():
+                self.dataSource.setSourceDataFrame(pd.DataFrame(data={'intensityProfile': intensityProfiles, 'timeStep': timeSteps[0:framesRead]}))
+                self._setProgress((framesRead*100)/frameCount)
+                self._setStatusMessage("%i frames read" % framesRead)
 
-            self._setProgress((framesRead*100)/frameCount)
-            self._setStatusMessage("%i frames read" % framesRead)
-
-        
+        self.dataSource.setSourceDataFrame(pd.DataFrame(data={'intensityProfile': intensityProfiles, 'timeStep': timeSteps[0:framesRead]}))
         
         self._setStatusMessage("file loaded")
         self._setProgress(100)
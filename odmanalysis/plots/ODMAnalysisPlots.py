@@ -363,7 +363,7 @@ def plotMultiCycleMeanVoltageDisplacement(df, measurementName="", nmPerPx=1, fig
     axes.set_ylabel("Displacement (px)")
     axes.set_xlabel("Actuator Voltage (V)")
     
-    grouped = df.groupby(['direction','actuatorVoltage'])['displacement']
+    grouped = df.groupby(['direction','actuatorVoltage'],observed=True)['displacement']
     dfMean = grouped.agg({'displacement': _np.mean})
     dfMean.displacement['forward'].plot(ax=axes,label="forward")
     dfMean.displacement['backward'].plot(ax=axes,label="backward")
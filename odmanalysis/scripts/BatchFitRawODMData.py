@@ -0,0 +1,331 @@
+"""
+    Copyright (C) 2014 Delft University of Technology, The Netherlands
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Fits all the measurements in a directory tree without asking anything from the user.
+
+Every data.csv file below the root directory is fitted with the FitRawODMData script.
+The settings are taken from the odmSettings.ini and fitSettings.pcl files in the
+folder of the measurement. If a folder does not have them, the template files that
+are given on the command line are copied into it first. Measurements without fit
+settings fail.
+
+Measurements whose odmanalysis.csv is newer than their data.csv and settings files
+are skipped, unless --force is given. The measurements are fitted by a pool of
+processes. The output of every measurement is written to odm_batch.log in its
+folder. A manifest with the status, time and error of every measurement is written
+to odm_batch.json in the root directory.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+import datetime
+from multiprocessing import Pool, cpu_count
+import odmanalysis as odm
+from odmanalysis.scripts.FitRawODMData import fitRawODMData
+
+
+DATA_FILE_NAME = 'data.csv'
+SETTINGS_FILE_NAME = 'odmSettings.ini'
+FIT_SETTINGS_FILE_NAME = 'fitSettings.pcl'
+RESULTS_FILE_NAME = 'odmanalysis.csv'
+LOG_FILE_NAME = 'odm_batch.log'
+MANIFEST_FILE_NAME = 'odm_batch.json'
+
+
+def findMeasurements(root,dataFileName=DATA_FILE_NAME):
+    """
+    Returns the sorted paths of all data files below the target root directory.
+    """
+    dataFiles = []
+    for path,directories,files in os.walk(root):
+        directories.sort()
+        if dataFileName in files:
+            dataFiles.append(os.path.abspath(os.path.join(path,dataFileName)))
+    return dataFiles
+
+
+def getInputFiles(dataFile):
+    """
+    Returns the paths of the data file and of the settings files in its folder, which
+    the results of a measurement depend on.
+    """
+    commonPath = os.path.split(dataFile)[0]
+    return [dataFile,os.path.join(commonPath,SETTINGS_FILE_NAME),os.path.join(commonPath,FIT_SETTINGS_FILE_NAME)]
+
+
+def isUpToDate(dataFile):
+    """
+    Returns True if the results of the target measurement are newer than its inputs.
+    """
+    resultsFile = os.path.join(os.path.split(dataFile)[0],RESULTS_FILE_NAME)
+    if not os.path.isfile(resultsFile):
+        return False
+    resultsTime = os.path.getmtime(resultsFile)
+    return all(os.path.getmtime(path) <= resultsTime for path in getInputFiles(dataFile) if os.path.isfile(path))
+
+
+def copyTemplates(dataFile,settingsTemplate=None,fitSettingsTemplate=None):
+    """
+    Copies the template settings files into the folder of the target measurement, if
+    it does not have settings files of its own.
+
+    Raises
+    ------
+
+    IOError: if the measurement has no fit settings and there is no template.
+    """
+    commonPath = os.path.split(dataFile)[0]
+    for fileName,template in [(SETTINGS_FILE_NAME,settingsTemplate),(FIT_SETTINGS_FILE_NAME,fitSettingsTemplate)]:
+        path = os.path.join(commonPath,fileName)
+        if not os.path.isfile(path) and template is not None:
+            shutil.copyfile(template,path)
+
+    if not os.path.isfile(os.path.join(commonPath,FIT_SETTINGS_FILE_NAME)):
+        raise IOError("no %s in %s and no fit settings template" % (FIT_SETTINGS_FILE_NAME,commonPath))
+    if not os.path.isfile(os.path.join(commonPath,SETTINGS_FILE_NAME)):
+        #the defaults, like the interactive scripts use when there is no settings file
+        odm.CurveFitSettings().saveToFile(os.path.join(commonPath,SETTINGS_FILE_NAME))
+
+
+class _RedirectedOutput(object):
+    """
+    Redirects the standard output and error of the process, including the output of
+    progress reporters that were created earlier, to a file.
+    """
+    def __init__(self,path):
+        self.path = path
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.logFile = open(self.path,'w')
+        self.savedDescriptors = [os.dup(1),os.dup(2)]
+        os.dup2(self.logFile.fileno(),1)
+        os.dup2(self.logFile.fileno(),2)
+        return self
+
+    def __exit__(self,excType,excValue,tb):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for descriptor,saved in zip([1,2],self.savedDescriptors):
+            os.dup2(saved,descriptor)
+            os.close(saved)
+        self.logFile.close()
+        return False
+
+
+def processMeasurement(task):
+    """
+    Fits a single measurement. Runs in the processes of the pool.
+
+    Parameters
+    ----------
+
+    task: dictionary
+        The 'dataFile', 'settingsTemplate', 'fitSettingsTemplate', 'force', 'crop',
+        'resume', 'cacheDir', 'cacheSize' and 'plots' of the measurement.
+
+    Returns
+    -------
+
+    A dictionary with the 'dataFile', 'status' ('fitted', 'skipped' or 'failed'),
+    'seconds', 'profiles' and the 'error' message of the measurement.
+    """
+    dataFile = task['dataFile']
+    record = {'dataFile': dataFile, 'status': None, 'seconds': 0., 'profiles': None, 'error': None}
+
+    if not task['force'] and isUpToDate(dataFile):
+        record['status'] = 'skipped'
+        return record
+
+    commonPath = os.path.split(dataFile)[0]
+    startTime = time.time()
+    try:
+        with _RedirectedOutput(os.path.join(commonPath,LOG_FILE_NAME)):
+            try:
+                copyTemplates(dataFile,task['settingsTemplate'],task['fitSettingsTemplate'])
+                df,movingPeakFitSettings,referencePeakFitSettings,measurementName = fitRawODMData(dataFile,
+                    settingsFile=os.path.join(commonPath,SETTINGS_FILE_NAME),
+                    fitSettingsFile=os.path.join(commonPath,FIT_SETTINGS_FILE_NAME),
+                    crop=task['crop'],saveSettings=False,resume=task['resume'],
+                    cacheDir=task['cacheDir'],cacheSize=task['cacheSize'])
+                record['profiles'] = len(df)
+
+                if task['plots']:
+                    makePlots(df,movingPeakFitSettings,referencePeakFitSettings,measurementName,commonPath)
+            except Exception:
+                traceback.print_exc()
+                raise
+        record['status'] = 'fitted'
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = "%s: %s" % (type(e).__name__,e)
+    record['seconds'] = time.time() - startTime
+
+    return record
+
+
+def makePlots(df,movingPeakFitSettings,referencePeakFitSettings,measurementName,commonPath):
+    """
+    Saves the plots that the AnalyzeRawODMData script makes.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from odmanalysis.scripts.MakeODMPlots import makeDisplacementPlots, makeIntensityProfilePlots
+
+    settings = odm.CurveFitSettings.loadFromFile(os.path.join(commonPath,SETTINGS_FILE_NAME))
+    plotKwargs = {'savePath' : commonPath, 'measurementName' : measurementName, 'nmPerPx' : settings.pxToNm}
+    makeDisplacementPlots(df, **plotKwargs)
+    makeIntensityProfilePlots(df, movingPeakFitSettings, referencePeakFitSettings, **plotKwargs)
+    plt.close('all')
+
+
+def writeManifest(manifest,manifestFile):
+    """
+    Writes the manifest as json. The file is replaced atomically, so that it can be
+    read while the batch is running.
+    """
+    tempFile = manifestFile + '.tmp'
+    with open(tempFile,'w') as f:
+        json.dump(manifest,f,indent=2,sort_keys=True)
+    if os.name == 'nt' and os.path.exists(manifestFile):
+        os.remove(manifestFile)
+    os.rename(tempFile,manifestFile)
+
+
+def batchFitRawODMData(root,settingsTemplate=None,fitSettingsTemplate=None,nJobs=1,force=False,crop=False,resume=False,cacheDir=None,cacheSize=None,plots=False,manifestFile=None):
+    """
+    Fits all measurements below the target root directory.
+
+    Parameters
+    ----------
+
+    root: string
+        The directory to search for data.csv files.
+    settingsTemplate: string or None
+        An odmSettings.ini file for the measurements that have none.
+    fitSettingsTemplate: string or None
+        A fitSettings.pcl file for the measurements that have none.
+    nJobs: integer
+        The number of measurements to fit at the same time, -1 for all cpu's.
+    force: boolean
+        If True, measurements are also fitted if their results are up to date.
+    crop: boolean
+        Only read the pixels of the fit windows (see FitRawODMData).
+    resume: boolean
+        Only fit the frames that are not in the fit results of an earlier run, e.g.
+        of measurements that have grown (see FitRawODMData).
+    cacheDir, cacheSize:
+        A fit result cache that is shared by all measurements (see FitRawODMData).
+    plots: boolean
+        If True, the plots of the AnalyzeRawODMData script are saved as well.
+    manifestFile: string or None
+        The json file to write the manifest to, odm_batch.json in the root directory
+        by default. The manifest is rewritten after every measurement.
+
+    Returns
+    -------
+
+    The manifest: a dictionary with the 'measurements' (see processMeasurement) and
+    the number of measurements per status.
+    """
+    if manifestFile is None:
+        manifestFile = os.path.join(root,MANIFEST_FILE_NAME)
+    if nJobs < 0:
+        nJobs = cpu_count()
+
+    tasks = [{'dataFile': dataFile,
+              'settingsTemplate': os.path.abspath(settingsTemplate) if settingsTemplate is not None else None,
+              'fitSettingsTemplate': os.path.abspath(fitSettingsTemplate) if fitSettingsTemplate is not None else None,
+              'force': force,
+              'crop': crop,
+              'resume': resume,
+              'cacheDir': os.path.abspath(cacheDir) if cacheDir is not None else None,
+              'cacheSize': cacheSize,
+              'plots': plots} for dataFile in findMeasurements(root)]
+    print "found %i measurements in %s" % (len(tasks),root)
+
+    manifest = {'root': os.path.abspath(root),
+                'started': datetime.datetime.now().isoformat(),
+                'finished': None,
+                'measurements': [],
+                'fitted': 0,
+                'skipped': 0,
+                'failed': 0}
+
+    pool = Pool(nJobs) if nJobs > 1 else None
+    try:
+        #the pool hands out the measurements one by one, as soon as a process is free
+        records = pool.imap_unordered(processMeasurement,tasks) if pool is not None else (processMeasurement(task) for task in tasks)
+        for i,record in enumerate(records):
+            manifest['measurements'].append(record)
+            manifest[record['status']] += 1
+            print "[%i/%i] %s %s (%.1f s)%s" % (i + 1,len(tasks),record['status'],record['dataFile'],record['seconds'],
+                                               ": " + record['error'] if record['error'] else "")
+            writeManifest(manifest,manifestFile)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    manifest['measurements'].sort(key=lambda record: record['dataFile'])
+    manifest['finished'] = datetime.datetime.now().isoformat()
+    writeManifest(manifest,manifestFile)
+    print "%i fitted, %i skipped, %i failed" % (manifest['fitted'],manifest['skipped'],manifest['failed'])
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fits all data.csv files below a directory, without asking for settings.")
+    parser.add_argument("root",type=str,
+                        help="the directory to search for data.csv files")
+    parser.add_argument("--settings-file",dest="odm_settings_file",type=str,default=None,
+                        help="an odmSettings.ini file for the measurements that have none")
+    parser.add_argument("--fitfunction-params-file",dest="fitfunction_params_file",type=str,default=None,
+                        help="a fitSettings.pcl file for the measurements that have none")
+    parser.add_argument("--jobs","-j",dest="jobs",type=int,default=-1,
+                        help="the number of measurements to fit at the same time, -1 for all cpu's")
+    parser.add_argument("--force",dest="force",action="store_true",
+                        help="also fit measurements whose results are up to date")
+    parser.add_argument("--crop",dest="crop",action="store_true",
+                        help="only read the pixels of the fit windows")
+    parser.add_argument("--resume",dest="resume",action="store_true",
+                        help="only fit the frames that are not in the fit results of an earlier run")
+    parser.add_argument("--cache",dest="cache",type=str,default=None,
+                        help="a directory to cache fit results in, shared by all measurements")
+    parser.add_argument("--cache-size",dest="cache_size",type=float,default=1024,
+                        help="the maximum size of the cache in MB")
+    parser.add_argument("--plots",dest="plots",action="store_true",
+                        help="also save the plots that odm_analyze makes")
+    parser.add_argument("--manifest",dest="manifest",type=str,default=None,
+                        help="the json file to write the manifest to (default: odm_batch.json in the root directory)")
+    args = parser.parse_args()
+
+    manifest = batchFitRawODMData(args.root,args.odm_settings_file,args.fitfunction_params_file,nJobs=args.jobs,
+                                  force=args.force,crop=args.crop,resume=args.resume,
+                                  cacheDir=args.cache,cacheSize=int(args.cache_size*1024**2),plots=args.plots,manifestFile=args.manifest)
+    sys.exit(1 if manifest['failed'] else 0)
+
+
+if __name__ == "__main__":
+    main()
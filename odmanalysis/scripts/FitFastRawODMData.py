@@ -25,7 +25,7 @@ from multiprocessing import Process, Queue
 
 
 def readAsync(outputQueue,inputFile):
-    reader = odm.getODMDataReader(inputFile)
+    reader = odm.getODMDataReader(inputFile,dropEmptyProfiles=True)
     for chunk in reader:
         outputQueue.put(chunk)
 
@@ -58,12 +58,12 @@ def main():
             #done
             break            
         
-        rawChunk = rawChunk[rawChunk.intensityProfile.map(len) > 0]
         if len(rawChunk) is not 0:
             processedChunk = dataProcessor.processDataFrame(rawChunk)
             chunkWriter.writeDataFrame(processedChunk)
     
     readerProcess.join()
+    chunkWriter.close()
     
     #make plots
     df = odm.readAnalysisData(outputFilename)
@@ -22,13 +22,141 @@ Created on Sat Aug 17 16:00:14 2013
 import os
 import sys
 import odmanalysis as odm
-import odmanalysis.gui as gui
 import odmanalysis.fitfunctions as ff
+import odmanalysis.AnalysisResults as AnalysisResults
+import odmanalysis.FitResults as FitResults
 import pickle
+import numpy as np
 import argparse
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 
-def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDataFile=None):
+def calculateMovingAndReferencePeakDisplacements(intensityProfiles,movingPeakFitSettings,referencePeakFitSettings,nJobs=1,pInitialMovingPeak=None,pInitialReferencePeak=None,**curveFitKwargs):
+    """
+    Fits the moving peak and, if referencePeakFitSettings is not None, the reference peak
+    in the target intensity profiles with odm.calculatePeakDisplacements.
+    
+    If nJobs is not 1, both peaks are fitted concurrently and share a single pool of
+    nJobs processes (all cpu's for -1).
+    
+    The fits start from pInitialMovingPeak and pInitialReferencePeak, or from the
+    estimates of the fit settings if they are None.
+    
+    Returns
+    -------
+    
+    df_movingPeak, df_referencePeak: the results of odm.calculatePeakDisplacements. 
+        df_referencePeak is None if there is no reference peak.
+    """
+    
+    if nJobs == 1:
+        df_movingPeak = odm.calculatePeakDisplacements(intensityProfiles, movingPeakFitSettings, pInitial=pInitialMovingPeak, **curveFitKwargs)
+        df_referencePeak = None
+        if referencePeakFitSettings is not None:
+            df_referencePeak = odm.calculatePeakDisplacements(intensityProfiles, referencePeakFitSettings, pInitial=pInitialReferencePeak, **curveFitKwargs)
+        return df_movingPeak, df_referencePeak
+    
+    if nJobs < 0:
+        nJobs = cpu_count()
+    processPool = Pool(nJobs)
+    threadPool = ThreadPool(2)
+    try:
+        kwargs = dict(curveFitKwargs, nJobs=nJobs, executor=processPool)
+        movingPeakResult = threadPool.apply_async(odm.calculatePeakDisplacements, (intensityProfiles, movingPeakFitSettings), dict(kwargs, pInitial=pInitialMovingPeak))
+        referencePeakResult = None
+        if referencePeakFitSettings is not None:
+            referencePeakResult = threadPool.apply_async(odm.calculatePeakDisplacements, (intensityProfiles, referencePeakFitSettings), dict(kwargs, pInitial=pInitialReferencePeak))
+        
+        df_movingPeak = movingPeakResult.get()
+        df_referencePeak = referencePeakResult.get() if referencePeakResult is not None else None
+    finally:
+        threadPool.close()
+        processPool.close()
+        processPool.join()
+    
+    return df_movingPeak, df_referencePeak
+
+
+def fitWithCheckpoints(intensityProfiles,movingPeakFitSettings,referencePeakFitSettings,fitResultsPath,resume=False,checkpointInterval=None,nJobs=1,actuatorVoltage=None,**curveFitKwargs):
+    """
+    Fits the moving and reference peaks in the target intensity profiles and writes the
+    fit results to a fit results directory while fitting.
+    
+    Parameters
+    ----------
+    
+    intensityProfiles: pandas.Series or odm.ProfileMatrix
+        The intensity profiles of the measurement.
+    movingPeakFitSettings, referencePeakFitSettings: ODAFitSettings instances
+        The fit settings of the peaks. referencePeakFitSettings may be None.
+    fitResultsPath: string
+        The fit results directory, usually 'fitResults.odmfits'.
+    resume: boolean
+        If True, the frames of which the fit results directory already holds the fit
+        results (see FitResults.countResumableFrames) are not fitted again. The
+        fits of the other frames start from the last existing fit results.
+    checkpointInterval: integer or None
+        The number of frames after which the fit results are written. If None, they
+        are written when all frames have been fitted.
+    nJobs: integer
+        See calculateMovingAndReferencePeakDisplacements.
+    actuatorVoltage: array-like or None
+        The actuator voltage of every profile, for the predictor of the warm start
+        policy (see odm.calculatePeakDisplacements).
+    
+    Returns
+    -------
+    
+    A dictionary with the FitResultStore of every frame by peak name ('mp' and, if
+    there is a reference peak, 'ref').
+    """
+    index = intensityProfiles.index
+    peakNames = ['mp','ref'] if referencePeakFitSettings is not None else ['mp']
+    parts = {name: [] for name in peakNames}
+    pInitial = {name: None for name in peakNames}
+    
+    nDone = 0
+    if resume and os.path.isdir(fitResultsPath):
+        existingStores = FitResults.readFitResults(fitResultsPath,mmap=False)
+        if sorted(existingStores.keys()) == sorted(peakNames):
+            nDone = FitResults.countResumableFrames(existingStores,index)
+        for name in peakNames:
+            if nDone > 0:
+                parts[name].append(existingStores[name].slice(0,nDone))
+                pInitial[name] = FitResults.lastUsableParameters(existingStores[name].slice(0,nDone))
+        print "resuming after %i of %i fitted frames" % (nDone,len(index))
+    
+    writer = FitResults.FitResultsWriter(fitResultsPath,append=nDone > 0)
+    writer.truncate(nDone)
+    try:
+        blockSize = checkpointInterval if checkpointInterval else max(len(index) - nDone,1)
+        for start in range(nDone,len(index),blockSize):
+            block = intensityProfiles.iloc[start:start + blockSize]
+            if actuatorVoltage is not None:
+                curveFitKwargs['actuatorVoltage'] = actuatorVoltage[start:start + blockSize]
+            df_movingPeak, df_referencePeak = calculateMovingAndReferencePeakDisplacements(block, movingPeakFitSettings, referencePeakFitSettings,
+                                                                                          nJobs=nJobs, pInitialMovingPeak=pInitial['mp'],
+                                                                                          pInitialReferencePeak=pInitial.get('ref'), **curveFitKwargs)
+            blockStores = {'mp': FitResults.FitResultStore.fromCurveFitResults(df_movingPeak.curveFitResult)}
+            if df_referencePeak is not None:
+                blockStores['ref'] = FitResults.FitResultStore.fromCurveFitResults(df_referencePeak.curveFitResult)
+            writer.append(blockStores)
+            
+            #the next block starts from the last usable fit, as if it had not been interrupted
+            for name,store in blockStores.items():
+                parts[name].append(store)
+                pInitial[name] = FitResults.lastUsableParameters(store,pInitial[name])
+            if checkpointInterval:
+                print "checkpoint: %i of %i frames fitted" % (start + len(block),len(index))
+    finally:
+        writer.close()
+    
+    return {name: FitResults.FitResultStore.concatenate(parts[name]) if parts[name] else FitResults.FitResultStore.empty(0,0,index)
+            for name in peakNames}
+
+
+def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDataFile=None,lazy=False,nJobs=1,crop=False,saveSettings=True,resume=False,checkpointInterval=None,cacheDir=None,cacheSize=None,predictor=None,predictByVoltage=False):
     """
     This script opens and analyzes the target data.csv file produced by LabVIEW and
     analyzes the optical displacement of a peak relative to another peak.
@@ -43,12 +171,48 @@ def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDat
     referenceIPDataFile: string
         Path the data.csv file of which the first intensity profile will be used
         as a reference for initializing the fit function.
+    lazy: boolean
+        If True, the intensity profiles are memory-mapped from the binary cache
+        of the data file instead of being loaded into memory (see odm.readODMData).
+    nJobs: integer
+        The number of processes to fit with (-1 for all cpu's). If not 1, the
+        moving peak and the reference peak are fitted concurrently.
+    crop: boolean
+        If True and fitSettingsFile is given, only the pixels of the fit windows are
+        read from the intensity profiles (see odm.ProfileRegion). The profiles are
+        binned if the horizontal binning of the settings is larger than 1.
+    saveSettings: boolean
+        If True, the settings are saved as defaults, to the odmSettings.ini file and
+        to fitSettings.pcl. If False, only the results are written, so that settings
+        files that are shared by several measurements are not touched.
+    resume: boolean
+        If True, only the frames that are not in the fit results of an earlier run
+        (fitResults.odmfits) are fitted, e.g. after the measurement has grown or the
+        earlier run was interrupted. See fitWithCheckpoints.
+    checkpointInterval: integer or None
+        The number of frames after which the fit results are written, so that an
+        interrupted run can be resumed from the last checkpoint.
+    cacheDir: string or None
+        A directory with a cache of fit results (see odm.FitResultCache). Blocks of
+        profiles that have been fitted before with the same settings are not fitted
+        again.
+    cacheSize: integer or None
+        The maximum size of the cache in bytes.
+    predictor: string or None
+        The predictor of the initial parameters of every fit from the previous fits:
+        'previous', 'linear' or 'kalman', or None for the default of
+        odm.WarmStartPolicy.
+    predictByVoltage: boolean
+        If True, the initial parameters are predicted from the actuator voltage and
+        actuation direction instead of the frame number.
+    
+    If settingsFile or fitSettingsFile is None, the settings are asked from the user.
     
     
     Returns
     -------
     
-    dataframe: pandas.DataFrame
+    dataframe: pandas.DataFrame or odm.LazyODMData
         A dataframe that contains the raw data, the calculated displacements,
         curve fit results and other diagnostic data.
     movingPeakFitSettings : CurveFitSettings instance
@@ -62,12 +226,13 @@ def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDat
     commonPath = os.path.abspath(os.path.split(filename)[0])
     measurementName = os.path.split(os.path.split(filename)[0])[1]
     
-    globalSettings = odm.CurveFitSettings.loadFromFileOrCreateDefault('./CurveFitScriptSettings.ini')
-    
+    globalSettings = None
     if (settingsFile is not None):
         print "reading settings from %s" % settingsFile
         settings = odm.CurveFitSettings.loadFromFile(settingsFile)
     else:
+        import odmanalysis.gui as gui
+        globalSettings = odm.CurveFitSettings.loadFromFileOrCreateDefault('./CurveFitScriptSettings.ini')
         settings = odm.CurveFitSettings.loadFromFileOrCreateDefault(commonPath + '/odmSettings.ini',prototype=globalSettings)
         gui.getSettingsFromUser(settings)
 
@@ -75,25 +240,39 @@ def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDat
     
 
     
-    df = odm.readODMData(filename)
+    if (fitSettingsFile is not None):
+        with file(fitSettingsFile,'r') as f:
+            print "reading fit settings from %s" % fitSettingsFile
+            settingsDict = pickle.load(f)
+            movingPeakFitSettings = settingsDict['movingPeakFitSettings']
+            referencePeakFitSettings = settingsDict['referencePeakFitSettings']
+    elif crop:
+        print "the profiles are not cropped, because there is no fit settings file"
+    
+    if crop and fitSettingsFile is not None:
+        region = odm.ProfileRegion.fromFitSettings([movingPeakFitSettings,referencePeakFitSettings],settings.hozontalBinning)
+    elif settings.hozontalBinning > 1:
+        region = odm.ProfileRegion(binning=settings.hozontalBinning)
+    else:
+        region = None
+    if region is not None:
+        print "reading the profiles in %s" % region
+    
+    df = odm.readODMData(filename,lazy=lazy,region=region)
     
-    if referenceIPDataFile is not None:
+    if referenceIPDataFile is not None or region is not None:
+        #the fit functions are initialized with a profile in measured pixel coordinates
+        referenceIPDataFile = referenceIPDataFile if referenceIPDataFile is not None else filename
         print "using the first profile from %s for initializing the fit functions" % referenceIPDataFile
-        for chunk in odm.getODMDataReader(referenceIPDataFile, chunksize=1):
+        for chunk in odm.getODMDataReader(referenceIPDataFile, chunksize=1, dropEmptyProfiles=True):
             referenceIntensityProfile = chunk.intensityProfile.iloc[0]
             break
     else:
         referenceIntensityProfile = df.intensityProfile.iloc[0]
     
 
-    if (fitSettingsFile is not None):
-        with file(fitSettingsFile,'r') as f:
-            print "reading fit settings from %s" % fitSettingsFile
-            settingsDict = pickle.load(f)
-            movingPeakFitSettings = settingsDict['movingPeakFitSettings']
-            referencePeakFitSettings = settingsDict['referencePeakFitSettings']
-        
-    else:
+    if (fitSettingsFile is None):
+        import odmanalysis.gui as gui
         movingPeakFitFunction = ff.createFitFunction(settings.defaultFitFunction)
         movingPeakFitSettings = gui.getPeakFitSettingsFromUser(referenceIntensityProfile,movingPeakFitFunction,
                                                            estimatorPromptPrefix="Moving peak:",
@@ -111,19 +290,31 @@ def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDat
     
 
     movingPeakFitSettings.referenceIntensityProfile = referenceIntensityProfile
-    referencePeakFitSettings.referenceIntensityProfile = referenceIntensityProfile
+    if (referencePeakFitSettings is not None):
+        referencePeakFitSettings.referenceIntensityProfile = referenceIntensityProfile
 
 
 
 
     print "fitting a %s function..." % settings.defaultFitFunction
-    df_movingPeak = odm.calculatePeakDisplacements(df.intensityProfile, movingPeakFitSettings, factor=100,maxfev=20000)
+    intensityProfiles = odm.getIntensityProfileMatrix(df,region) if region is not None and not lazy else df.intensityProfile
+    cache = None
+    if cacheDir is not None:
+        cache = odm.FitResultCache(cacheDir,cacheSize) if cacheSize is not None else odm.FitResultCache(cacheDir)
+    actuatorVoltage = np.asarray(df.actuatorVoltage,dtype=float) if predictByVoltage else None
+    fitResultStores = fitWithCheckpoints(intensityProfiles, movingPeakFitSettings, referencePeakFitSettings, FitResults.getFitResultsPath(commonPath),
+                                         resume=resume, checkpointInterval=checkpointInterval, nJobs=nJobs, actuatorVoltage=actuatorVoltage, cache=cache,
+                                         warmStartPolicy=odm.WarmStartPolicy(predictor=predictor) if predictor is not None else odm.WarmStartPolicy(),
+                                         factor=100, maxfev=20000)
+    if cache is not None:
+        print "%i of %i fits were found in the cache" % (cache.hits,cache.hits + cache.misses)
     
+    df_movingPeak = odm.getPeakDisplacementDataFrame(fitResultStores['mp'],movingPeakFitSettings.fitFunction)
     df_movingPeak.rename(columns = lambda columnName: columnName + "_mp",inplace=True)
     df = df.join(df_movingPeak)
     
     if (referencePeakFitSettings is not None):
-        df_referencePeak = odm.calculatePeakDisplacements(df.intensityProfile, referencePeakFitSettings, factor=100,maxfev=20000)
+        df_referencePeak = odm.getPeakDisplacementDataFrame(fitResultStores['ref'],referencePeakFitSettings.fitFunction)
         df_referencePeak.rename(columns = lambda columnName: columnName + "_ref",inplace=True)
         df = df.join(df_referencePeak)
         df['displacement'] = df.displacement_mp - df.displacement_ref
@@ -132,13 +323,15 @@ def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDat
     
     
     #save settings
-    sys.stdout.write("saving defaults...")
-    globalSettings.saveToFile()
-    sys.stdout.write("done\r\n")
-    
-    sys.stdout.write("saving local setting file...")
-    settings.saveToFile()
-    sys.stdout.write("done\r\n")
+    if saveSettings:
+        if globalSettings is not None:
+            sys.stdout.write("saving defaults...")
+            globalSettings.saveToFile()
+            sys.stdout.write("done\r\n")
+        
+        sys.stdout.write("saving local setting file...")
+        settings.saveToFile()
+        sys.stdout.write("done\r\n")
     
     print "done"    
     
@@ -150,21 +343,18 @@ def fitRawODMData(filename,settingsFile=None,fitSettingsFile=None,referenceIPDat
     df[exportColumns].to_csv(os.path.join(commonPath,'odmanalysis.csv'),index_label='timestamp')
     sys.stdout.write("done\r\n")
     
-    #save fit results as pickled dataframe
-    sys.stdout.write("pickling fit results dataframe as pcl file...")
-    fitResultColumns = ['curveFitResult_mp']
-    if 'curveFitResult_ref' in df.columns:
-        fitResultColumns += ['curveFitResult_ref']
-    df[fitResultColumns].to_pickle(commonPath + '/fitResults.pcl')
+    sys.stdout.write("saving dataframe as binary results...")
+    AnalysisResults.writeAnalysisResults(df[exportColumns],os.path.join(commonPath,'odmanalysis' + AnalysisResults.RESULTS_EXTENSION))
     sys.stdout.write("done\r\n")
     
     #save the used fit functions and fit settings as pickled objects
-    sys.stdout.write("pickling fit functions and settings...")
-    settingsDict = {'movingPeakFitSettings': movingPeakFitSettings,
-                             'referencePeakFitSettings': referencePeakFitSettings if referencePeakFitSettings is not None else None}
-    with file(commonPath+'/fitSettings.pcl','w') as stream:
-        pickle.dump(settingsDict,stream)
-    sys.stdout.write("done\r\n")
+    if saveSettings:
+        sys.stdout.write("pickling fit functions and settings...")
+        settingsDict = {'movingPeakFitSettings': movingPeakFitSettings,
+                                 'referencePeakFitSettings': referencePeakFitSettings if referencePeakFitSettings is not None else None}
+        with file(commonPath+'/fitSettings.pcl','w') as stream:
+            pickle.dump(settingsDict,stream)
+        sys.stdout.write("done\r\n")
     
     print "ALL DONE"
     
@@ -180,11 +370,30 @@ def main():
     		help="an odmSettings.ini file to get the settings from")
     parser.add_argument("--fitfunction-params-file",dest="fitfunction_params_file",type=str,default=None,
     		help="a json file with the fitfunction parameters to use")
+    parser.add_argument("--lazy",dest="lazy",action="store_true",
+    		help="memory-map the intensity profiles instead of loading them into memory")
+    parser.add_argument("--jobs","-j",dest="jobs",type=int,default=1,
+    		help="the number of processes to fit with, -1 for all cpu's")
+    parser.add_argument("--crop",dest="crop",action="store_true",
+    		help="only read the pixels of the fit windows of the fit function params file")
+    parser.add_argument("--resume",dest="resume",action="store_true",
+    		help="only fit the frames that are not in the fit results of an earlier run")
+    parser.add_argument("--checkpoint-interval",dest="checkpoint_interval",type=int,default=None,
+    		help="write the fit results every N frames, so that an interrupted run can be resumed")
+    parser.add_argument("--cache",dest="cache",type=str,default=None,
+    		help="a directory to cache fit results in, so that refitting the same profiles with the same settings is instant")
+    parser.add_argument("--cache-size",dest="cache_size",type=float,default=1024,
+    		help="the maximum size of the cache in MB")
+    parser.add_argument("--predictor",dest="predictor",choices=sorted(odm.WarmStart.PREDICTORS),default=None,
+    		help="how the initial parameters of every fit are predicted from the previous fits")
+    parser.add_argument("--predict-by-voltage",dest="predict_by_voltage",action="store_true",
+    		help="predict the initial parameters from the actuator voltage instead of the frame number")
     args = parser.parse_args()
 
     if (not args.datafile is None and os.path.exists(args.datafile) and os.path.isfile(args.datafile)):
         datafile = args.datafile
     else:
+        import odmanalysis.gui as gui
         datafile = gui.get_path("*.csv",defaultFile="data.csv")
         
     if (not args.odm_settings_file is None and os.path.exists(args.odm_settings_file) and os.path.isfile(args.odm_settings_file)):
@@ -197,7 +406,10 @@ def main():
     else:
         ffSettingsFile = None
 
-    df,movingPeakFitSettings,referencePeakFitSettings,measurementName = fitRawODMData(datafile,settingsFile=odmSettingsFile,fitSettingsFile=ffSettingsFile)
+    df,movingPeakFitSettings,referencePeakFitSettings,measurementName = fitRawODMData(datafile,settingsFile=odmSettingsFile,fitSettingsFile=ffSettingsFile,lazy=args.lazy,nJobs=args.jobs,crop=args.crop,
+                                                                                    resume=args.resume,checkpointInterval=args.checkpoint_interval,
+                                                                                    cacheDir=args.cache,cacheSize=int(args.cache_size*1024**2),
+                                                                                    predictor=args.predictor,predictByVoltage=args.predict_by_voltage)
     
     
 if __name__ == "__main__":
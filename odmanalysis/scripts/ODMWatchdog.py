@@ -24,9 +24,10 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import sys
 import os
-from Queue import Queue, Full
-import odmanalysis.gui as gui
-from odmanalysis.chunkhandling import ChunkedODMDataProcessor, ChunkReader, ChunkWriter, ReturnActionConsumerThread
+import json
+import signal
+import argparse
+from odmanalysis.chunkhandling import ChunkedODMDataProcessor, ChunkReader, ChunkWriter, StreamingPipeline
 
 class OMDCsvChunkHandler(FileSystemEventHandler):
     """
@@ -35,78 +36,176 @@ class OMDCsvChunkHandler(FileSystemEventHandler):
     Description
     -----------
     
-    This class hosts three consumer/producer threads for the following functions
+    This class hosts a StreamingPipeline of consumer/producer threads for the following functions
     
         - producer: reading chunks of data from the input file.
         - consumer-producer: processing chunks of data
         - consumer: writing chunks of data to the output file
         
-    When a change is detected on the target input file a flag is raised to the
-    'reader' thread to read a chunk of data. This chunk is then passed on to the
-    dataProcessing consumer thread where the displacement is detected and stored to an
-    output dataframe. This dataframe is passed to the outputwriter consumer thread that
-    writes it to the output csv file.
+    When a change is detected on the target input file the pipeline is notified and
+    the 'reader' thread reads the new data in chunks. These chunks are passed on to the
+    dataProcessing consumer thread where the displacement is detected. The results are
+    passed to the outputwriter consumer thread that appends them to the output csv file.
+    
+    The threads are connected by bounded queues (see StreamingPipeline for the 'block'
+    and 'drop' policies). With more than one worker, the chunks are fitted in a pool
+    of processes and put back in order before they are written.
     """    
     
-    def __init__(self,inputFile,outputFile):
-        self.inputFile = inputFile
-        
-        self.fileQueue = Queue(1)
-        self.rawDataframeQueue = Queue()
-        self.processedDataframeQueue = Queue()
+    def __init__(self,inputFile,outputFile,dataProcessor=None,queueSize=4,policy='block',maxChunkBytes=None,nWorkers=1):
+        """
+        Parameters
+        ----------
         
-        self.chunkReader = ChunkReader(inputFile)
-        self.dataProcessor = ChunkedODMDataProcessor(os.path.abspath(os.path.split(inputFile)[0]))
-        self.chunkWriter = ChunkWriter(outputFile)
+        inputFile: string
+            Path to the data.csv file that is being written.
+        outputFile: string
+            Path to the csv file to write the results to.
+        dataProcessor: ChunkedODMDataProcessor or None
+            The processor of the chunks. By default an interactive processor that asks
+            the fit settings from the user.
+        queueSize: integer
+            The maximum number of chunks in the queues between the threads.
+        policy: 'block' or 'drop'
+            What to do when the processor cannot keep up with the reader.
+        maxChunkBytes: integer or None
+            The maximum number of bytes of the data file to read per chunk.
+        nWorkers: integer
+            The number of processes to fit the chunks with, -1 for all cpu's.
+        """
+        self.inputFile = os.path.abspath(inputFile)
         
-        self.fileConsumerThread = ReturnActionConsumerThread(self.chunkReader.read_next,self.fileQueue,self.rawDataframeQueue)
-        self.odmProcessorThread = ReturnActionConsumerThread(self.dataProcessor.processDataFrame,self.rawDataframeQueue,self.processedDataframeQueue)
-        self.outputWriterThread = ReturnActionConsumerThread(self.chunkWriter.writeDataFrame,self.processedDataframeQueue)
+        if dataProcessor is None:
+            dataProcessor = ChunkedODMDataProcessor(os.path.split(self.inputFile)[0])
         
+        self.chunkReader = ChunkReader(inputFile,maxBytes=maxChunkBytes)
+        self.dataProcessor = dataProcessor
+        self.chunkWriter = ChunkWriter(outputFile)
+        self.pipeline = StreamingPipeline(self.chunkReader,self.dataProcessor,self.chunkWriter,queueSize=queueSize,policy=policy,nWorkers=nWorkers)
         
         
     def on_modified(self, event):
-        if (event.src_path == self.inputFile):
-            try:
-                self.fileQueue.put((),block=False)
-            except Full:
-                pass
+        if (os.path.abspath(event.src_path) == self.inputFile):
+            self.pipeline.notify()
+    
+    on_created = on_modified
     
     def startPCChain(self):
-        self.fileConsumerThread.start()
-        self.odmProcessorThread.start()
-        self.outputWriterThread.start()
+        self.pipeline.start()
+        self.pipeline.notify()
     
-    def stopPCChain(self):
-        pass
+    def stopPCChain(self,timeout=None):
+        """
+        Processes the data that has not been processed yet, flushes and closes the
+        output file and stops the threads.
+        """
+        return self.pipeline.stop(timeout)
+    
+    def getMetrics(self):
+        return self.pipeline.getMetrics()
         
 
+def writeMetrics(metrics,metricsFile):
+    """
+    Writes the pipeline metrics as json. The file is replaced atomically, so that
+    other processes never read a partially written file.
+    """
+    tempFile = metricsFile + '.tmp'
+    with open(tempFile,'w') as f:
+        json.dump(metrics,f,indent=2,sort_keys=True)
+    if os.name == 'nt' and os.path.exists(metricsFile):
+        os.remove(metricsFile)
+    os.rename(tempFile,metricsFile)
+
+
+def formatMetrics(metrics):
+    stages = metrics['stages']
+    latency = metrics['lastEndToEndLatency']
+    return "%i rows read, latency %s s (max %.2f s), queues %s, %i chunks dropped, %i errors" % (
+        metrics['rowsRead'],
+        "%.2f" % latency if latency is not None else "-",
+        metrics['maxEndToEndLatency'],
+        "/".join("%i" % stages[name]['queueDepth'] for name in ['processor','writer']),
+        metrics['dropped'],
+        sum(stage['errors'] for stage in stages.values()))
+
+
 def main():
-    if (len(sys.argv) > 1 and os.path.exists(sys.argv[1]) and os.path.isfile(sys.argv[1])):
-        filename = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Analyzes a data.csv file while it is being written by a measurement.")
+    parser.add_argument("datafile",type=str,nargs="?",default=None)
+    parser.add_argument("--output",dest="output",type=str,default=None,
+                        help="the csv file to write the results to (default: odmanalysis.csv next to the data file)")
+    parser.add_argument("--fitfunction-params-file",dest="fitfunction_params_file",type=str,default=None,
+                        help="a fitSettings.pcl file with the fit settings to use. If given, or if there is one next to the data file, no gui is shown")
+    parser.add_argument("--interactive",dest="interactive",action="store_true",
+                        help="ask the fit settings from the user, even if there is a fitSettings.pcl file")
+    parser.add_argument("--queue-size",dest="queue_size",type=int,default=4,
+                        help="the maximum number of chunks waiting between the reading, fitting and writing threads")
+    parser.add_argument("--policy",dest="policy",choices=['block','drop'],default='block',
+                        help="when fitting cannot keep up: 'block' reads larger chunks later, 'drop' discards the oldest unfitted chunks")
+    parser.add_argument("--max-chunk-bytes",dest="max_chunk_bytes",type=int,default=1000000,
+                        help="the maximum number of bytes to read from the data file per chunk")
+    parser.add_argument("--jobs","-j",dest="jobs",type=int,default=1,
+                        help="the number of processes to fit with, -1 for all cpu's")
+    parser.add_argument("--poll-interval",dest="poll_interval",type=float,default=1.,
+                        help="seconds between checks of the data file in addition to filesystem events")
+    parser.add_argument("--metrics-file",dest="metrics_file",type=str,default=None,
+                        help="a json file to write the latency and queue metrics to")
+    parser.add_argument("--metrics-interval",dest="metrics_interval",type=float,default=10.,
+                        help="seconds between metrics reports")
+    args = parser.parse_args()
+    
+    if args.datafile is not None and os.path.isfile(args.datafile):
+        filename = args.datafile
     else:
+        import odmanalysis.gui as gui
         filename = gui.get_path("*.csv",defaultFile="data.csv")
     
     commonPath = os.path.abspath(os.path.split(filename)[0])
-    outputFile = os.path.join(commonPath, "odmanalysis.csv")
+    outputFile = args.output if args.output is not None else os.path.join(commonPath, "odmanalysis.csv")
+    
+    fitSettingsFile = args.fitfunction_params_file
+    if fitSettingsFile is None and not args.interactive and os.path.isfile(os.path.join(commonPath,'fitSettings.pcl')):
+        fitSettingsFile = os.path.join(commonPath,'fitSettings.pcl')
+    
+    if fitSettingsFile is not None:
+        print "reading fit settings from %s" % fitSettingsFile
+        dataProcessor = ChunkedODMDataProcessor.fromFitSettingsFile(commonPath,fitSettingsFile)
+    else:
+        dataProcessor = ChunkedODMDataProcessor(commonPath)
     
     print "Now watching %s for changes" % filename
-    handler = OMDCsvChunkHandler(filename,outputFile)
+    handler = OMDCsvChunkHandler(filename,outputFile,dataProcessor,queueSize=args.queue_size,policy=args.policy,maxChunkBytes=args.max_chunk_bytes,nWorkers=args.jobs)
     observer = Observer()
     observer.schedule(handler, path=commonPath, recursive=False)
     handler.startPCChain()
     observer.start()
-
+    
+    def terminate(signum,frame):
+        raise SystemExit()
+    signal.signal(signal.SIGTERM,terminate)
+    
+    lastReport = time.time()
     try:
         while True:
-            time.sleep(1)
+            time.sleep(args.poll_interval)
+            handler.pipeline.notify()
+            if time.time() - lastReport >= args.metrics_interval:
+                lastReport = time.time()
+                metrics = handler.getMetrics()
+                print formatMetrics(metrics)
+                if args.metrics_file is not None:
+                    writeMetrics(metrics,args.metrics_file)
                 
     except (KeyboardInterrupt, SystemExit):
         print "Stopping..."
         observer.stop()
-        time.sleep(1)
     observer.join()
+    handler.stopPCChain()
+    if args.metrics_file is not None:
+        writeMetrics(handler.getMetrics(),args.metrics_file)
+    print formatMetrics(handler.getMetrics())
     
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -90,7 +90,7 @@ def main():
     measurementName = _os.path.split(_os.path.split(filename)[0])[1]
     
         
-    df = _odm.readODMData(filename)
+    df = _odm.readODMData(filename,lazy=True)
     
     app = qt.QApplication(_sys.argv)
     stepViewer = InteractiveStepViewer(df)
@@ -0,0 +1,111 @@
+import unittest
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import odmanalysis as odm
+import odmanalysis.fitfunctions as ff
+import odmanalysis.FitResults as FitResults
+import odmanalysis.scripts.BatchFitRawODMData as BatchFitRawODMData
+from odmanalysis.tests.test_streaming import writePeakDataFile
+
+
+def writeFitSettingsFile(path):
+    fitSettings = odm.ODAFitSettings(ff.ScaledSpline(),{'minBound': (20,0),'maxBound': (70,0)})
+    with open(path,'w') as f:
+        pickle.dump({'movingPeakFitSettings': fitSettings, 'referencePeakFitSettings': None},f)
+
+
+class Test_BatchFitRawODMData(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def addMeasurement(self,name,fitSettings=True):
+        folder = os.path.join(self.root,name)
+        os.makedirs(folder)
+        dataFile = os.path.join(folder,'data.csv')
+        writePeakDataFile(dataFile,nRows=50)
+        if fitSettings:
+            writeFitSettingsFile(os.path.join(folder,'fitSettings.pcl'))
+        return dataFile
+
+    def test_findMeasurements(self):
+        for name in ['b','a/sub','a']:
+            folder = os.path.join(self.root,name)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            open(os.path.join(folder,'data.csv'),'w').close()
+        os.makedirs(os.path.join(self.root,'c'))
+        open(os.path.join(self.root,'c','other.csv'),'w').close()
+
+        expected = [os.path.join(self.root,name,'data.csv') for name in ['a','a/sub','b']]
+        self.assertEqual(BatchFitRawODMData.findMeasurements(self.root),expected)
+
+    def test_copyTemplates(self):
+        dataFile = self.addMeasurement('a',fitSettings=False)
+        self.assertRaises(IOError,BatchFitRawODMData.copyTemplates,dataFile)
+
+        template = os.path.join(self.root,'template.pcl')
+        writeFitSettingsFile(template)
+        BatchFitRawODMData.copyTemplates(dataFile,fitSettingsTemplate=template)
+        self.assertTrue(os.path.isfile(os.path.join(self.root,'a','fitSettings.pcl')))
+        self.assertTrue(os.path.isfile(os.path.join(self.root,'a','odmSettings.ini')))
+
+    def test_upToDateMeasurementsAreSkipped(self):
+        dataFile = self.addMeasurement('a')
+        self.assertFalse(BatchFitRawODMData.isUpToDate(dataFile))
+
+        manifest = BatchFitRawODMData.batchFitRawODMData(self.root)
+        self.assertEqual(manifest['fitted'],1)
+        self.assertEqual(manifest['measurements'][0]['profiles'],50)
+        self.assertTrue(BatchFitRawODMData.isUpToDate(dataFile))
+
+        manifest = BatchFitRawODMData.batchFitRawODMData(self.root)
+        self.assertEqual((manifest['fitted'],manifest['skipped']),(0,1))
+
+        #a data file that is newer than the results is fitted again
+        resultsTime = os.path.getmtime(os.path.join(self.root,'a','odmanalysis.csv'))
+        os.utime(dataFile,(resultsTime + 10,resultsTime + 10))
+        self.assertFalse(BatchFitRawODMData.isUpToDate(dataFile))
+        manifest = BatchFitRawODMData.batchFitRawODMData(self.root)
+        self.assertEqual((manifest['fitted'],manifest['skipped']),(1,0))
+
+    def test_resume(self):
+        #the fit settings file holds a ScaledSpline without a spline
+        dataFile = self.addMeasurement('a')
+        BatchFitRawODMData.batchFitRawODMData(self.root)
+        resultsFile = os.path.join(self.root,'a','odmanalysis.csv')
+        expected = pd.read_csv(resultsFile)
+
+        writer = FitResults.FitResultsWriter(FitResults.getFitResultsPath(os.path.join(self.root,'a')),append=True)
+        writer.truncate(20)
+        writer.close()
+        manifest = BatchFitRawODMData.batchFitRawODMData(self.root,force=True,resume=True)
+        self.assertEqual(manifest['fitted'],1)
+        df = pd.read_csv(resultsFile)
+        self.assertTrue(np.allclose(df.displacement,expected.displacement))
+
+    def test_failedMeasurementInManifest(self):
+        self.addMeasurement('a')
+        failedDataFile = self.addMeasurement('b',fitSettings=False)
+        manifestFile = os.path.join(self.root,'manifest.json')
+
+        BatchFitRawODMData.batchFitRawODMData(self.root,manifestFile=manifestFile)
+        with open(manifestFile) as f:
+            manifest = json.load(f)
+        self.assertEqual((manifest['fitted'],manifest['failed']),(1,1))
+        record = manifest['measurements'][1]
+        self.assertEqual(record['dataFile'],failedDataFile)
+        self.assertEqual(record['status'],'failed')
+        self.assertTrue(record['error'].startswith('IOError'))
+        self.assertTrue(os.path.isfile(os.path.join(self.root,'b','odm_batch.log')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import odmanalysis as odm
+from odmanalysis import RawDataCache, AnalysisResults, FitResults
+from odmanalysis.chunkhandling import ChunkReader
+
+
+def writeDataFile(path,nRows=20,nPixels=16):
+    with open(path,'w') as f:
+        f.write("Timestamp\tRelative time (s)\tActuator Voltage (V)\tIntensity Profile\n")
+        for i in range(nRows):
+            profile = "<%s>" % ";".join(str(100 + i + j) for j in range(nPixels)) if i != 2 else "<>"
+            f.write("10/18/2026 12:00:%02i.000\t%f\t%f\t%s\n" % (i,i*1.0,abs(i % 10 - 5),profile))
+
+
+class Test_ParseIntensityProfiles(unittest.TestCase):
+    def test_parseIntensityProfiles(self):
+        profiles,nonEmpty = odm.parseIntensityProfiles(["<1;2;3>","<>","<4;5;6>"])
+        self.assertEqual(profiles.shape,(2,3))
+        self.assertTrue(np.array_equal(nonEmpty,[True,False,True]))
+        self.assertTrue(np.array_equal(profiles[1],odm.ipStringToArray("<4;5;6>")))
+
+    def test_unequalLengthsRaise(self):
+        self.assertRaises(ValueError,odm.parseIntensityProfiles,["<1;2;3>","<4;5>"])
+        #the lengths add up to 3 profiles of 3 pixels
+        self.assertRaises(ValueError,odm.parseIntensityProfiles,["<1;2;3>","<4;5>","<6;7;8;9>"])
+        region = odm.ProfileRegion(0,2)
+        self.assertRaises(ValueError,odm.parseIntensityProfiles,["<1;2;3;4;5;6>","<1>","<1;2;3;4;5;6;7;8;9;10;11>"],region=region)
+
+
+class Test_ProfileMatrix(unittest.TestCase):
+    def test_fromSeriesSharesMemory(self):
+        profiles = odm.ProfileMatrix(np.arange(12).reshape((4,3)))
+        series = profiles.toSeries()
+        self.assertTrue(np.shares_memory(odm.ProfileMatrix.fromSeries(series).data,profiles.data))
+        self.assertTrue(np.shares_memory(odm.ProfileMatrix.fromSeries(series.iloc[1:3]).data,profiles.data))
+
+    def test_indexing(self):
+        profiles = odm.ProfileMatrix(np.arange(12).reshape((4,3)),index=list('abcd'))
+        self.assertTrue(np.array_equal(profiles.iloc[1],[3,4,5]))
+        masked = profiles[np.array([True,False,True,False])]
+        self.assertEqual(list(masked.index),['a','c'])
+        self.assertEqual(profiles.crop(1,3).shape,(4,2))
+
+
+class Test_ProfileRegion(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dataFile = os.path.join(self.folder,'data.csv')
+        writeDataFile(self.dataFile,nPixels=40)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_parseRegion(self):
+        ipStrings = ["<%s>" % ";".join(str(10*i + j) for j in range(40)) for i in range(3)]
+        full,nonEmpty = odm.parseIntensityProfiles(ipStrings)
+        for region in [odm.ProfileRegion(5,12),odm.ProfileRegion(5,30),odm.ProfileRegion(4,12,binning=4)]:
+            profiles,nonEmpty = odm.parseIntensityProfiles(ipStrings,region=region)
+            self.assertTrue(np.array_equal(profiles,region.apply(full)))
+        self.assertTrue(np.array_equal(profiles[0],[5.5,9.5]))
+
+    def test_fromFitSettings(self):
+        region = odm.ProfileRegion.fromFitSettings([odm.ODAFitSettings(None,{'minBound': (10,0),'maxBound': (15,0)}),
+                                                      odm.ODAFitSettings(None,{'minBound': (20,0),'maxBound': (25,0)}),None],binning=2)
+        self.assertEqual((region.xmin,region.xmax,region.binning),(10,26,2))
+
+    def test_readRegion(self):
+        region = odm.ProfileRegion(10,18,binning=2)
+        full = odm.getIntensityProfileMatrix(odm.readODMData(self.dataFile))
+        for useCache in [True,False]:
+            profiles = odm.getIntensityProfileMatrix(odm.readODMData(self.dataFile,useCache=useCache,region=region),region)
+            self.assertTrue(np.array_equal(profiles.data,region.apply(full.data)))
+            self.assertTrue(np.array_equal(profiles.pixelCoordinates,[10.5,12.5,14.5,16.5]))
+        lazy = odm.readODMData(self.dataFile,lazy=True,region=odm.ProfileRegion(10,18))
+        self.assertTrue(np.array_equal(lazy.intensityProfile.data,full.data[:,10:18]))
+
+        xdata,window = profiles.window(12,17)
+        self.assertTrue(np.array_equal(xdata,[12.5,14.5,16.5]))
+        #the profiles of the data file are linear, so interpolation restores them
+        fullWidth = profiles.fullWidthProfile(0)
+        self.assertEqual(len(fullWidth),18)
+        self.assertTrue(np.allclose(fullWidth[11:17],full.data[0,11:17]))
+
+
+class Test_ActuationDirectionAndCycle(unittest.TestCase):
+    def setUp(self):
+        voltage = np.abs(np.arange(40) % 10 - 5.)
+        self.df = pd.DataFrame({'actuatorVoltage': voltage})
+
+    def test_directionAndCycle(self):
+        df = odm.getActuationDirectionAndCycle(self.df,inplace=False)
+        self.assertEqual(list(df.direction[:7]),['forward'] + ['backward']*5 + ['forward'])
+        self.assertEqual(df.cycleNumber.dtype,np.int32)
+        self.assertEqual(list(df.cycleNumber[[0,5,6,15,16]]),[1,1,2,2,3])
+
+    def test_incremental(self):
+        expected = odm.getActuationDirectionAndCycle(self.df,inplace=False)
+        state = None
+        for start in range(0,40,7):
+            block,state = odm.getActuationDirectionAndCycleIncremental(self.df.iloc[start:start + 7],state,inplace=False)
+            self.assertTrue((block.direction == expected.direction.iloc[start:start + 7]).all())
+            self.assertTrue((block.cycleNumber == expected.cycleNumber.iloc[start:start + 7]).all())
+        self.assertEqual(state.cycleNumber,expected.cycleNumber.iloc[-1])
+
+
+class Test_RawDataCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dataFile = os.path.join(self.folder,'data.csv')
+        writeDataFile(self.dataFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_cacheRoundTrip(self):
+        df = odm.readODMData(self.dataFile)
+        self.assertEqual(len(df),19)
+        self.assertTrue(RawDataCache.isCacheValid(self.dataFile))
+
+        dfCached = odm.readODMData(self.dataFile)
+        self.assertTrue((df.index == dfCached.index).all())
+        self.assertTrue(np.array_equal(odm.getIntensityProfileMatrix(df).data,odm.getIntensityProfileMatrix(dfCached).data))
+
+    def test_cacheInvalidatedByChange(self):
+        odm.readODMData(self.dataFile)
+        writeDataFile(self.dataFile,nRows=25)
+        self.assertFalse(RawDataCache.isCacheValid(self.dataFile))
+        self.assertEqual(len(odm.readODMData(self.dataFile)),24)
+
+    def test_unparsedTimestamps(self):
+        with open(self.dataFile) as f:
+            lines = f.readlines()
+        with open(self.dataFile,'w') as f:
+            f.write(lines[0])
+            f.writelines("frame %i%s" % (i,line[line.index("\t"):]) for i,line in enumerate(lines[1:]))
+        for i in range(2):
+            self.assertEqual(len(odm.readODMData(self.dataFile)),19)
+        self.assertFalse(os.path.exists(RawDataCache.getCachePath(self.dataFile)))
+        self.assertRaises(ValueError,odm.readODMData,self.dataFile,lazy=True)
+        self.assertFalse(os.path.exists(RawDataCache.getCachePath(self.dataFile) + '.tmp'))
+
+    def test_unloadableCacheIsMiss(self):
+        odm.readODMData(self.dataFile)
+        #timestamps as python objects, which cannot be memory-mapped
+        np.save(os.path.join(RawDataCache.getCachePath(self.dataFile),'timestamp.npy'),np.array(["frame %i" % i for i in range(19)],dtype=object))
+        self.assertTrue(RawDataCache.isCacheValid(self.dataFile))
+        self.assertIsNone(RawDataCache.readRawDataCache(self.dataFile))
+        self.assertEqual(len(odm.readODMData(self.dataFile)),19)
+        self.assertEqual(len(odm.readODMData(self.dataFile,lazy=True)),19)
+
+    def test_lazyRead(self):
+        df = odm.readODMData(self.dataFile,useCache=False)
+        lazy = odm.readODMData(self.dataFile,lazy=True)
+        self.assertEqual(len(lazy),len(df))
+        self.assertTrue(isinstance(lazy.intensityProfile.data.base,np.memmap))
+        self.assertTrue(np.array_equal(lazy.intensityProfile.iloc[5],df.intensityProfile.iloc[5]))
+        self.assertTrue((lazy.cycleNumber == df.cycleNumber).all())
+
+        forward = lazy[lazy.direction == 'forward']
+        self.assertEqual(len(forward.intensityProfile),(df.direction == 'forward').sum())
+
+
+class Test_AnalysisResults(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.csvFile = os.path.join(self.folder,'odmanalysis.csv')
+        index = pd.date_range('2026-10-18 12:00',periods=20,freq='10ms',name='timestamp')
+        self.df = pd.DataFrame({'actuatorVoltage': np.abs(np.arange(20) % 10 - 5.),
+                                'displacement': np.linspace(0,1,20)},index=index)
+        odm.getActuationDirectionAndCycle(self.df)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_appendAndRead(self):
+        path = AnalysisResults.getBinaryResultsPath(self.csvFile)
+        writer = AnalysisResults.AnalysisResultsWriter(path)
+        writer.append(self.df.iloc[:8])
+        writer.close()
+        writer = AnalysisResults.AnalysisResultsWriter(path,append=True)
+        writer.append(self.df.iloc[8:])
+        writer.close()
+
+        df = AnalysisResults.readAnalysisResults(path)
+        self.assertEqual(list(df.columns),list(self.df.columns))
+        self.assertTrue((df.index == self.df.index).all())
+        self.assertTrue((df.direction == self.df.direction).all())
+        self.assertTrue(np.array_equal(df.displacement,self.df.displacement))
+
+        selected = AnalysisResults.readAnalysisResults(path,columns=['displacement'])
+        self.assertEqual(list(selected.columns),['displacement'])
+
+    def test_readAnalysisDataDetectsBinaryResults(self):
+        self.df.to_csv(self.csvFile,index_label='timestamp')
+        AnalysisResults.writeAnalysisResults(self.df,AnalysisResults.getBinaryResultsPath(self.csvFile))
+        df = odm.readAnalysisData(self.csvFile,columns=['cycleNumber','displacement'])
+        self.assertEqual(df.cycleNumber.dtype,np.int32)
+        self.assertTrue((df.index == self.df.index).all())
+
+        os.utime(self.csvFile,(time.time() + 10,time.time() + 10))
+        df = odm.readAnalysisData(self.csvFile,columns=['cycleNumber','displacement'])
+        self.assertEqual(df.cycleNumber.dtype,np.int64)
+
+
+class Test_ChunkReader(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dataFile = os.path.join(self.folder,'data.csv')
+        writeDataFile(self.dataFile,nRows=30)
+        with open(self.dataFile) as f:
+            self.text = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def writeText(self,end):
+        with open(self.dataFile,'w') as f:
+            f.write(self.text[:end])
+
+    def test_readsAppendedData(self):
+        expected = odm.readODMData(self.dataFile,useCache=False)
+        reader = ChunkReader(self.dataFile)
+        chunks = []
+        #cuts in the header, halfway lines and at the end of the file
+        for end in [30,500,520,1500,len(self.text)]:
+            self.writeText(end)
+            df = reader.read_next()
+            if df is not None:
+                chunks.append(df)
+        df = pd.concat(chunks)
+        self.assertTrue((df.index == expected.index).all())
+        self.assertTrue(np.array_equal(odm.getIntensityProfileMatrix(df).data,odm.getIntensityProfileMatrix(expected).data))
+        self.assertEqual(reader.offset,len(self.text))
+
+    def test_truncation(self):
+        reader = ChunkReader(self.dataFile)
+        reader.read_next()
+        writeDataFile(self.dataFile,nRows=5)
+        self.assertEqual(len(reader.read_next()),4)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+class Test_FitResults(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        index = pd.date_range('2026-10-18 12:00',periods=5,freq='10ms',name='timestamp')
+        results = [(np.array([i,1.,2.]),np.eye(3)*i,0.1*i) for i in range(5)]
+        results[3] = (results[3][0],np.full((3,3),np.inf),results[3][2])
+        self.store = FitResults.FitResultStore.fromResults(results,index)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_views(self):
+        self.assertEqual(self.store.popt.shape,(5,3))
+        self.assertEqual(self.store.pcov.shape,(5,3,3))
+        self.assertEqual(self.store[-1].popt[0],4)
+        self.assertEqual(self.store[2].chiSquare,0.2)
+        self.assertEqual(list(self.store.status),[0,0,0,FitResults.STATUS_NO_COVARIANCE,0])
+        self.assertRaises(IndexError,lambda: self.store[5])
+
+    def test_lastUsableParameters(self):
+        self.store.status[4] = FitResults.STATUS_IMPLAUSIBLE
+        p = FitResults.lastUsableParameters(self.store)
+        self.assertEqual(list(p),[3,1,2])
+        p[0] = -1
+        self.assertEqual(self.store.popt[3,0],3)
+        self.assertEqual(FitResults.lastUsableParameters(self.store.slice(4,5),'default'),'default')
+
+    def test_writeAndRead(self):
+        path = FitResults.getFitResultsPath(self.folder)
+        FitResults.writeFitResults(path,{'mp': self.store})
+        stores = odm.readFitResultStores(path)
+        self.assertEqual(stores.keys(),['curveFitResult_mp'])
+        store = stores['curveFitResult_mp']
+        self.assertTrue(isinstance(store.popt,np.memmap))
+        self.assertTrue(np.array_equal(store.popt,self.store.popt))
+        self.assertTrue((store.index == self.store.index).all())
+        self.assertTrue(np.array_equal(store[-1].pcov,self.store.pcov[-1]))
+
+    def test_readPickledResults(self):
+        path = os.path.join(self.folder,'fitResults.pcl')
+        pd.DataFrame({'curveFitResult_mp': list(self.store)},index=self.store.index).to_pickle(path)
+        store = odm.readFitResultStores(path)['curveFitResult_mp']
+        self.assertTrue(np.array_equal(store.chiSquare,self.store.chiSquare))
+
+    def test_readCurveFitResultsDataFrame(self):
+        path = FitResults.getFitResultsPath(self.folder)
+        FitResults.writeFitResults(path,{'mp': self.store})
+        df = odm.readCurveFitResults(path)
+        self.assertEqual(list(df.columns),['curveFitResult_mp'])
+        self.assertTrue((df.index == self.store.index).all())
+        self.assertEqual(df.curveFitResult_mp.iloc[-1].popt[0],4)
+        self.assertEqual(df.curveFitResult_mp.iloc[2].chiSquare,0.2)
+
+    def test_appendAndResume(self):
+        path = FitResults.getFitResultsPath(self.folder)
+        writer = FitResults.FitResultsWriter(path)
+        writer.append({'mp': self.store.slice(0,2)})
+        writer.close()
+        #an interrupted write of the next block
+        with open(os.path.join(path,'mp','popt.npy'),'ab') as f:
+            f.write(np.zeros(2).tostring())
+
+        writer = FitResults.FitResultsWriter(path,append=True)
+        self.assertEqual(writer.nFrames,2)
+        writer.append({'mp': self.store.slice(2,5)})
+        writer.close()
+
+        stores = FitResults.readFitResults(path)
+        self.assertTrue(np.array_equal(stores['mp'].popt,self.store.popt))
+        self.assertTrue((stores['mp'].index == self.store.index).all())
+        self.assertEqual(FitResults.countResumableFrames(stores,self.store.index),5)
+        self.assertEqual(FitResults.countResumableFrames(stores,self.store.index[:3]),3)
+        self.assertEqual(FitResults.countResumableFrames(stores,self.store.index.insert(1,pd.Timestamp('2026-10-18 11:00'))),1)
+
+    def test_appendToSavedStore(self):
+        path = os.path.join(self.folder,'fitResults.odmfits')
+        self.store.slice(0,3).save(os.path.join(path,'mp'))
+        writer = FitResults.FitResultsWriter(path,append=True)
+        writer.append({'mp': self.store.slice(3,5)})
+        writer.close()
+        store = FitResults.readFitResults(path)['mp']
+        self.assertTrue(np.array_equal(store.chiSquare,self.store.chiSquare))
+        concatenated = FitResults.FitResultStore.concatenate([self.store.slice(0,3),self.store.slice(3,5)])
+        self.assertTrue(np.array_equal(concatenated.popt,self.store.popt))
+        self.assertTrue((concatenated.index == self.store.index).all())
@@ -0,0 +1,348 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import pickle
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from scipy.optimize import curve_fit
+import odmanalysis as odm
+import odmanalysis.fitfunctions as ff
+from odmanalysis.ProgressReporting import ProgressReporter
+
+
+def createProfiles(fitFunction,xdata,parameterSets,noise=1.0,seed=0):
+    random = np.random.RandomState(seed)
+    return np.array([fitFunction(xdata,*p) + random.normal(0,noise,len(xdata)) for p in parameterSets])
+
+
+class Test_BatchCurveFit(unittest.TestCase):
+    def test_matchesCurveFit(self):
+        gaussian = ff.Gaussian()
+        xdata = np.arange(40,100,dtype=float)
+        parameterSets = [[70 + 0.1*i,6,75000,0,1000] for i in range(20)]
+        ydata = createProfiles(gaussian,xdata,parameterSets)
+
+        result = ff.batchCurveFit(gaussian,xdata,ydata,parameterSets[0])
+        self.assertTrue(result.converged.all())
+        for i in [0,10,19]:
+            popt,pcov = curve_fit(gaussian,xdata,ydata[i],p0=parameterSets[0])
+            standardError = np.sqrt(np.diag(pcov))
+            self.assertTrue(np.all(np.abs(result.popt[i] - popt) < 1e-3 * standardError))
+            self.assertTrue(np.allclose(result.pcov[i],pcov,rtol=1e-2))
+
+    def test_analyticJacobian(self):
+        gaussian = ff.Gaussian()
+        xdata = np.arange(40,100,dtype=float)
+        parameterSets = [[70 + 0.1*i,6,75000,0,1000] for i in range(20)]
+        ydata = createProfiles(gaussian,xdata,parameterSets)
+
+        numeric = ff.batchCurveFit(gaussian,xdata,ydata,parameterSets[0])
+        analytic = ff.batchCurveFit(gaussian,xdata,ydata,parameterSets[0],jacobian=gaussian.jacobian)
+        self.assertTrue(analytic.converged.all())
+        self.assertTrue(np.allclose(analytic.popt[:,0],numeric.popt[:,0],atol=1e-5))
+
+
+class Test_Jacobians(unittest.TestCase):
+    def test_matchesFiniteDifferences(self):
+        xdata = np.arange(40,100,dtype=float)
+        cases = [(ff.Gaussian(),[70,6,75000,0.5,1000]),
+                 (ff.Harmonic(),[70,3000,0.02,2,1000]),
+                 (ff.Merlijnian(),[30,60,80,100,70,1000]),
+                 (ff.Jaapian(),[20,5,0.8,70,1000,100]),
+                 (ff.DualHarmonic(),[70,0.1,300,200,1000]),
+                 (ff.Sinc(),[0.3,500,1000,70.5])]
+        for fitFunction,p in cases:
+            p = np.array(p,dtype=float)
+            J = fitFunction.jacobian(xdata,*p)
+            self.assertEqual(J.shape,(len(xdata),len(p)))
+            for j in range(len(p)):
+                h = 1e-6*abs(p[j])
+                pPlus,pMinus = p.copy(),p.copy()
+                pPlus[j] += h
+                pMinus[j] -= h
+                numeric = (fitFunction(xdata,*pPlus) - fitFunction(xdata,*pMinus)) / (2*h)
+                self.assertTrue(np.allclose(J[:,j],numeric,rtol=1e-4,atol=1e-6*np.abs(J).max()),fitFunction.getName())
+
+
+class Test_CalculatePeakDisplacements(unittest.TestCase):
+    def test_resultViews(self):
+        gaussian = ff.Gaussian()
+        xdata = np.arange(100,dtype=float)
+        parameterSets = [[50 + 0.2*i,6,75000,0,1000] for i in range(10)]
+        profiles = createProfiles(gaussian,xdata,parameterSets)
+        index = pd.date_range('2026-10-18 12:00',periods=len(profiles),freq='10ms')
+        settings = odm.ODAFitSettings(gaussian,{'minBound': (30,0),'maxBound': (80,0)})
+
+        df = odm.calculatePeakDisplacements(pd.Series(list(profiles),index=index),settings,pInitial=parameterSets[0])
+        self.assertEqual(sorted(df.columns),['chiSquare','curveFitResult','displacement'])
+        self.assertTrue(np.allclose(df.displacement,[p[0] for p in parameterSets],atol=0.05))
+        result = df.curveFitResult[-1]
+        self.assertEqual(result.popt[0],df.displacement[-1])
+        self.assertEqual(result.chiSquare,df.chiSquare[-1])
+        self.assertTrue(all(r.store is result.store for r in df.curveFitResult))
+
+        store = odm.FitResultStore.fromCurveFitResults(df.curveFitResult)
+        self.assertTrue(store.popt is result.store.popt)
+        self.assertTrue(np.array_equal(pickle.loads(pickle.dumps(result)).pcov,result.pcov))
+
+
+class Test_UninitializedFitFunction(unittest.TestCase):
+    def test_pInitial(self):
+        #a spline fit function that was read from a fit settings file, which has no spline yet
+        xdata = np.arange(100,dtype=float)
+        profiles = createProfiles(ff.Gaussian(),xdata,[[40 + 0.25*i,6,75000,0,1000] for i in range(20)])
+        settings = odm.ODAFitSettings(ff.ScaledSpline(),{'minBound': (20,0),'maxBound': (80,0)})
+        settings = pickle.loads(pickle.dumps(settings))
+        settings.referenceIntensityProfile = profiles[0]
+        reference = odm.calculatePeakDisplacements(pd.Series(list(profiles)),settings,ProgressReporter())
+
+        settings = pickle.loads(pickle.dumps(odm.ODAFitSettings(ff.ScaledSpline(),{'minBound': (20,0),'maxBound': (80,0)})))
+        settings.referenceIntensityProfile = profiles[0]
+        pInitial = reference.curveFitResult.iloc[9].popt
+        df = odm.calculatePeakDisplacements(pd.Series(list(profiles[10:])),settings,ProgressReporter(),pInitial=pInitial)
+        self.assertTrue(np.allclose(df.displacement,reference.displacement[10:],atol=1e-6))
+
+
+class MessageRecorder(ProgressReporter):
+    def __init__(self):
+        self.messages = []
+
+    def message(self,message):
+        self.messages.append(message)
+
+
+class Test_ParallelFit(unittest.TestCase):
+    def setUp(self):
+        gaussian = ff.Gaussian()
+        xdata = np.arange(100,dtype=float)
+        self.parameterSets = [[40 + 0.25*i,6,75000,0,1000] for i in range(80)]
+        self.profiles = pd.Series(list(createProfiles(gaussian,xdata,self.parameterSets)))
+        self.settings = odm.ODAFitSettings(gaussian,{'minBound': (20,0),'maxBound': (80,0)})
+        self.serial = self.fit()
+
+    def fit(self,progressReporter=None,**kwargs):
+        return odm.calculatePeakDisplacements(self.profiles,self.settings,progressReporter or ProgressReporter(),pInitial=self.parameterSets[0],**kwargs)
+
+    def assertMatchesSerial(self,df):
+        self.assertTrue(df.index.equals(self.serial.index))
+        self.assertTrue(np.allclose(df.displacement,self.serial.displacement,atol=1e-6))
+        self.assertTrue(np.allclose(df.chiSquare,self.serial.chiSquare,rtol=1e-6))
+
+    def test_processes(self):
+        self.assertMatchesSerial(self.fit(nJobs=2))
+        #the first profile of every block is part of the pre-fit of every n-th profile
+        for blockSize,messages in [(35,['pre-fitting every 2th profile...','fitting 3 blocks of 34 profiles...']),
+                                   (50,['pre-fitting every 3th profile...','fitting 2 blocks of 48 profiles...'])]:
+            progressReporter = MessageRecorder()
+            self.assertMatchesSerial(self.fit(progressReporter,nJobs=2,blockSize=blockSize))
+            self.assertEqual(progressReporter.messages,messages)
+
+    def test_batchedSolver(self):
+        #blocks of 30 profiles, with 3 pre-fitted profiles each
+        self.assertMatchesSerial(self.fit(solver='batched',blockSize=30))
+
+        harmonic = ff.Harmonic()
+        xdata = np.arange(100,dtype=float)
+        parameterSets = [[40 + 0.25*i,2000,0.02,0,3000] for i in range(80)]
+        profiles = pd.Series(list(createProfiles(harmonic,xdata,parameterSets)))
+        settings = odm.ODAFitSettings(harmonic,{'minBound': (20,0),'maxBound': (80,0)})
+        serial = odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=parameterSets[0])
+        batched = odm.calculatePeakDisplacements(profiles,settings,ProgressReporter(),pInitial=parameterSets[0],solver='batched',blockSize=30)
+        self.assertTrue(np.allclose(batched.displacement,serial.displacement,atol=1e-4))
+
+    def test_executor(self):
+        pool = Pool(2)
+        try:
+            self.assertMatchesSerial(self.fit(executor=pool,blockSize=35))
+        finally:
+            pool.close()
+            pool.join()
+        threadPool = ThreadPool(2)
+        try:
+            self.assertMatchesSerial(self.fit(executor=threadPool,blockSize=50))
+        finally:
+            threadPool.close()
+            threadPool.join()
+
+
+class Test_WarmStart(unittest.TestCase):
+    def setUp(self):
+        self.gaussian = ff.Gaussian()
+        xdata = np.arange(100,dtype=float)
+        self.parameterSets = [[50 + 0.2*i,6,75000,0,1000] for i in range(30)]
+        self.profiles = createProfiles(self.gaussian,xdata,self.parameterSets)
+        #dropped frames
+        self.profiles[[10,11]] = createProfiles(self.gaussian,xdata,[[0,1,0,0,0]]*2)
+        self.settings = odm.ODAFitSettings(self.gaussian,{'minBound': (30,0),'maxBound': (80,0),
+                                                          'peakCoordinates': (50,5000),
+                                                          'lowerValleyCoordinates': (44,1000),
+                                                          'upperValleyCoordinates': (56,1000)})
+
+    def fit(self,**kwargs):
+        return odm.calculatePeakDisplacements(pd.Series(list(self.profiles)),self.settings,ProgressReporter(),
+                                              pInitial=self.parameterSets[0],maxfev=20000,**kwargs)
+
+    def test_estimateOrder(self):
+        self.settings.referenceIntensityProfile = self.profiles[0]
+        self.assertEqual(odm.estimateInitialParameters(self.settings)[:2],[50,6])
+
+    def test_recovery(self):
+        df = self.fit(warmStartPolicy=odm.WarmStartPolicy())
+        status = df.curveFitResult.iloc[0].store.status
+        valid = np.ones(len(self.profiles),dtype=bool)
+        valid[[10,11]] = False
+        self.assertTrue(np.all(status[valid] == odm.FitResults.STATUS_OK))
+        self.assertTrue(np.all(status[~valid] != odm.FitResults.STATUS_OK))
+        self.assertTrue(np.allclose(df.displacement[valid],[p[0] for p in np.array(self.parameterSets)[valid]],atol=0.05))
+
+    def test_tracker(self):
+        tracker = odm.WarmStartPolicy(predictor='linear',resetAfter=2).createTracker(self.gaussian,np.arange(30,81),[50,6,75000,0,1000])
+        for i,mu in enumerate([50,51]):
+            self.assertTrue(tracker.isPlausible(np.array([mu,6,75000,0,1000]),1.))
+            tracker.accept(np.array([mu,6,75000,0,1000]),1.,i)
+        self.assertEqual(tracker.initialParameters(2)[0],52)
+        self.assertFalse(tracker.isPlausible(np.array([51,6,75000,0,1000]),100.))
+        self.assertFalse(tracker.isPlausible(np.array([80,6,75000,0,1000]),1.))
+        self.assertFalse(tracker.isPlausible(np.array([np.nan,6,75000,0,1000]),1.))
+        tracker.reject()
+        tracker.reject()
+        self.assertTrue(tracker.isPlausible(np.array([80,6,75000,0,1000]),1.))
+        self.assertEqual(tracker.initialParameters(2)[0],50)
+
+    def test_predictors(self):
+        #a triangle sweep of the voltage, with a different slope in both directions
+        voltage = np.r_[np.arange(0,10.),np.arange(10,-1,-1.)]
+        popt = np.where(np.arange(len(voltage)) < 10,2*voltage,30 - voltage)[:,np.newaxis]
+        for predictor in [odm.WarmStart.LinearPredictor(),odm.WarmStart.KalmanPredictor(processNoise=1e3)]:
+            self.assertIsNone(predictor.predict(0))
+            errors = []
+            for v,p in zip(voltage,popt):
+                prediction = predictor.predict(v)
+                if prediction is not None:
+                    errors.append(abs(prediction[0] - p[0]))
+                predictor.update(p,v)
+            #only the first steps in both directions are not predicted
+            self.assertLess(np.sum(np.array(errors) > 0.1),6)
+            self.assertAlmostEqual(predictor.predict(-1)[0],31,places=1)
+            self.assertAlmostEqual(predictor.predict(1)[0],32,places=1)
+
+    def test_actuatorVoltage(self):
+        voltage = np.arange(len(self.profiles)) / 3.
+        df = self.fit(warmStartPolicy=odm.WarmStartPolicy(predictor='kalman'),actuatorVoltage=voltage)
+        reference = self.fit(warmStartPolicy=odm.WarmStartPolicy())
+        self.assertTrue(np.allclose(df.displacement,reference.displacement,atol=1e-4))
+        with self.assertRaises(ValueError):
+            self.fit(warmStartPolicy=odm.WarmStartPolicy(),actuatorVoltage=voltage[1:])
+
+
+class Test_FitCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.gaussian = ff.Gaussian()
+        xdata = np.arange(100,dtype=float)
+        self.parameterSets = [[50 + 0.2*i,6,75000,0,1000] for i in range(10)]
+        self.profiles = createProfiles(self.gaussian,xdata,self.parameterSets)
+        self.settings = odm.ODAFitSettings(self.gaussian,{'minBound': (30,0),'maxBound': (80,0)})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def fit(self,cache,settings=None,index=None,**kwargs):
+        return odm.calculatePeakDisplacements(pd.Series(list(self.profiles),index=index),settings or self.settings,ProgressReporter(),
+                                              pInitial=self.parameterSets[0],cache=cache,**kwargs)
+
+    def test_hit(self):
+        cache = odm.FitResultCache(self.folder)
+        df = self.fit(cache)
+        self.assertEqual((cache.hits,cache.misses),(0,1))
+
+        index = pd.date_range('2026-10-18 12:00',periods=len(self.profiles),freq='10ms')
+        cached = self.fit(cache,index=index)
+        self.assertEqual((cache.hits,cache.misses),(1,1))
+        self.assertTrue((cached.index == index).all())
+        self.assertTrue(np.array_equal(cached.displacement.values,df.displacement.values))
+        self.assertTrue(np.array_equal(cached.curveFitResult.iloc[-1].pcov,df.curveFitResult.iloc[-1].pcov))
+
+    def test_miss(self):
+        cache = odm.FitResultCache(self.folder)
+        self.fit(cache)
+        self.fit(cache,settings=odm.ODAFitSettings(self.gaussian,{'minBound': (31,0),'maxBound': (80,0)}))
+        self.fit(cache,maxfev=500)
+        self.profiles[3,50] += 1
+        self.fit(cache)
+        self.assertEqual((cache.hits,cache.misses),(0,4))
+
+    def test_eviction(self):
+        store = odm.FitResultStore.fromResults([(np.zeros(5),np.eye(5),1.)]*100)
+        cache = odm.FitResultCache(self.folder)
+        for key in ['a','b','c']:
+            cache.put(key,store)
+            #the modification times must differ
+            os.utime(os.path.join(self.folder,key),(time.time(),time.time() - {'a': 30,'b': 20,'c': 10}[key]))
+        entrySize = cache.size / 3
+        self.assertTrue(cache.get('a') is not None)
+
+        cache.evict(2*entrySize)
+        self.assertEqual(['a' in cache,'b' in cache,'c' in cache],[True,False,True])
+
+class Test_TemplateMatching(unittest.TestCase):
+    def setUp(self):
+        self.x = np.arange(120,dtype=float)
+        self.shape = lambda center: 1000 + 500*np.exp(-((self.x - center)/6.)**2) - 200*np.exp(-((self.x - center - 10)/4.)**2)
+
+    def test_splineTemplate(self):
+        fitFunction = ff.createFitFunction("Scaled Spline (template matching)")
+        fitFunction.estimateInitialParameters(self.shape(60))
+        t = np.linspace(-5,125,1000)
+        values,derivatives = fitFunction.template.evaluate(t)
+        self.assertTrue(np.allclose(values,fitFunction.spline(t),rtol=1e-9))
+        self.assertTrue(np.allclose(derivatives,fitFunction.spline(t,nu=1),rtol=1e-6,atol=1e-6))
+
+    def test_matchesScaledSpline(self):
+        random = np.random.RandomState(1)
+        shifts = 8*np.sin(np.arange(300)/20.)
+        profiles = np.array([1.02*self.shape(60 + shift) + 5 + random.normal(0,2,len(self.x)) for shift in shifts])[:,20:100]
+        xdata = self.x[20:100]
+
+        scaledSpline = ff.ScaledSpline()
+        p0 = scaledSpline.estimateInitialParameters(self.shape(60)).values()
+        templateMatching = ff.TemplateMatchingSpline(blockSize=128)
+        templateMatching.estimateInitialParameters(self.shape(60))
+
+        results = templateMatching.fitProfiles(xdata,profiles,p0)
+        for i in [0,75,150,299]:
+            popt,pcov = curve_fit(scaledSpline,xdata,profiles[i],p0=results[i][0])
+            self.assertAlmostEqual(results[i][0][0],popt[0],places=4)
+            self.assertAlmostEqual(results[i][0][0],shifts[i],places=1)
+
+
+class Test_CrossCorrelation(unittest.TestCase):
+    def test_shifts(self):
+        from odmanalysis.fitfunctions.CrossCorrelation import crossCorrelationShifts
+        x = np.arange(120,dtype=float)
+        shape = lambda center: 1000 + 500*np.exp(-((x - center)/6.)**2) - 200*np.exp(-((x - center - 10)/4.)**2)
+        shifts = np.linspace(-9.5,9.5,50)
+        profiles = np.array([1.1*shape(60 + shift) + 20 for shift in shifts])
+
+        estimated = crossCorrelationShifts(x[20:100],profiles[:,20:100],shape(60),upsampleFactor=1000)
+        self.assertTrue(np.allclose(estimated,shifts,atol=1e-3))
+
+    def test_fitFunction(self):
+        x = np.arange(120,dtype=float)
+        shape = lambda center: 1000 + 500*np.exp(-((x - center)/6.)**2)
+        fitFunction = ff.createFitFunction("FFT cross-correlation")
+        fitFunction.estimateInitialParameters(shape(60))
+        profiles = np.array([0.9*shape(60 + shift) + 50 for shift in [-2.25,0,3.5]])[:,20:100]
+
+        results = fitFunction.fitProfiles(x[20:100],profiles,[0,1,0])
+        self.assertTrue(np.allclose([popt[0] for popt,pcov,chiSquare in results],[-2.25,0,3.5],atol=1e-2))
+        scales = [popt[1] for popt,pcov,chiSquare in results]
+        self.assertTrue(np.allclose(scales,scales[0],rtol=1e-3))
+
+
+if __name__ == '__main__':
+    unittest.main()
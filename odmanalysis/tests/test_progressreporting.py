@@ -0,0 +1,160 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import odmanalysis as odm
+import odmanalysis.fitfunctions as ff
+from StringIO import StringIO
+from odmanalysis.ProgressReporting import BasicProgressReporter, InstrumentedStage, CollectingSink, JsonLinesSink, SummaryTableSink, ProgressReporter, addInstrumentationSink, removeInstrumentationSink, measureStage
+from odmanalysis.ProgressReporting import RateLimiter, StreamReporter, ThrottledProgressReporter, throttled
+from odmanalysis.tests.test_datareading import writeDataFile
+
+
+@InstrumentedStage('doubling')
+def double(df):
+    return df * 2
+
+@BasicProgressReporter(entryMessage="Summing...")
+def total(df,progressReporter=None):
+    return float(df.a.sum())
+
+
+class Test_Instrumentation(unittest.TestCase):
+    def setUp(self):
+        self.sink = addInstrumentationSink(CollectingSink())
+        self.df = pd.DataFrame({'a': np.arange(10.)})
+
+    def tearDown(self):
+        removeInstrumentationSink(self.sink)
+
+    def test_instrumentedStage(self):
+        double(self.df)
+        double(self.df)
+        self.assertEqual(len(self.sink.records),2)
+        record = self.sink.records[0]
+        self.assertEqual(record['stage'],'doubling')
+        self.assertEqual(record['items'],10)
+        self.assertFalse(record['failed'])
+        self.assertGreaterEqual(record['wallTime'],0)
+        self.assertGreaterEqual(record['cpuTime'],0)
+
+    def test_basicProgressReporterRecordsStage(self):
+        total(self.df,progressReporter=ProgressReporter())
+        self.assertEqual(total.func_name,'total')
+        self.assertEqual([r['stage'] for r in self.sink.records],['total'])
+        self.assertEqual(self.sink.records[0]['items'],10)
+
+    def test_measureStage(self):
+        with measureStage('manual',items=3):
+            pass
+        with self.assertRaises(ValueError):
+            with measureStage('failing'):
+                raise ValueError()
+        self.assertEqual([(r['stage'],r['failed']) for r in self.sink.records],[('manual',False),('failing',True)])
+
+    def test_summary(self):
+        double(self.df)
+        double(self.df)
+        total(self.df,progressReporter=ProgressReporter())
+        summary = self.sink.summary()
+        self.assertEqual(list(summary.index),['doubling','total'])
+        self.assertEqual(summary.loc['doubling','calls'],2)
+        self.assertEqual(summary.loc['doubling','items'],20)
+
+    def test_readODMData(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempDir,'data.csv')
+            writeDataFile(path)
+            df = odm.readODMData(path,progressReporter=ProgressReporter(),useCache=False)
+            self.assertEqual([r['stage'] for r in self.sink.records],['reading'])
+            self.assertEqual(self.sink.records[0]['items'],len(df))
+        finally:
+            shutil.rmtree(tempDir)
+
+
+class Test_Sinks(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_jsonLinesSink(self):
+        path = os.path.join(self.tempDir,'stages.jsonl')
+        sink = addInstrumentationSink(JsonLinesSink(path))
+        try:
+            double(pd.Series(np.arange(5)))
+        finally:
+            removeInstrumentationSink(sink)
+        double(pd.Series(np.arange(5)))
+
+        with open(path,'r') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records),1)
+        self.assertEqual(records[0]['stage'],'doubling')
+        self.assertEqual(records[0]['items'],5)
+
+    def test_summaryTableSink(self):
+        path = os.path.join(self.tempDir,'summary.txt')
+        with open(path,'w') as stream:
+            sink = addInstrumentationSink(SummaryTableSink(stream))
+            double(pd.Series(np.arange(5)))
+            removeInstrumentationSink(sink)
+        with open(path,'r') as f:
+            self.assertIn('doubling',f.read())
+
+
+class RecordingProgressReporter(ProgressReporter):
+    def __init__(self):
+        self.progressValues = []
+        self.messages = []
+
+    def progress(self,progress,message=""):
+        self.progressValues.append(progress)
+
+    def message(self,message):
+        self.messages.append(message)
+
+
+class Test_Throttling(unittest.TestCase):
+    def test_rateLimiterInterval(self):
+        limiter = RateLimiter(minInterval=60)
+        self.assertTrue(limiter.ready())
+        self.assertFalse(any(limiter.ready() for i in range(1000)))
+
+    def test_rateLimiterCount(self):
+        limiter = RateLimiter(minInterval=0,minCount=10)
+        self.assertEqual(sum(limiter.ready() for i in range(100)),10)
+
+    def test_throttledProgressReporter(self):
+        recorder = RecordingProgressReporter()
+        reporter = ThrottledProgressReporter(recorder,minInterval=60)
+        for i in range(1,101):
+            reporter.progress(i)
+        reporter.message("fitted")
+        self.assertEqual(recorder.progressValues,[1,100])
+        self.assertEqual(recorder.messages,["fitted"])
+        self.assertIs(throttled(reporter),reporter)
+
+    def test_streamReporter(self):
+        stream = StringIO()
+        reporter = StreamReporter(stream,minInterval=60)
+        for i in range(1,101):
+            reporter.progress(i,"fitting")
+        self.assertEqual(stream.getvalue(),"fitting 1%\rfitting 100%\r")
+
+    def test_calculatePeakDisplacementsThrottlesProgress(self):
+        x = np.arange(60,dtype=float)
+        profiles = pd.Series([1000 + 2000*np.exp(-0.5*((x - 30 - i/100.)/5.)**2) for i in range(300)])
+        settings = odm.ODAFitSettings(ff.Gaussian(),{'minBound': (10,0),'maxBound': (50,0)})
+        recorder = RecordingProgressReporter()
+        odm.calculatePeakDisplacements(profiles,settings,recorder,pInitial=[30,5,2000*5*np.sqrt(2*np.pi),0,1000])
+        self.assertLess(len(recorder.progressValues),len(profiles) / 10)
+        self.assertEqual(recorder.progressValues[-1],100)
+
+if __name__ == '__main__':
+    unittest.main()
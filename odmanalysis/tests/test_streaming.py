@@ -0,0 +1,135 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import odmanalysis as odm
+import odmanalysis.fitfunctions as ff
+import odmanalysis.chunkhandling.Streaming as Streaming
+from odmanalysis.chunkhandling import ChunkReader, ChunkWriter, ChunkedODMDataProcessor, StreamingPipeline
+from odmanalysis.tests.test_datareading import writeDataFile
+
+
+def writePeakDataFile(path,nRows=300,nPixels=100):
+    random = np.random.RandomState(0)
+    x = np.arange(nPixels)
+    with open(path,'w') as f:
+        f.write("Timestamp\tRelative time (s)\tActuator Voltage (V)\tIntensity Profile\n")
+        for i in range(nRows):
+            voltage = abs(i % 100 - 50.)
+            profile = 1000 + 2000*np.exp(-0.5*((x - 40 - voltage/10.)/5.)**2) + random.normal(0,2,nPixels)
+            f.write("10/18/2026 12:%02i:%02i.000\t%f\t%f\t<%s>\n" % (i // 60,i % 60,i*1.0,voltage,";".join("%i" % p for p in profile)))
+
+
+class ConstantDisplacementProcessor(object):
+    def __init__(self,delay=0.):
+        self.delay = delay
+        self.actuationState = None
+
+    def processDataFrame(self,df):
+        time.sleep(self.delay)
+        df = df.drop('intensityProfile',axis=1)
+        for column in ['displacement','displacement_mp','chiSquare_mp']:
+            df[column] = 1.
+        df,self.actuationState = odm.getActuationDirectionAndCycleIncremental(df,self.actuationState)
+        return df
+
+
+def failInSecondMinute(df,*args):
+    if (df.index.minute == 1).any():
+        raise ValueError("cannot fit")
+    return fitDataFrame(df,*args)
+
+def exitInSecondMinute(df,*args):
+    if (df.index.minute == 1).any():
+        #like a worker process that is killed
+        os._exit(1)
+    return fitDataFrame(df,*args)
+
+fitDataFrame = Streaming._fitDataFrame
+
+
+class Test_StreamingPipeline(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dataFile = os.path.join(self.folder,'data.csv')
+        self.outputFile = os.path.join(self.folder,'odmanalysis.csv')
+        writeDataFile(self.dataFile,nRows=200)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stopFlushesAllRows(self):
+        pipeline = StreamingPipeline(ChunkReader(self.dataFile,maxBytes=1000),ConstantDisplacementProcessor(),ChunkWriter(self.outputFile),queueSize=2)
+        pipeline.start()
+        self.assertTrue(pipeline.stop(timeout=30))
+
+        df = pd.read_csv(self.outputFile)
+        self.assertEqual(len(df),199)
+        self.assertTrue(df.relativeTime.is_monotonic_increasing)
+        metrics = pipeline.getMetrics()
+        self.assertEqual(metrics['dropped'],0)
+        self.assertEqual(metrics['stages']['processor']['errors'],0)
+        self.assertTrue(metrics['maxEndToEndLatency'] > 0)
+
+    def test_dropPolicy(self):
+        pipeline = StreamingPipeline(ChunkReader(self.dataFile,maxBytes=500),ConstantDisplacementProcessor(delay=0.05),ChunkWriter(self.outputFile),queueSize=1,policy='drop')
+        pipeline.start()
+        self.assertTrue(pipeline.stop(timeout=30))
+
+        metrics = pipeline.getMetrics()
+        self.assertTrue(metrics['dropped'] > 0)
+        df = pd.read_csv(self.outputFile)
+        self.assertTrue(0 < len(df) < 199)
+
+    def test_parallelWorkersKeepOrder(self):
+        writePeakDataFile(self.dataFile)
+        fitSettings = odm.ODAFitSettings(ff.ScaledSpline(),{'minBound': (20,0),'maxBound': (70,0)})
+        serial = ChunkedODMDataProcessor(self.folder,fitSettings,interactive=False)
+        parallel = ChunkedODMDataProcessor(self.folder,fitSettings,interactive=False)
+
+        pipeline = StreamingPipeline(ChunkReader(self.dataFile,maxBytes=20000),parallel,ChunkWriter(self.outputFile),nWorkers=2)
+        pipeline.start()
+        self.assertTrue(pipeline.stop(timeout=60))
+        self.assertEqual(pipeline.getMetrics()['stages']['ordering']['errors'],0)
+
+        expected = serial.processDataFrame(odm.readODMData(self.dataFile,useCache=False))
+        df = pd.read_csv(self.outputFile)
+        self.assertEqual(len(df),300)
+        self.assertTrue(np.allclose(df.displacement,expected.displacement,atol=1e-3))
+        self.assertTrue((df.cycleNumber.values == expected.cycleNumber.values).all())
+
+    def runFailingParallelPipeline(self,fitFunction,**kwargs):
+        writePeakDataFile(self.dataFile)
+        fitSettings = odm.ODAFitSettings(ff.ScaledSpline(),{'minBound': (20,0),'maxBound': (70,0)})
+        processor = ChunkedODMDataProcessor(self.folder,fitSettings,interactive=False)
+        pipeline = StreamingPipeline(ChunkReader(self.dataFile,maxBytes=20000),processor,ChunkWriter(self.outputFile),nWorkers=2,**kwargs)
+        #the worker processes are forked when the pipeline starts
+        Streaming._fitDataFrame = fitFunction
+        try:
+            pipeline.start()
+        finally:
+            Streaming._fitDataFrame = fitDataFrame
+        self.assertTrue(pipeline.stop(timeout=60))
+
+        self.assertTrue(pipeline.getMetrics()['stages']['ordering']['errors'] > 0)
+        df = pd.read_csv(self.outputFile,parse_dates=['timestamp'])
+        #the chunks after the failed ones are written
+        self.assertEqual(df.relativeTime.values[-1],299)
+        self.assertTrue(df.relativeTime.is_monotonic_increasing)
+        return pd.DatetimeIndex(df.timestamp).minute
+
+    def test_parallelFailedChunkIsSkipped(self):
+        minutes = self.runFailingParallelPipeline(failInSecondMinute)
+        self.assertFalse((minutes == 1).any())
+
+    def test_parallelLostChunkTimesOut(self):
+        #the workers that replace the exited worker fit all chunks, so only the first chunk is lost
+        minutes = self.runFailingParallelPipeline(exitInSecondMinute,chunkTimeout=5)
+        self.assertTrue(len(minutes) < 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -47,6 +47,7 @@ setup(name='odmanalysis',
               'odm_plot=odmanalysis.scripts.MakeODMPlots:main',
               'odm_fit=odmanalysis.scripts.FitRawODMData:main',
               'odm_fitfast=odmanalysis.scripts.FitFastRawODMData:main',
+              'odm_batch=odmanalysis.scripts.BatchFitRawODMData:main',
               'odm_noise=odmanalysis.scripts.AnalyzeDisplacementCurveNoise:main',
               'odm_watch=odmanalysis.scripts.ODMWatchdog:main',
               'odm_clean_data=odmanalysis.scripts.RemoveUnitsFromRawData:main',